@@ -1,41 +1,43 @@
+import asyncio
 import os
-from typing import List
+import queue
+import threading
+import time
+from functools import lru_cache
+from typing import AsyncIterator, Iterator, List
 from llama_index.core.agent import ReActAgent
 from llama_index.core.workflow import Context
-from llama_index.core.agent.workflow import AgentStream, ToolCallResult
+from llama_index.core.agent.workflow import AgentInput, AgentStream, ToolCall, ToolCallResult
 from llama_index.core.memory import ChatMemoryBuffer
-from llama_index.core.storage.chat_store import SimpleChatStore
+from llama_index.core.llms import ChatMessage, MessageRole
 from llama_index.core import Settings
 
-from llama_index.llms.ollama import Ollama
-from llama_index.llms.openai_like import OpenAILike
-from llama_index.embeddings.huggingface import HuggingFaceEmbedding
-
-from .tools import ToolsBuilder
-
-def get_llm():
-    # OLLAMA_MODEL = "qwen3:8b" 
-    # OLLAMA_ENDPOINT = "http://localhost:11434/api/chat"
-    # return Ollama(model=OLLAMA_MODEL, endpoint=OLLAMA_ENDPOINT)
-    return OpenAILike(
-        model="gemini-2.5-flash",
-        api_base="https://gemini.kzm.pw/openai/v1",
-        api_key="sk-G@ry1203",
-        context_window=128000,
-        is_chat_model=True,
-        is_function_calling_model=True,
-    )
+from .tools import ToolsBuilder, format_search_results
+from .llm_client import get_llm
+from .router import IntentRouter, search_terms, warm_intent_classifier
+from .chat_store import get_chat_store
+from .memory import RollingSummaryMemory
+from .usage import track_turn, record_tool, record_iteration
+from .tracing import next_iteration, span
+
+# buffer: 單純截斷；summary: 最近幾輪保留原文，舊對話在背景摺疊成摘要
+MEMORY_MODE = os.environ.get("APP_MEMORY_MODE", "summary")
+# mock: 固定向量，不載入模型（基準測試、離線開發用）
+EMBED_MODEL = os.environ.get("APP_EMBED_MODEL", "BAAI/bge-small-en-v1.5")
+
+_pending_summaries: set = set()
 
 PROMPT = """
 你是一個禮貌且簡潔的助理，可以回答問題、查詢產品資訊、存取文件內容，以及協助下單。
 請嚴格遵守以下規則：
 
 1. **只有在必要時才使用工具**
-   - `product_sql_tool`：僅用於從資料庫取得產品描述或規格。
+   - `product_search_tool`：用關鍵字搜尋產品（名稱、價格、庫存），找產品時優先使用。
+   - `product_sql_tool`：僅用於需要彙總、比較或複雜條件的產品查詢。
    - `order_sql_tool`：用於查詢訂單資訊。
-   - `docs_tool`：用於回答文件中的問題。
-   - `place_order_tool`：在所有必要資訊齊全後才用於下單。
-   - `request_more_info_tool`：用於向使用者詢問缺少的必要資訊。
+   - `policy_docs_tool`：用於回答文件中的問題。
+   - `place_order`：在所有必要資訊齊全後才用於下單。
+   - `request_more_info`：用於向使用者詢問缺少的必要資訊。
 
 2. **保持禮貌與簡潔**
    - 如果可以辨識使用者的語言，則用相同語言回覆。
@@ -48,7 +50,7 @@ PROMPT = """
 4. **逐步推理**
    - 思考使用者的需求。
    - 決定要用哪個工具。
-   - 如果要使用 `sql_tool`，先推敲正確的 WHERE 條件再寫 SQL。
+   - 如果要使用 `product_sql_tool` 或 `order_sql_tool`，先推敲正確的 WHERE 條件再寫 SQL。
    - 展示推理過程後再呼叫工具。
    - 觀察工具輸出，然後回覆使用者。
 
@@ -61,41 +63,234 @@ PROMPT = """
     - 每個使用者的記憶是獨立的。
 """
 
+@lru_cache(maxsize=1)
+def get_embed_model() -> "HuggingFaceEmbedding":
+    if EMBED_MODEL == "mock":
+        from llama_index.core.embeddings import MockEmbedding
+        return MockEmbedding(embed_dim=384)
+    # 載入 HuggingFace / torch 需要數秒，等第一次用到才 import
+    from llama_index.embeddings.huggingface import HuggingFaceEmbedding
+    return HuggingFaceEmbedding(model_name=EMBED_MODEL)
+
+
+class AnswerStream:
+    """從 ReAct 的串流輸出中只取出 `Answer:` 之後的文字；每個 LLM 步驟開始時 reset()"""
+
+    MARKER = "Answer:"
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self) -> None:
+        self.buffer = ""
+        self.answering = False
+
+    def feed(self, delta: str) -> str:
+        if self.answering:
+            return delta
+        self.buffer += delta
+        idx = self.buffer.find(self.MARKER)
+        if idx >= 0:
+            self.answering = True
+            return self.buffer[idx + len(self.MARKER):].lstrip()
+        head = self.buffer.lstrip()
+        if len(head) >= len("Thought") and not head.startswith(("Thought", "Action")):
+            # 沒有照 ReAct 格式、直接回答
+            self.answering = True
+            return head
+        return ""
+
+
+class TracedReActAgent(ReActAgent):
+    """每次推理開一個 react.iteration span，接著的工具呼叫也算在同一個迭代"""
+
+    async def take_step(self, ctx, llm_input, tools, memory):
+        iteration = next_iteration()
+        try:
+            output = await super().take_step(ctx, llm_input, tools, memory)
+        except Exception as e:
+            if iteration is not None:
+                iteration.end(error=e)
+            raise
+        if iteration is not None:
+            iteration.set(tool_calls=",".join(t.tool_name for t in output.tool_calls) or None)
+            if not output.tool_calls:
+                iteration.end()
+        return output
+
+
 class AgentBuilder:
 
     def __init__(self, store_id: int, user_id: str):
+        self.store_id = store_id
+        self.user_id = user_id
         os.makedirs(os.path.join(os.getcwd(), "storage"), exist_ok=True)
 
-        # Configure global settings
+        # Configure global settings（LLM 與 embedding 模型整個 process 共用）
         Settings.llm = get_llm()
-        Settings.embed_model = HuggingFaceEmbedding(model_name="BAAI/bge-small-en-v1.5")
+        Settings.embed_model = get_embed_model()
 
-        self.chat_store = SimpleChatStore()
-        chat_store_path = os.path.join(os.getcwd(), "storage", "chat_store.json")
-        # self.chat_store.from_persist_path(chat_store_path)
-        self.memory = ChatMemoryBuffer.from_defaults(chat_store=self.chat_store, chat_store_key=user_id, token_limit=4000)
+        # 記憶逐筆寫入 SQLite，依 user_id 延遲載入
+        self.chat_store = get_chat_store()
+        if MEMORY_MODE == "summary":
+            self.memory = RollingSummaryMemory.from_defaults(llm=Settings.llm, chat_store=self.chat_store, chat_store_key=user_id, token_limit=4000)
+        else:
+            self.memory = ChatMemoryBuffer.from_defaults(chat_store=self.chat_store, chat_store_key=user_id, token_limit=4000)
 
         tools_builder = ToolsBuilder(store_id, user_id)
+        self.tools = tools_builder.build_tools()
+        self.tools_by_name = {tool.metadata.name: tool for tool in self.tools}
+        self.router = IntentRouter()
+        # 分類器在背景訓練，完成前模糊的訊息交給 agent
+        warm_intent_classifier()
 
-        self.agent = ReActAgent(system_prompt=PROMPT, tools=tools_builder.build_tools(), memory=self.memory, llm=Settings.llm, verbose=True, max_iterations=3)
+        self.agent = TracedReActAgent(system_prompt=PROMPT, tools=self.tools, memory=self.memory, llm=Settings.llm, verbose=True, max_iterations=3)
         self.ctx = Context(self.agent)
-        self.ctx.set("store_id", store_id)
-        self.ctx.set("user_id", user_id)
+
+    async def stream_chat(self, user_input: str) -> AsyncIterator[dict]:
+        """逐步產生事件：trace（原始 ReAct 輸出）、delta（給使用者的回答片段）、tool、done"""
+        with span("agent.chat", root=True, store_id=self.store_id, user_id=str(self.user_id)) as turn_span, \
+                track_turn(self.store_id, self.user_id) as stats:
+            routed = await self._route_direct(user_input, stats)
+            if turn_span is not None:
+                turn_span.set(routed=stats.routed)
+            if routed is not None:
+                yield {"type": "delta", "delta": routed}
+                yield {"type": "done", "response": routed}
+                return
+
+            answer = AnswerStream()
+            tool_started = {}
+            first_tool = None
+            handler = self.agent.run(user_input, context=self.ctx, memory=self.memory)
+            async for ev in handler.stream_events():
+                if isinstance(ev, AgentInput):
+                    record_iteration()
+                    answer.reset()
+                if isinstance(ev, ToolCall):
+                    tool_started[ev.tool_id] = time.perf_counter()
+                    first_tool = first_tool or ev.tool_name
+                if isinstance(ev, ToolCallResult):
+                    started = tool_started.pop(ev.tool_id, None)
+                    if started is not None:
+                        record_tool(ev.tool_name, (time.perf_counter() - started) * 1000)
+                    yield {"type": "tool", "tool_name": ev.tool_name, "tool_kwargs": ev.tool_kwargs, "output": str(ev.tool_output)}
+                    if ev.tool_name == "request_more_info":
+                        handler.cancel_run()
+                        output = str(ev.tool_output)
+                        yield {"type": "delta", "delta": output}
+                        yield {"type": "done", "response": output}
+                        return
+                if isinstance(ev, AgentStream):
+                    yield {"type": "trace", "delta": ev.delta}
+                    delta = answer.feed(ev.delta)
+                    if delta:
+                        yield {"type": "delta", "delta": delta}
+
+            response = await handler
+            if first_tool is not None:
+                # 意圖分類器的訓練資料（記憶中的回答已去掉 Action 軌跡，無法事後推回）
+                await asyncio.to_thread(self.chat_store.add_tool_choice, str(self.user_id), user_input, first_tool)
+            yield {"type": "done", "response": str(response)}
 
     async def chat(self, user_input: str) -> str:
-        handler = self.agent.run(user_input, context=self.ctx, memory=self.memory)
-        async for ev in handler.stream_events():
-            if isinstance(ev, ToolCallResult):
-                print(f"\nCall {ev.tool_name} with {ev.tool_kwargs}\nReturned: {ev.tool_output}")
-                if ev.tool_name == "request_more_info_tool":
-                    handler.cancel_run()
-                    return ev.tool_output
-            if isinstance(ev, AgentStream):
-                print(f"{ev.delta}", end="", flush=True)
-
-        response = await handler
-        return str(response)
-    
+        response = ""
+        async for event in self.stream_chat(user_input):
+            if event["type"] == "trace":
+                print(event["delta"], end="", flush=True)
+            elif event["type"] == "tool":
+                print(f"\nCall {event['tool_name']} with {event['tool_kwargs']}\nReturned: {event['output']}")
+            elif event["type"] == "done":
+                response = event["response"]
+        return response
+
+    async def _route_direct(self, user_input: str, stats=None):
+        """明確意圖直接呼叫工具，略過 ReAct 的 Thought/Action 迴圈；不確定時回傳 None"""
+        route = await self.router.aroute(user_input)
+        if route is None or route.tool_name not in self.tools_by_name:
+            return None
+        tool = self.tools_by_name[route.tool_name]
+        print(f"\nRoute {route.intent} -> {route.tool_name} ({route.source}, {route.confidence:.2f})")
+        started = time.perf_counter()
+        if route.tool_name == "product_search_tool":
+            # 關鍵字搜尋不需要 LLM；句子裡沒有商品關鍵字或找不到商品時交給 agent
+            query = search_terms(user_input)
+            results = (await tool.acall(query=query)).raw_output if query else []
+            answer = format_search_results(results) if results else None
+        else:
+            answer = str(await tool.acall(user_input))
+        record_tool(route.tool_name, (time.perf_counter() - started) * 1000)
+        if answer is None:
+            return None
+        if stats is not None:
+            stats.routed = route.intent
+        await self.memory.aput(ChatMessage(role=MessageRole.USER, content=user_input))
+        await self.memory.aput(ChatMessage(role=MessageRole.ASSISTANT, content=answer))
+        return answer
+
     def save(self):
-        chat_store_path = os.path.join(os.getcwd(), "storage", "chat_store.json")
-        self.chat_store.persist(chat_store_path)
\ No newline at end of file
+        """訊息在加入記憶時就已寫入資料庫，保留此方法以相容既有呼叫"""
+        pass
+
+    def close(self):
+        """從快取淘汰時呼叫：記憶已在資料庫中，下次建立 agent 會依 user_id 重新載入"""
+        self.save()
+        task = getattr(self.memory, "_summary_task", None)
+        if task is not None and not task.done():
+            # event loop 對 task 只保留弱參照；agent 被回收前先接手，讓背景摘要完成後寫回
+            _pending_summaries.add(task)
+            task.get_loop().call_soon_threadsafe(task.add_done_callback, _pending_summaries.discard)
+
+
+def shared_agent_objects() -> list:
+    """所有 agent 共用的物件，估算單一 agent 的記憶體時不計入"""
+    from .router import get_intent_classifier
+    from .schema_context import get_pruned_sql_database
+
+    shared = [Settings.llm, Settings.embed_model, get_chat_store()]
+    for profile in ("product", "order"):
+        database = get_pruned_sql_database(profile)
+        shared.extend([database, database.engine])
+    if get_intent_classifier.cache_info().currsize:
+        shared.append(get_intent_classifier())
+    if get_agent_loop.cache_info().currsize:
+        shared.append(get_agent_loop())
+    return shared
+
+
+def build_user_agent(user_id: str, store_id: int) -> AgentBuilder:
+    """LINE 使用者的 agent；記憶以 LINE user id 區分"""
+    return AgentBuilder(store_id, user_id)
+
+
+@lru_cache(maxsize=1)
+def get_agent_loop() -> asyncio.AbstractEventLoop:
+    """同步呼叫端（Flask）共用的背景 event loop；agent 的 Context 與連線池都綁在這個 loop 上"""
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, name="agent-loop", daemon=True).start()
+    return loop
+
+
+def iter_chat_events(agent: AgentBuilder, user_input: str) -> Iterator[dict]:
+    """在背景 loop 執行 agent.stream_chat，讓同步的 WSGI generator 逐筆取得事件"""
+    events: "queue.Queue" = queue.Queue()
+
+    async def pump():
+        try:
+            async for event in agent.stream_chat(user_input):
+                events.put(event)
+        except Exception as e:
+            events.put({"type": "error", "error": str(e)})
+        finally:
+            events.put(None)
+
+    future = asyncio.run_coroutine_threadsafe(pump(), get_agent_loop())
+    try:
+        while True:
+            event = events.get()
+            if event is None:
+                break
+            yield event
+    finally:
+        # 用戶端中途斷線時停止 agent
+        future.cancel()
@@ -0,0 +1,341 @@
+"""
+Agent 每輪對話的開銷基準
+
+    python -m app.agent_bench --db storage/bench.db --sessions 20 --turns 6 --concurrency 4
+    python -m app.agent_bench ... --ttft-ms 0 --tokens-per-sec 0      # 只量應用程式本身
+    python -m app.agent_bench ... --compare storage/benchmarks/agent-<舊版>.json
+
+在本機啟動 mock_llm（固定延遲、腳本化的 ReAct 與 text-to-SQL 輸出），
+以 --db 中的商品與使用者產生客服問題（或讀取 --corpus），每個 session 建立一個 AgentBuilder 依序對話。
+每輪從 usage.TurnStats 拆出 LLM、SQL、文件檢索、記憶讀取、記憶寫入的時間，其餘視為框架開銷；
+另外單獨量測 agent 建立、記憶載入、工具派送、文件檢索與 SQL 查詢。結果另存成 JSON 供不同 commit 比較。
+
+embedding 預設使用固定向量（APP_EMBED_MODEL=mock），文件索引與用量紀錄寫在 --workdir，不會動到 storage/。
+"""
+
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import random
+import sqlite3
+import sys
+import time
+from collections import defaultdict
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+from .loadtest import git_commit, percentile, prepare_database
+from .mock_llm import MOCK_MODEL, start_mock_llm
+
+RESULTS_DIR = os.path.join(os.getcwd(), "storage", "benchmarks")
+
+# 問題種類 -> (權重, 樣板)；{product} 會代入該商店的商品名稱
+QUESTION_TEMPLATES: Dict[str, tuple] = {
+    "product": (40, ["請問有賣「{product}」嗎？", "想找「{product}」，有推薦的嗎", "「{product}」這款怎麼樣"]),
+    "aggregate": (10, ["目前最便宜的商品是哪幾款？", "比較一下最貴的五樣商品"]),
+    "order": (20, ["我的訂單出貨了嗎？", "幫我看一下最近的訂單", "我上次買的包裹到哪了"]),
+    "policy": (20, ["退貨要怎麼申請？", "保固期多久？", "運費怎麼計算？", "可以用哪些付款方式"]),
+    "buy": (10, ["我想買「{product}」", "幫我買兩個「{product}」"]),
+}
+
+TURN_PARTS = ["llm_ms", "sql_ms", "retrieval_ms", "memory_ms", "persist_ms", "overhead_ms"]
+
+
+class Corpus:
+    """依權重抽出問題；同一個 seed 產生同樣的問題序列"""
+
+    def __init__(self, db_path: str, store_id: int, seed: int, path: Optional[str] = None):
+        conn = sqlite3.connect(db_path)
+        try:
+            self.products = [r[0] for r in conn.execute(
+                "SELECT products.name FROM products JOIN product_items ON product_items.product_id = products.id "
+                "WHERE products.store_id = ? AND products.status = 'NORMAL' AND product_items.stock > 0 "
+                "GROUP BY products.id ORDER BY products.id LIMIT 500", (store_id,))] or ["商品"]
+            # 有訂單的使用者優先，訂單查詢才有結果
+            self.users = [str(r[0]) for r in conn.execute(
+                "SELECT users.id FROM users LEFT JOIN orders ON orders.user_id = users.id AND orders.store_id = ? "
+                "GROUP BY users.id ORDER BY COUNT(orders.id) DESC, users.id LIMIT 1000", (store_id,))]
+        finally:
+            conn.close()
+        self.random = random.Random(seed)
+        self.custom: Optional[List[str]] = None
+        if path:
+            with open(path, "r", encoding="utf-8") as f:
+                self.custom = [line.strip() for line in f if line.strip() and not line.startswith("#")]
+
+    def question(self) -> tuple:
+        if self.custom:
+            template = self.random.choice(self.custom)
+            kind = "custom"
+        else:
+            kinds = list(QUESTION_TEMPLATES)
+            kind = self.random.choices(kinds, weights=[QUESTION_TEMPLATES[k][0] for k in kinds])[0]
+            template = self.random.choice(QUESTION_TEMPLATES[kind][1])
+        return kind, template.format(product=self.random.choice(self.products))
+
+
+def _dist(values: List[float]) -> Dict[str, Optional[float]]:
+    values = sorted(values)
+
+    def rounded(v):
+        return round(v, 2) if v is not None else None
+    return {
+        "count": len(values),
+        "mean_ms": rounded(sum(values) / len(values)) if values else None,
+        "p50_ms": rounded(percentile(values, 50)),
+        "p95_ms": rounded(percentile(values, 95)),
+        "max_ms": rounded(values[-1]) if values else None,
+    }
+
+
+class AgentBench:
+    def __init__(self, corpus: Corpus, store_id: int, sessions: int, turns: int, concurrency: int,
+                 component_runs: int):
+        self.corpus = corpus
+        self.store_id = store_id
+        self.sessions = sessions
+        self.turns = turns
+        self.concurrency = concurrency
+        self.component_runs = component_runs
+        self.records: List[Dict[str, Any]] = []
+        self.build_ms: List[float] = []
+        self.agents: List[Any] = []
+        # 先把整份腳本抽好，併發數不同時每個 session 的問題仍然相同
+        self.scripts = [[corpus.question() for _ in range(turns)] for _ in range(sessions)]
+
+    def build_agent(self, user_id: str):
+        from .agent import AgentBuilder
+        started = time.perf_counter()
+        agent = AgentBuilder(self.store_id, user_id)
+        self.build_ms.append((time.perf_counter() - started) * 1000)
+        # 每次從空白記憶開始，避免前一次執行的對話影響記憶載入時間
+        agent.chat_store.delete_messages(user_id)
+        if hasattr(agent.memory, "clear_summary"):
+            agent.memory.clear_summary()
+        return agent
+
+    async def run_turn(self, agent, session: int, kind: str, question: str) -> None:
+        from .usage import current_turn
+
+        stats = None
+        tools: List[str] = []
+        first_delta_ms = None
+        error = None
+        started = time.perf_counter()
+        try:
+            async for event in agent.stream_chat(question):
+                # async generator 在呼叫端的 context 中執行，可以直接取得這一輪的 TurnStats
+                stats = stats or current_turn()
+                if event["type"] == "delta" and first_delta_ms is None:
+                    first_delta_ms = (time.perf_counter() - started) * 1000
+                elif event["type"] == "tool":
+                    tools.append(event["tool_name"])
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+        total_ms = (time.perf_counter() - started) * 1000
+
+        record = {"session": session, "kind": kind, "question": question, "total_ms": round(total_ms, 2),
+                  "first_delta_ms": round(first_delta_ms, 2) if first_delta_ms is not None else None,
+                  "tools": tools, "error": error}
+        if stats is not None:
+            record.update({
+                "routed": stats.routed, "llm_calls": stats.llm_calls, "iterations": stats.iterations,
+                "prompt_tokens": stats.prompt_tokens, "completion_tokens": stats.completion_tokens,
+                "llm_ms": stats.llm_ms, "sql_queries": stats.sql_queries, "sql_ms": stats.sql_ms,
+                "retrieval_ms": stats.retrieval_ms, "memory_ms": stats.memory_ms, "persist_ms": stats.persist_ms,
+                "tool_ms": dict(stats.tool_ms), "error": error or stats.error,
+            })
+            # SQL 工具內的 text-to-SQL 呼叫同時算在 llm_ms 與 tool_ms，這裡只扣 llm_ms，不再扣 tool_ms
+            accounted = sum(record[k] for k in TURN_PARTS[:-1])
+            record["overhead_ms"] = round(max(0.0, total_ms - accounted), 2)
+        self.records.append(record)
+
+    async def run_session(self, session: int, semaphore: asyncio.Semaphore) -> None:
+        async with semaphore:
+            user_id = self.corpus.users[session % len(self.corpus.users)] if self.corpus.users else "1"
+            agent = self.build_agent(user_id)
+            self.agents.append(agent)
+            for kind, question in self.scripts[session]:
+                await self.run_turn(agent, session, kind, question)
+
+    async def run_components(self) -> Dict[str, Dict[str, Optional[float]]]:
+        """單獨量測各環節，不經過 LLM"""
+        agent = self.agents[0]
+        timings: Dict[str, List[float]] = defaultdict(list)
+
+        async def timed(name: str, coro_fn) -> None:
+            for _ in range(self.component_runs):
+                started = time.perf_counter()
+                await coro_fn()
+                timings[name].append((time.perf_counter() - started) * 1000)
+
+        for _ in range(self.component_runs):
+            self.build_agent(f"bench-warm-{self.store_id}")
+        timings["agent_build_warm"] = self.build_ms[-self.component_runs:]
+        await timed("memory_load", agent.memory.aget)
+        await timed("tool_dispatch", lambda: agent.tools_by_name["request_more_info"].acall(missing_fields=["quantity"]))
+        product = self.corpus.products[0]
+        await timed("product_search_sql", lambda: agent.tools_by_name["product_search_tool"].acall(query=product))
+        retriever = getattr(agent.tools_by_name["policy_docs_tool"].query_engine, "retriever", None)
+        if retriever is not None:
+            await timed("docs_retrieval", lambda: retriever.aretrieve("退貨要怎麼申請？"))
+        return {name: _dist(values) for name, values in timings.items()}
+
+    async def run(self) -> Dict[str, Any]:
+        semaphore = asyncio.Semaphore(self.concurrency)
+        started = time.perf_counter()
+        await asyncio.gather(*(self.run_session(i, semaphore) for i in range(self.sessions)))
+        elapsed = time.perf_counter() - started
+        cold_build_ms = self.build_ms[0] if self.build_ms else None
+        components = await self.run_components()
+        # 等背景的記憶摘要寫完再結束
+        pending = [t for t in (getattr(a.memory, "_summary_task", None) for a in self.agents) if t is not None]
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+        components["agent_build_cold"] = _dist([cold_build_ms] if cold_build_ms is not None else [])
+        return {"elapsed_s": round(elapsed, 2), "components": components, "turns": self.summarize()}
+
+    def summarize(self) -> Dict[str, Dict[str, Any]]:
+        groups: Dict[str, List[Dict[str, Any]]] = defaultdict(list)
+        for rec in self.records:
+            groups[rec["kind"]].append(rec)
+        groups["total"] = list(self.records)
+        result = {}
+        for kind, recs in groups.items():
+            ok = [r for r in recs if not r["error"]]
+            summary = _dist([r["total_ms"] for r in ok])
+            summary.update({
+                "turns": len(recs),
+                "errors": len(recs) - len(ok),
+                "routed": sum(1 for r in recs if r.get("routed")),
+                "first_delta_p50_ms": _dist([r["first_delta_ms"] for r in ok if r["first_delta_ms"] is not None])["p50_ms"],
+                "llm_calls_per_turn": round(sum(r.get("llm_calls", 0) for r in ok) / len(ok), 2) if ok else None,
+                "breakdown_mean_ms": {part: round(sum(r.get(part, 0) for r in ok) / len(ok), 2) if ok else None
+                                      for part in TURN_PARTS},
+            })
+            tool_ms: Dict[str, List[float]] = defaultdict(list)
+            for r in ok:
+                for name, ms in (r.get("tool_ms") or {}).items():
+                    tool_ms[name].append(ms)
+            summary["tool_ms_p50"] = {name: _dist(values)["p50_ms"] for name, values in tool_ms.items()}
+            result[kind] = summary
+        return result
+
+
+def print_report(result: Dict[str, Any], baseline: Optional[Dict[str, Any]] = None) -> None:
+    header = f"{'kind':<10} {'turns':>6} {'err':>4} {'routed':>6} {'llm/t':>6} {'p50':>8} {'p95':>8} {'1st Δ':>8}"
+    header += "".join(f" {part[:-3]:>9}" for part in TURN_PARTS)
+    if baseline:
+        header += f" {'Δp95':>8}"
+    print(header)
+    old_turns = (baseline or {}).get("turns", {})
+    for kind, s in sorted(result["turns"].items(), key=lambda kv: (kv[0] == "total", kv[0])):
+        line = (f"{kind:<10} {s['turns']:>6} {s['errors']:>4} {s['routed']:>6} {_fmt(s['llm_calls_per_turn'])} "
+                f"{_fmt(s['p50_ms'], 8)} {_fmt(s['p95_ms'], 8)} {_fmt(s['first_delta_p50_ms'], 8)}")
+        line += "".join(f" {_fmt(s['breakdown_mean_ms'][part], 9)}" for part in TURN_PARTS)
+        if baseline:
+            line += f" {_delta(old_turns.get(kind, {}).get('p95_ms'), s['p95_ms'])}"
+        print(line)
+    print(f"\n{'component':<20} {'runs':>5} {'p50':>9} {'p95':>9}")
+    old_components = (baseline or {}).get("components", {})
+    for name, s in sorted(result["components"].items()):
+        line = f"{name:<20} {s['count']:>5} {_fmt(s['p50_ms'], 9)} {_fmt(s['p95_ms'], 9)}"
+        if baseline:
+            line += f" {_delta(old_components.get(name, {}).get('p95_ms'), s['p95_ms'])}"
+        print(line)
+
+
+def _fmt(value: Optional[float], width: int = 6) -> str:
+    return f"{value:>{width}.1f}" if value is not None else f"{'-':>{width}}"
+
+
+def _delta(old: Optional[float], new: Optional[float]) -> str:
+    if not old or new is None:
+        return f"{'-':>8}"
+    return f"{(new - old) / old * 100:>+7.1f}%"
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Per-turn overhead benchmark for the agent, using a local mock LLM")
+    parser.add_argument("--db", default=os.path.join("storage", "bench.db"), help="Benchmark database path")
+    parser.add_argument("--seed-scale", type=float, default=None, help="Generate the database at this scale if missing")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--store", type=int, default=1, help="Store id the agents serve")
+    parser.add_argument("--corpus", default=None, help="Question file, one per line ({product} is substituted)")
+    parser.add_argument("--sessions", type=int, default=20, help="Conversations to replay")
+    parser.add_argument("--turns", type=int, default=6, help="Questions per conversation")
+    parser.add_argument("--concurrency", type=int, default=4, help="Conversations running at once")
+    parser.add_argument("--component-runs", type=int, default=20, help="Repetitions for component timings")
+    parser.add_argument("--ttft-ms", type=float, default=300, help="Mock LLM delay before the first token")
+    parser.add_argument("--tokens-per-sec", type=float, default=80, help="Mock LLM streaming speed; 0 = no delay")
+    parser.add_argument("--embed-model", default="mock", help="'mock' for constant vectors, or a HuggingFace model name")
+    parser.add_argument("--workdir", default=os.path.join("storage", "agent_bench"), help="Docs index and usage log location")
+    parser.add_argument("--verbose", action="store_true", help="Show the agent's ReAct trace")
+    parser.add_argument("--output", default=None, help="JSON result path (default: storage/benchmarks/agent-<time>-<commit>.json)")
+    parser.add_argument("--compare", default=None, help="Previous JSON result to diff against")
+    args = parser.parse_args(argv)
+
+    # 之後會切換到 workdir，路徑先轉成絕對路徑
+    db_path = os.path.abspath(args.db)
+    workdir = os.path.abspath(args.workdir)
+    output = os.path.abspath(args.output) if args.output else None
+    compare = os.path.abspath(args.compare) if args.compare else None
+    commit = git_commit()
+    mock = start_mock_llm(ttft_ms=args.ttft_ms, tokens_per_sec=args.tokens_per_sec)
+    # llm_client / models / usage 在 import 時讀取這些設定，必須在 import agent 之前設好
+    os.environ.update({
+        "APP_DB_PATH": db_path,
+        "APP_LLM_API_BASE": mock.url,
+        "APP_LLM_MODEL": MOCK_MODEL,
+        "APP_LLM_API_KEY": "mock",
+        "APP_LLM_RATE": "0",
+        "APP_LLM_FALLBACK": "",
+        "APP_EMBED_MODEL": args.embed_model,
+        "APP_DOCS_DIR": os.path.abspath(os.environ.get("APP_DOCS_DIR", "docs")),
+        "APP_USAGE_LOG": os.path.join(workdir, "agent_turns.jsonl"),
+    })
+    prepare_database(db_path, args.seed_scale, args.seed)
+    corpus = Corpus(db_path, args.store, args.seed, path=args.corpus)
+    os.makedirs(os.path.join(workdir, "storage"), exist_ok=True)
+    os.chdir(workdir)
+
+    bench = AgentBench(corpus, args.store, sessions=args.sessions, turns=args.turns,
+                       concurrency=args.concurrency, component_runs=args.component_runs)
+    print(f"🤖 {args.sessions} sessions × {args.turns} turns, concurrency {args.concurrency}, "
+          f"mock LLM ttft {args.ttft_ms:g} ms / {args.tokens_per_sec:g} tokens/s")
+    with contextlib.ExitStack() as stack:
+        if not args.verbose:
+            # ReActAgent(verbose=True) 與 LlamaDebugHandler 會印出大量 trace
+            stack.enter_context(contextlib.redirect_stdout(stack.enter_context(open(os.devnull, "w"))))
+        result = asyncio.run(bench.run())
+    mock.shutdown()
+    result["mock_llm_calls"] = dict(mock.calls)
+    result["meta"] = {
+        "commit": commit, "time": datetime.now().isoformat(timespec="seconds"), "db": db_path,
+        "store": args.store, "sessions": args.sessions, "turns": args.turns, "concurrency": args.concurrency,
+        "ttft_ms": args.ttft_ms, "tokens_per_sec": args.tokens_per_sec, "embed_model": args.embed_model,
+    }
+    result["records"] = bench.records
+
+    baseline = None
+    if compare:
+        with open(compare, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        print(f"Comparing with {compare} (commit {baseline.get('meta', {}).get('commit')})")
+    print_report(result, baseline)
+    print(f"\nMock LLM calls: {result['mock_llm_calls']}")
+
+    output = output or os.path.join(
+        RESULTS_DIR, f"agent-{datetime.now().strftime('%Y%m%d-%H%M%S')}-{commit or 'nogit'}.json")
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    print(f"💾 Saved {output}")
+    if result["turns"].get("total", {}).get("errors"):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,178 @@
+import gc
+import os
+import sys
+import threading
+import time
+import types
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Iterable, Optional
+
+AGENT_CACHE_SIZE = int(os.environ.get("APP_AGENT_CACHE_SIZE", "200"))
+AGENT_CACHE_TTL = float(os.environ.get("APP_AGENT_CACHE_TTL", "1800"))  # 秒，閒置超過就淘汰
+SIZE_WALK_LIMIT = 200_000  # 估算記憶體時最多走訪的物件數
+
+_SKIP_TYPES = (type, types.ModuleType, types.FunctionType, types.BuiltinFunctionType, types.MethodType)
+
+
+def estimate_bytes(obj: Any, shared: Iterable[Any] = ()) -> int:
+    """沿著 gc referents 估算物件獨占的記憶體；shared 中的物件（共用的 LLM、embedding、engine）不計入"""
+    seen = {id(o) for o in shared}
+    stack = [obj]
+    total = 0
+    visited = 0
+    while stack and visited < SIZE_WALK_LIMIT:
+        o = stack.pop()
+        if id(o) in seen or isinstance(o, _SKIP_TYPES):
+            continue
+        seen.add(id(o))
+        visited += 1
+        total += sys.getsizeof(o, 0)
+        stack.extend(gc.get_referents(o))
+    return total
+
+
+class _Entry:
+    __slots__ = ("value", "last_used", "size")
+
+    def __init__(self, value: Any):
+        self.value = value
+        self.last_used = time.monotonic()
+        self.size: Optional[int] = None
+
+
+class AgentCache:
+    """有上限的 LRU + 閒置 TTL 快取。
+
+    agent 的對話記憶每則訊息寫入時就已存進 SQLite，淘汰時只需呼叫 on_evict 收尾；
+    下次同一使用者再來時重新建立 agent，記憶依 chat_store_key 延遲載入。
+    """
+
+    def __init__(self, factory: Callable[[Hashable], Any], max_size: int = AGENT_CACHE_SIZE,
+                 ttl: float = AGENT_CACHE_TTL, on_evict: Optional[Callable[[Any], None]] = None,
+                 shared: Optional[Callable[[], Iterable[Any]]] = None):
+        self.factory = factory
+        self.max_size = max_size
+        self.ttl = ttl
+        self.on_evict = on_evict
+        self.shared = shared
+        self._entries: "OrderedDict[Hashable, _Entry]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._building: Dict[Hashable, threading.Lock] = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key: Hashable) -> Any:
+        with self._lock:
+            self._expire()
+            entry = self._entries.get(key)
+            if entry is not None:
+                self.hits += 1
+                entry.last_used = time.monotonic()
+                self._entries.move_to_end(key)
+                return entry.value
+            build_lock = self._building.setdefault(key, threading.Lock())
+
+        # 建立 agent 很慢，不持有全域鎖；同一個 key 只建立一次
+        with build_lock:
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None:
+                    # 等待期間已由其他 thread 建好
+                    self.hits += 1
+                    entry.last_used = time.monotonic()
+                    return entry.value
+                self.misses += 1
+            value = self.factory(key)
+            with self._lock:
+                self._entries[key] = _Entry(value)
+                self._building.pop(key, None)
+                evicted = self._evict_overflow()
+        for old in evicted:
+            self._close(old)
+        return value
+
+    def __getitem__(self, key: Hashable) -> Any:
+        return self.get(key)
+
+    def __contains__(self, key: Hashable) -> bool:
+        with self._lock:
+            return key in self._entries
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._entries)
+
+    def pop(self, key: Hashable) -> None:
+        with self._lock:
+            entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._close(entry.value)
+
+    def clear(self) -> None:
+        with self._lock:
+            entries = list(self._entries.values())
+            self._entries.clear()
+        for entry in entries:
+            self._close(entry.value)
+
+    def _expire(self) -> None:
+        if not self.ttl:
+            return
+        deadline = time.monotonic() - self.ttl
+        expired = []
+        # OrderedDict 依最後使用時間排序，最舊的在前面
+        while self._entries:
+            key, entry = next(iter(self._entries.items()))
+            if entry.last_used >= deadline:
+                break
+            self._entries.popitem(last=False)
+            self.expirations += 1
+            expired.append(entry.value)
+        for value in expired:
+            threading.Thread(target=self._close, args=(value,), daemon=True).start()
+
+    def _evict_overflow(self) -> list:
+        evicted = []
+        while len(self._entries) > self.max_size:
+            _, entry = self._entries.popitem(last=False)
+            self.evictions += 1
+            evicted.append(entry.value)
+        return evicted
+
+    def _close(self, value: Any) -> None:
+        if self.on_evict is None:
+            return
+        try:
+            self.on_evict(value)
+        except Exception as e:
+            print(f"agent cache: on_evict failed: {e}")
+
+    def counters(self) -> Dict[str, Any]:
+        """只有計數器，不估算記憶體；給每次 /metrics 抓取使用"""
+        with self._lock:
+            self._expire()
+            hits, misses = self.hits, self.misses
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "ttl_seconds": self.ttl,
+                "hits": hits,
+                "misses": misses,
+                "hit_rate": round(hits / (hits + misses), 4) if hits + misses else None,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+
+    def stats(self) -> Dict[str, Any]:
+        """計數器加上估計的記憶體用量；估算會走訪物件圖，只在管理端點使用"""
+        stats = self.counters()
+        with self._lock:
+            entries = list(self._entries.values())
+        shared = list(self.shared()) if self.shared else []
+        for entry in entries:
+            if entry.size is None:
+                entry.size = estimate_bytes(entry.value, shared)
+        stats["estimated_bytes"] = sum(e.size for e in entries)
+        return stats
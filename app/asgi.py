@@ -0,0 +1,108 @@
+"""
+ASGI 入口：agent 相關路由直接跑在 event loop 上，其餘頁面沿用 Flask（WSGI）
+
+    uvicorn app.asgi:app --port 5000
+    python -m app.run --service web --asgi
+"""
+
+import json
+import os
+from datetime import datetime
+from typing import Any, Dict, Optional
+
+from a2wsgi import WSGIMiddleware
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Mount, Route
+
+from .db_executor import run_blocking
+from .tracing import span
+from .web_api import app as flask_app, get_web_agent, persist_user_message, persist_ai_message, sse_event
+
+# 掛載的 Flask 頁面使用的 WSGI thread 數
+WSGI_THREADS = int(os.environ.get("APP_WSGI_THREADS", "16"))
+
+
+def _in_app_context(fn, *args):
+    with flask_app.app_context():
+        return fn(*args)
+
+
+async def run_db(fn, *args):
+    """在 DB thread pool 中以 Flask app context 執行同步函式（建立 agent、寫入 ChatMessage）"""
+    return await run_blocking(_in_app_context, fn, *args)
+
+
+def flask_session(request: Request) -> Dict[str, Any]:
+    """讀取 Flask 簽章過的 session cookie，讓 ASGI 路由與 Flask 頁面共用登入狀態"""
+    cookie = request.cookies.get(flask_app.config.get("SESSION_COOKIE_NAME", "session"))
+    if not cookie:
+        return {}
+    serializer = flask_app.session_interface.get_signing_serializer(flask_app)
+    if serializer is None:
+        return {}
+    try:
+        max_age = int(flask_app.permanent_session_lifetime.total_seconds())
+        return serializer.loads(cookie, max_age=max_age)
+    except Exception:
+        return {}
+
+
+async def chat_stream(request: Request):
+    """與 Flask 版 /api/chat/stream 相同的 SSE 協定，但 agent 直接在 event loop 上執行"""
+    user = flask_session(request)
+    if "user_id" not in user or user.get("user_type") != "user":
+        return JSONResponse({"error": "權限不足"}, status_code=403)
+
+    try:
+        data = await request.json()
+    except json.JSONDecodeError:
+        data = {}
+    message = (data.get("message") or "").strip()
+    if not message:
+        return JSONResponse({"error": "訊息不能為空"}, status_code=400)
+
+    store_id = user.get("store_id", 1)
+    user_id = user["user_id"]
+    try:
+        chat_session_id = await run_db(persist_user_message, store_id, user_id, data.get("session_id"), message)
+        agent = await run_db(get_web_agent, store_id, user_id)
+    except Exception as e:
+        return JSONResponse({"error": str(e)}, status_code=500)
+
+    async def generate():
+        yield sse_event("session", {"session_id": chat_session_id})
+        final: Optional[str] = None
+        # 這個路由不經過 Flask，由這裡開 HTTP 的 root span
+        with span("POST /api/chat/stream", root=True, traceparent=request.headers.get("traceparent"),
+                  **{"service": "web", "http.method": "POST", "http.route": "/api/chat/stream"}):
+            try:
+                async for event in agent.stream_chat(message):
+                    if event["type"] == "delta":
+                        yield sse_event("delta", {"delta": event["delta"]})
+                    elif event["type"] == "tool":
+                        yield sse_event("tool", {"tool_name": event["tool_name"], "output": event["output"]})
+                    elif event["type"] == "done":
+                        final = event["response"]
+            except Exception as e:
+                yield sse_event("error", {"error": str(e)})
+                return
+
+            if final is None:
+                return
+            try:
+                await run_db(persist_ai_message, chat_session_id, final)
+            except Exception as e:
+                yield sse_event("error", {"error": f"訊息保存失敗：{str(e)}"})
+                return
+        yield sse_event("done", {"response": final, "session_id": chat_session_id, "timestamp": datetime.now().isoformat()})
+
+    return StreamingResponse(generate(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+app = Starlette(routes=[
+    Route("/api/chat/stream", chat_stream, methods=["POST"]),
+    Mount("/", app=WSGIMiddleware(flask_app, workers=WSGI_THREADS)),
+])
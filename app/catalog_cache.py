@@ -0,0 +1,134 @@
+import os
+import threading
+from collections import defaultdict
+from typing import Any, Callable, Dict, Hashable, List, Optional, Tuple
+
+from sqlalchemy import event, func, inspect, select
+from sqlalchemy.orm import Session
+
+from .models import Product, ProductItem, ProductStatus, get_default_engine
+
+# 商品目錄版本檔：任何 process 提交商品異動後 touch，讀取端只需 stat，不必查資料庫
+CATALOG_VERSION_PATH = os.environ.get("APP_CATALOG_VERSION_PATH", os.path.join(os.getcwd(), "storage", "catalog.version"))
+CAROUSEL_SIZE = 10  # LINE carousel 上限
+
+# 這些 ProductItem 欄位會影響商品卡片；只改庫存（下單）不需要重建
+_ITEM_FIELDS = ("name", "price", "status", "product_id")
+
+_local_version = 0
+_version_lock = threading.Lock()
+
+
+def bump_catalog_version() -> None:
+    global _local_version
+    with _version_lock:
+        _local_version += 1
+    try:
+        os.makedirs(os.path.dirname(CATALOG_VERSION_PATH), exist_ok=True)
+        with open(CATALOG_VERSION_PATH, "a"):
+            os.utime(CATALOG_VERSION_PATH, None)
+    except OSError as e:
+        print(f"catalog version: touch failed: {e}")
+
+
+def catalog_version() -> Tuple[int, int]:
+    try:
+        mtime = os.stat(CATALOG_VERSION_PATH).st_mtime_ns
+    except OSError:
+        mtime = 0
+    return _local_version, mtime
+
+
+def _affects_catalog(obj: Any) -> bool:
+    if isinstance(obj, Product):
+        return True
+    if isinstance(obj, ProductItem):
+        state = inspect(obj)
+        return any(state.attrs[name].history.has_changes() for name in _ITEM_FIELDS)
+    return False
+
+
+@event.listens_for(Session, "before_flush")
+def _track_catalog_changes(session, flush_context, instances):
+    if session.info.get("catalog_changed"):
+        return
+    if any(isinstance(o, (Product, ProductItem)) for o in session.new) \
+            or any(isinstance(o, (Product, ProductItem)) for o in session.deleted) \
+            or any(_affects_catalog(o) for o in session.dirty):
+        session.info["catalog_changed"] = True
+
+
+@event.listens_for(Session, "after_commit")
+def _bump_on_commit(session):
+    if session.info.pop("catalog_changed", False):
+        bump_catalog_version()
+
+
+@event.listens_for(Session, "after_rollback")
+def _reset_on_rollback(session):
+    session.info.pop("catalog_changed", None)
+
+
+def load_carousel_products(engine=None) -> Dict[Tuple[int, Optional[str]], List[Dict[str, Any]]]:
+    """一次查出所有上架、未刪除的商品，依 (store_id, 分類) 與 (store_id, None=全部) 分組"""
+    # 共用 process 的預設 engine；get_engine() 每次都會建新的 engine 並改綁 SessionLocal
+    engine = engine or get_default_engine()
+    query = (
+        select(Product.id, Product.store_id, Product.catalog, Product.name, Product.descriptions, Product.picture,
+               func.min(ProductItem.price).label("min_price"))
+        .join(ProductItem, ProductItem.product_id == Product.id)
+        .where(Product.status == ProductStatus.NORMAL, ProductItem.status == ProductStatus.NORMAL,
+               Product.deleted_at.is_(None), ProductItem.deleted_at.is_(None))
+        .group_by(Product.id)
+        .order_by(Product.store_id, Product.id.desc())
+    )
+    grouped: Dict[Tuple[int, Optional[str]], List[Dict[str, Any]]] = defaultdict(list)
+    with engine.connect() as conn:
+        for row in conn.execute(query):
+            product = dict(row._mapping)
+            for key in ((row.store_id, row.catalog), (row.store_id, None)):
+                if len(grouped[key]) < CAROUSEL_SIZE:
+                    grouped[key].append(product)
+    return dict(grouped)
+
+
+class CatalogCache:
+    """商品卡片資料與組好的訊息物件都放在記憶體，商品目錄版本改變時整批重建"""
+
+    def __init__(self, loader: Callable[[], Dict] = load_carousel_products):
+        self.loader = loader
+        self._lock = threading.Lock()
+        self._version: Optional[Tuple[int, int]] = None
+        self._products: Dict[Tuple[int, Optional[str]], List[Dict[str, Any]]] = {}
+        self._built: Dict[Hashable, Any] = {}
+        self.rebuilds = 0
+
+    def _refresh(self) -> None:
+        version = catalog_version()
+        if version == self._version:
+            return
+        self._products = self.loader()
+        self._built = {}
+        self._version = version
+        self.rebuilds += 1
+
+    def products(self, store_id: int, category: Optional[str] = None) -> List[Dict[str, Any]]:
+        with self._lock:
+            self._refresh()
+            return self._products.get((store_id, category), [])
+
+    def categories(self, store_id: int) -> List[str]:
+        with self._lock:
+            self._refresh()
+            return sorted(c for s, c in self._products if s == store_id and c is not None)
+
+    def get_built(self, key: Hashable, build: Callable[[List[Dict[str, Any]]], Any]) -> Any:
+        """key 為 (store_id, 分類)；build 以商品清單組出訊息物件，同一版本只組一次"""
+        with self._lock:
+            self._refresh()
+            if key not in self._built:
+                self._built[key] = build(self._products.get(key, []))
+            return self._built[key]
+
+
+catalog_cache = CatalogCache()
@@ -0,0 +1,198 @@
+import json
+import os
+import time
+from functools import lru_cache
+from typing import Any, List, Optional, Tuple
+
+from pydantic import PrivateAttr
+from sqlalchemy import delete, func, insert, select, text
+from llama_index.core.llms import ChatMessage
+from llama_index.core.storage.chat_store import BaseChatStore
+
+from .models import Base, ChatStoreMessage, ChatStoreSummary, ChatToolChoice, get_engine
+from .usage import record_memory_load, record_persist
+
+LEGACY_CHAT_STORE_PATH = os.path.join(os.getcwd(), "storage", "chat_store.json")
+CHAT_STORE_MAX_MESSAGES = int(os.environ.get("APP_CHAT_STORE_MAX_MESSAGES", "200"))
+TOOL_CHOICE_LIMIT = int(os.environ.get("APP_TOOL_CHOICE_LIMIT", "5000"))  # 訓練分類器時最多讀取幾筆
+
+_table = ChatStoreMessage.__table__
+_summary_table = ChatStoreSummary.__table__
+_tool_table = ChatToolChoice.__table__
+
+
+class SQLiteChatStore(BaseChatStore):
+    """以 chat_store_messages 表保存 agent 記憶：逐筆 append、依 key 讀取、在資料庫端修剪。
+
+    每次操作都是獨立的短交易，多個 worker process 可以共用同一個資料庫檔案。
+    """
+
+    max_messages: int = CHAT_STORE_MAX_MESSAGES
+    _engine: Any = PrivateAttr()
+
+    def __init__(self, engine=None, max_messages: int = CHAT_STORE_MAX_MESSAGES, **kwargs: Any):
+        super().__init__(max_messages=max_messages, **kwargs)
+        self._engine = engine or get_engine()
+        Base.metadata.create_all(self._engine, tables=[_table, _summary_table, _tool_table])
+        if self._engine.dialect.name == "sqlite":
+            # WAL 讓讀取不會被其他 process 的寫入擋住；設定會保存在資料庫檔案中
+            with self._engine.begin() as conn:
+                conn.execute(text("PRAGMA journal_mode=WAL"))
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "SQLiteChatStore"
+
+    @staticmethod
+    def _row(key: str, message: ChatMessage) -> dict:
+        return {"chat_store_key": key, "role": str(message.role.value), "payload": message.model_dump_json()}
+
+    def _trim(self, conn, key: str) -> None:
+        if not self.max_messages:
+            return
+        cutoff = conn.execute(
+            select(_table.c.id).where(_table.c.chat_store_key == key)
+            .order_by(_table.c.id.desc()).offset(self.max_messages).limit(1)
+        ).scalar()
+        if cutoff is not None:
+            conn.execute(delete(_table).where(_table.c.chat_store_key == key, _table.c.id <= cutoff))
+
+    def _ids(self, conn, key: str) -> List[int]:
+        return list(conn.execute(
+            select(_table.c.id).where(_table.c.chat_store_key == key).order_by(_table.c.id)
+        ).scalars())
+
+    def set_messages(self, key: str, messages: List[ChatMessage]) -> None:
+        started = time.perf_counter()
+        with self._engine.begin() as conn:
+            conn.execute(delete(_table).where(_table.c.chat_store_key == key))
+            if messages:
+                conn.execute(insert(_table), [self._row(key, m) for m in messages])
+            self._trim(conn, key)
+        record_persist((time.perf_counter() - started) * 1000)
+
+    def get_messages(self, key: str, limit: Optional[int] = None) -> List[ChatMessage]:
+        query = select(_table.c.payload).where(_table.c.chat_store_key == key).order_by(_table.c.id.desc())
+        if limit:
+            query = query.limit(limit)
+        started = time.perf_counter()
+        with self._engine.connect() as conn:
+            payloads = list(conn.execute(query).scalars())
+        messages = [ChatMessage.model_validate_json(p) for p in reversed(payloads)]
+        record_memory_load((time.perf_counter() - started) * 1000)
+        return messages
+
+    def add_message(self, key: str, message: ChatMessage, idx: Optional[int] = None) -> None:
+        started = time.perf_counter()
+        with self._engine.begin() as conn:
+            if idx is None:
+                conn.execute(insert(_table), [self._row(key, message)])
+            else:
+                # 插入到中間位置需要重排，較少用到，直接重寫該 key
+                messages = self.get_messages(key)
+                messages.insert(idx, message)
+                conn.execute(delete(_table).where(_table.c.chat_store_key == key))
+                conn.execute(insert(_table), [self._row(key, m) for m in messages])
+            self._trim(conn, key)
+        record_persist((time.perf_counter() - started) * 1000)
+
+    def delete_messages(self, key: str) -> Optional[List[ChatMessage]]:
+        messages = self.get_messages(key)
+        if not messages:
+            return None
+        with self._engine.begin() as conn:
+            conn.execute(delete(_table).where(_table.c.chat_store_key == key))
+        return messages
+
+    def delete_message(self, key: str, idx: int) -> Optional[ChatMessage]:
+        with self._engine.begin() as conn:
+            ids = self._ids(conn, key)
+            if idx < 0 or idx >= len(ids):
+                return None
+            payload = conn.execute(select(_table.c.payload).where(_table.c.id == ids[idx])).scalar()
+            conn.execute(delete(_table).where(_table.c.id == ids[idx]))
+        return ChatMessage.model_validate_json(payload)
+
+    def delete_last_message(self, key: str) -> Optional[ChatMessage]:
+        with self._engine.begin() as conn:
+            row = conn.execute(
+                select(_table.c.id, _table.c.payload).where(_table.c.chat_store_key == key)
+                .order_by(_table.c.id.desc()).limit(1)
+            ).first()
+            if row is None:
+                return None
+            conn.execute(delete(_table).where(_table.c.id == row.id))
+        return ChatMessage.model_validate_json(row.payload)
+
+    def delete_oldest(self, key: str, count: int) -> None:
+        """刪除最舊的 count 筆（摘要記憶摺疊舊對話時使用）"""
+        if count <= 0:
+            return
+        with self._engine.begin() as conn:
+            cutoff = conn.execute(
+                select(_table.c.id).where(_table.c.chat_store_key == key)
+                .order_by(_table.c.id).offset(count - 1).limit(1)
+            ).scalar()
+            if cutoff is not None:
+                conn.execute(delete(_table).where(_table.c.chat_store_key == key, _table.c.id <= cutoff))
+
+    @staticmethod
+    def _upsert_summary(conn, key: str, summary: str) -> None:
+        conn.execute(delete(_summary_table).where(_summary_table.c.chat_store_key == key))
+        conn.execute(insert(_summary_table), [{"chat_store_key": key, "summary": summary}])
+
+    def get_summary(self, key: str) -> Optional[str]:
+        with self._engine.connect() as conn:
+            return conn.execute(select(_summary_table.c.summary).where(_summary_table.c.chat_store_key == key)).scalar()
+
+    def set_summary(self, key: str, summary: str) -> None:
+        started = time.perf_counter()
+        with self._engine.begin() as conn:
+            self._upsert_summary(conn, key, summary)
+        record_persist((time.perf_counter() - started) * 1000)
+
+    def delete_summary(self, key: str) -> None:
+        with self._engine.begin() as conn:
+            conn.execute(delete(_summary_table).where(_summary_table.c.chat_store_key == key))
+
+    def add_tool_choice(self, key: str, user_message: str, tool_name: str) -> None:
+        """記錄這輪對話 agent 第一個呼叫的工具"""
+        with self._engine.begin() as conn:
+            conn.execute(insert(_tool_table), [{"chat_store_key": key, "user_message": user_message, "tool_name": tool_name}])
+
+    def get_tool_choices(self, limit: int = TOOL_CHOICE_LIMIT) -> List[Tuple[str, str]]:
+        """最近的 (使用者訊息, 工具名稱)，新的在前"""
+        query = select(_tool_table.c.user_message, _tool_table.c.tool_name).order_by(_tool_table.c.id.desc()).limit(limit)
+        with self._engine.connect() as conn:
+            return [tuple(row) for row in conn.execute(query)]
+
+    def get_keys(self) -> List[str]:
+        with self._engine.connect() as conn:
+            return list(conn.execute(select(_table.c.chat_store_key).distinct()).scalars())
+
+    def count_messages(self, key: str) -> int:
+        with self._engine.connect() as conn:
+            return conn.execute(select(func.count()).where(_table.c.chat_store_key == key)).scalar()
+
+    def import_json(self, path: str = LEGACY_CHAT_STORE_PATH) -> int:
+        """匯入舊的 SimpleChatStore JSON；已經存在於資料庫的 key 會略過"""
+        if not os.path.exists(path):
+            return 0
+        with open(path, "r", encoding="utf-8") as f:
+            store = json.load(f).get("store", {})
+        existing = set(self.get_keys())
+        imported = 0
+        for key, raw_messages in store.items():
+            if key in existing:
+                continue
+            self.set_messages(key, [ChatMessage.model_validate(m) for m in raw_messages])
+            imported += 1
+        return imported
+
+
+@lru_cache(maxsize=1)
+def get_chat_store() -> SQLiteChatStore:
+    """每個 process 共用一個 chat store；第一次建立時匯入舊的 chat_store.json"""
+    store = SQLiteChatStore()
+    store.import_json()
+    return store
@@ -0,0 +1,20 @@
+import asyncio
+import contextvars
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, partial
+
+# 同步的資料庫工作（SQLAlchemy session、NL→SQL 查詢引擎）在 event loop 之外執行的 thread 上限
+DB_THREADS = int(os.environ.get("APP_DB_THREADS", "8"))
+
+
+@lru_cache(maxsize=1)
+def get_db_executor() -> ThreadPoolExecutor:
+    return ThreadPoolExecutor(max_workers=DB_THREADS, thread_name_prefix="db")
+
+
+async def run_blocking(fn, *args, **kwargs):
+    """在有上限的 DB thread pool 執行同步函式；複製 contextvars，讓用量統計跟著這一輪對話"""
+    loop = asyncio.get_running_loop()
+    ctx = contextvars.copy_context()
+    return await loop.run_in_executor(get_db_executor(), partial(ctx.run, fn, *args, **kwargs))
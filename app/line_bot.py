@@ -1,52 +1,88 @@
-from flask import Flask, request, abort
+from flask import Flask, request, abort, jsonify
 from linebot import LineBotApi, WebhookHandler
-from linebot.exceptions import InvalidSignatureError
+from linebot.exceptions import InvalidSignatureError, LineBotApiError
 from linebot.models import (
-    MessageEvent, TextMessage, TextSendMessage, 
+    MessageEvent, PostbackEvent, TextMessage, TextSendMessage, 
     TemplateSendMessage, ButtonsTemplate, PostbackAction,
     CarouselTemplate, CarouselColumn, URIAction,
     FlexSendMessage, BubbleContainer, BoxComponent, TextComponent,
-    ButtonComponent, SeparatorComponent, SpacerComponent
+    ButtonComponent, SeparatorComponent
 )
+import asyncio
+import concurrent.futures
 import os
 import json
+import time
+from functools import lru_cache
 from typing import List, Dict, Any
 
-# Import the existing agent
-from .agent import build_user_agent
+# agent（LlamaIndex、HuggingFace）等第一則文字訊息才載入，webhook 啟動時不需要
+from .agent_cache import AgentCache
+from .catalog_cache import catalog_cache
+from .line_worker import EventDeduplicator, LineEventDispatcher
+from .metrics import REGISTRY, instrument_flask, metrics_response, watch_cache
+from .query_stats import instrument_queries
+from .tracing import instrument_tracing
 from .models import get_engine, init_db
 
 # LINE Bot configuration
 LINE_CHANNEL_ACCESS_TOKEN = os.environ.get('LINE_CHANNEL_ACCESS_TOKEN', '')
 LINE_CHANNEL_SECRET = os.environ.get('LINE_CHANNEL_SECRET', '')
+# LINE 官方帳號對應的商店
+LINE_STORE_ID = int(os.environ.get('LINE_STORE_ID', '1'))
+
+# reply token 約一分鐘內有效，超過就改用 push
+REPLY_TOKEN_TTL = float(os.environ.get('LINE_REPLY_TOKEN_TTL', '50'))
+AGENT_TURN_TIMEOUT = float(os.environ.get('LINE_AGENT_TIMEOUT', '120'))
+
+# 快速回覆的分類代碼 -> 商品分類；ALL_CATEGORIES 代表全部，查不到的代碼（None）改回文字說明
+ALL_CATEGORIES = object()
+CATEGORY_CODES = {'electronics': '電子產品', 'home': '居家', 'all': ALL_CATEGORIES}
+
+@lru_cache(maxsize=1)
+def get_line_bot_api() -> LineBotApi:
+    return LineBotApi(LINE_CHANNEL_ACCESS_TOKEN)
 
-line_bot_api = LineBotApi(LINE_CHANNEL_ACCESS_TOKEN)
 handler = WebhookHandler(LINE_CHANNEL_SECRET)
 
-# Initialize database
-init_db()
+def build_line_agent(user_id: str):
+    from .agent import build_user_agent
+    return build_user_agent(user_id, LINE_STORE_ID)
+
+def line_shared_agent_objects() -> list:
+    from .agent import shared_agent_objects
+    return shared_agent_objects()
 
 class LineBotService:
     def __init__(self):
-        self.user_agents = {}  # Cache for user agents
+        # 有上限的 LRU/TTL 快取；淘汰的使用者下次來時重新建立 agent，記憶從資料庫載入
+        self.user_agents = AgentCache(build_line_agent, on_evict=lambda agent: agent.close(), shared=line_shared_agent_objects)
+        # 固定內容的訊息只組一次
+        self.welcome_message = self.create_welcome_message()
+        self.quick_replies = self.create_quick_replies()
     
     def get_user_agent(self, user_id: str):
         """Get or create user agent for LINE user"""
-        if user_id not in self.user_agents:
-            self.user_agents[user_id] = build_user_agent(user_id)
-        return self.user_agents[user_id]
+        return self.user_agents.get(user_id)
     
     def handle_text_message(self, event: MessageEvent) -> TextSendMessage:
         """Handle text messages using LlamaIndex agent"""
         user_id = event.source.user_id
-        user_input = event.text
+        user_input = event.message.text
         
         try:
+            from .agent import get_agent_loop
             # Get user agent
             agent = self.get_user_agent(user_id)
             
-            # Process with agent
-            response = agent.chat(user_input)
+            # Process with agent（在共用的背景 event loop 上執行，這個 worker thread 等待結果）
+            future = asyncio.run_coroutine_threadsafe(agent.chat(user_input), get_agent_loop())
+            try:
+                response = future.result(timeout=AGENT_TURN_TIMEOUT)
+            except concurrent.futures.TimeoutError:
+                # 不再等待的回合要取消，否則仍在 agent loop 上執行、佔用 LLM 與 DB
+                future.cancel()
+                return TextSendMessage(text="抱歉，這個問題處理太久了，請稍後再試一次。")
             
             # Format response
             response_text = str(response)
@@ -70,14 +106,14 @@ class LineBotService:
                         size="lg",
                         color="#1DB446"
                     ),
-                    SpacerComponent(size="sm"),
                     TextComponent(
+                        margin="sm",
                         text="我可以幫助您：",
                         size="sm",
                         color="#666666"
                     ),
-                    SpacerComponent(size="sm"),
                     TextComponent(
+                        margin="sm",
                         text="• 查詢商品資訊\n• 查看訂單狀態\n• 了解購買流程\n• 售後服務諮詢\n• 下單購買商品",
                         size="sm",
                         color="#666666"
@@ -95,8 +131,8 @@ class LineBotService:
                             data="action=view_products"
                         )
                     ),
-                    SpacerComponent(size="sm"),
                     ButtonComponent(
+                        margin="sm",
                         style="secondary",
                         color="#666666",
                         action=PostbackAction(
@@ -104,8 +140,8 @@ class LineBotService:
                             data="action=purchase_guide"
                         )
                     ),
-                    SpacerComponent(size="sm"),
                     ButtonComponent(
+                        margin="sm",
                         style="secondary",
                         color="#666666",
                         action=PostbackAction(
@@ -124,9 +160,12 @@ class LineBotService:
         columns = []
         
         for product in products[:10]:  # LINE carousel limit is 10
+            description = product.get('descriptions') or "無描述"
+            if product.get('min_price') is not None:
+                description = f"NT${product['min_price']} 起｜{description}"
             column = CarouselColumn(
                 title=product['name'][:40],  # LINE title limit
-                text=product['outline'][:120] if product['outline'] else "無描述",  # LINE text limit
+                text=description[:60],  # LINE text limit（無圖片時 120，有標題時 60）
                 actions=[
                     PostbackAction(
                         label="查看詳情",
@@ -142,6 +181,14 @@ class LineBotService:
         
         return CarouselTemplate(columns=columns)
     
+    def product_carousel_message(self, category: str = None):
+        """商品輪播訊息：依商品目錄版本快取，postback 不需查資料庫；沒有商品時回傳 None"""
+        def build(products):
+            if not products:
+                return None
+            return TemplateSendMessage(alt_text="商品列表", template=self.create_product_carousel(products))
+        return catalog_cache.get_built((LINE_STORE_ID, category), build)
+    
     def create_quick_replies(self) -> List[TextSendMessage]:
         """Create quick reply options"""
         quick_replies = [
@@ -150,7 +197,6 @@ class LineBotService:
                 quick_reply={
                     "items": [
                         {"type": "action", "action": {"type": "postback", "label": "電子產品", "data": "category=electronics"}},
-                        {"type": "action", "action": {"type": "postback", "label": "服飾", "data": "category=clothing"}},
                         {"type": "action", "action": {"type": "postback", "label": "家居用品", "data": "category=home"}},
                         {"type": "action", "action": {"type": "postback", "label": "所有商品", "data": "category=all"}}
                     ]
@@ -182,6 +228,39 @@ class LineBotService:
 
 # Create service instance
 line_service = LineBotService()
+watch_cache("agent_line", line_service.user_agents.counters)
+
+def send_reply(event, messages) -> None:
+    """優先用 reply token 回覆；token 過期或失效時改用 push message"""
+    age = time.time() - event.timestamp / 1000 if getattr(event, 'timestamp', None) else 0
+    if age < REPLY_TOKEN_TTL:
+        try:
+            get_line_bot_api().reply_message(event.reply_token, messages)
+            return
+        except LineBotApiError as e:
+            if e.status_code != 400:
+                raise
+    user_id = getattr(event.source, 'user_id', None)
+    if user_id:
+        get_line_bot_api().push_message(user_id, messages)
+
+def dispatch_event(event) -> None:
+    """worker thread 中處理單一 webhook 事件"""
+    if isinstance(event, MessageEvent) and isinstance(event.message, TextMessage):
+        handle_message(event)
+    elif isinstance(event, PostbackEvent):
+        handle_postback(event)
+
+# 在 create_line_app 中建立（需要資料庫）
+dispatcher = None
+
+LINE_PENDING_EVENTS = REGISTRY.gauge("line_pending_events", "LINE webhook events waiting for a worker")
+
+def _collect_line_dispatcher():
+    if dispatcher is not None:
+        LINE_PENDING_EVENTS.set(dispatcher.pending())
+
+REGISTRY.register_collector(_collect_line_dispatcher)
 
 # Webhook handler
 @handler.add(MessageEvent, message=TextMessage)
@@ -190,21 +269,19 @@ def handle_message(event):
     
     # Handle specific commands
     if event.message.text.lower() in ['hi', 'hello', '你好', '您好']:
-        welcome_msg = line_service.create_welcome_message()
-        line_bot_api.reply_message(event.reply_token, welcome_msg)
+        send_reply(event, line_service.welcome_message)
         return
     
     if event.message.text.lower() in ['help', '幫助', '說明']:
-        quick_replies = line_service.create_quick_replies()
-        for msg in quick_replies:
-            line_bot_api.reply_message(event.reply_token, msg)
+        # 同一個 reply token 只能用一次，多則訊息一起送出
+        send_reply(event, line_service.quick_replies)
         return
     
     # Process with LlamaIndex agent
     response = line_service.handle_text_message(event)
-    line_bot_api.reply_message(event.reply_token, response)
+    send_reply(event, response)
 
-@handler.add(MessageEvent, message=TextMessage)
+@handler.add(PostbackEvent)
 def handle_postback(event):
     """Handle postback events"""
     try:
@@ -214,26 +291,11 @@ def handle_postback(event):
             action = data.split("=")[1]
             
             if action == "view_products":
-                # Get products from database
-                from .models import SessionLocal
-                with SessionLocal() as session:
-                    from .models import Product, ProductStatus
-                    products = session.query(Product).filter_by(status=ProductStatus.NORMAL).limit(10).all()
-                    
-                    product_data = []
-                    for p in products:
-                        product_data.append({
-                            'id': p.id,
-                            'name': p.name,
-                            'outline': p.outline or "無描述"
-                        })
-                
-                if product_data:
-                    carousel = line_service.create_product_carousel(product_data)
-                    template_msg = TemplateSendMessage(alt_text="商品列表", template=carousel)
-                    line_bot_api.reply_message(event.reply_token, template_msg)
+                template_msg = line_service.product_carousel_message()
+                if template_msg is not None:
+                    send_reply(event, template_msg)
                 else:
-                    line_bot_api.reply_message(event.reply_token, TextSendMessage(text="目前沒有可用的商品"))
+                    send_reply(event, TextSendMessage(text="目前沒有可用的商品"))
             
             elif action == "purchase_guide":
                 guide_text = """📋 購買流程說明：
@@ -246,7 +308,7 @@ def handle_postback(event):
 6️⃣ 等待發貨：我們會在24小時內發貨
 
 有任何問題都可以詢問我！"""
-                line_bot_api.reply_message(event.reply_token, TextSendMessage(text=guide_text))
+                send_reply(event, TextSendMessage(text=guide_text))
             
             elif action == "after_sales":
                 service_text = """🔧 售後服務說明：
@@ -261,13 +323,19 @@ def handle_postback(event):
 • 免費維修服務
 
 需要協助請隨時聯繫我們！"""
-                line_bot_api.reply_message(event.reply_token, TextSendMessage(text=service_text))
+                send_reply(event, TextSendMessage(text=service_text))
         
         elif data.startswith("category="):
             category = data.split("=")[1]
-            # Handle category selection
+            # Handle category selection：有對應分類的商品就直接送出快取的輪播
+            catalog = CATEGORY_CODES.get(category)
+            if catalog is not None:
+                template_msg = line_service.product_carousel_message(None if catalog is ALL_CATEGORIES else catalog)
+                if template_msg is not None:
+                    send_reply(event, template_msg)
+                    return
             category_text = f"您選擇了 {category} 類別的商品。請告訴我您想了解哪個商品，或直接詢問具體問題！"
-            line_bot_api.reply_message(event.reply_token, TextSendMessage(text=category_text))
+            send_reply(event, TextSendMessage(text=category_text))
         
         elif data.startswith("guide="):
             guide_type = data.split("=")[1]
@@ -279,7 +347,7 @@ def handle_postback(event):
             elif guide_type == "delivery":
                 guide_text = "配送服務：標準配送3-5天，快速配送1-2天。滿500元免運費！"
             
-            line_bot_api.reply_message(event.reply_token, TextSendMessage(text=guide_text))
+            send_reply(event, TextSendMessage(text=guide_text))
         
         elif data.startswith("service="):
             service_type = data.split("=")[1]
@@ -291,14 +359,23 @@ def handle_postback(event):
             elif service_type == "contact":
                 service_text = "客服聯絡：電話0800-123-456，信箱service@example.com，LINE@example_service"
             
-            line_bot_api.reply_message(event.reply_token, TextSendMessage(text=service_text))
+            send_reply(event, TextSendMessage(text=service_text))
     
     except Exception as e:
-        line_bot_api.reply_message(event.reply_token, TextSendMessage(text=f"處理您的請求時發生錯誤：{str(e)}"))
+        send_reply(event, TextSendMessage(text=f"處理您的請求時發生錯誤：{str(e)}"))
 
 def create_line_app():
     """Create Flask app for LINE Bot webhook"""
+    global dispatcher
     app = Flask(__name__)
+    instrument_flask(app, "line")
+    instrument_tracing(app, "line")
+    instrument_queries(app)
+    init_db()
+    if dispatcher is None:
+        dispatcher = LineEventDispatcher(dispatch_event, dedup=EventDeduplicator())
+    # 啟動時先組好商品卡片資料
+    catalog_cache.products(LINE_STORE_ID)
     
     @app.route("/callback", methods=['POST'])
     def callback():
@@ -309,18 +386,34 @@ def create_line_app():
         body = request.get_data(as_text=True)
         app.logger.info("Request body: " + body)
         
-        # Handle webhook body
+        # 只驗證簽章並排入背景佇列，立即回 200，避免 agent 太慢造成 LINE 逾時重送；
+        # 同一批的多個事件分散給 worker pool，同一使用者依序處理，重送的事件依 webhookEventId 略過
         try:
-            handler.handle(body, signature)
+            events = handler.parser.parse(body, signature)
         except InvalidSignatureError:
             abort(400)
         
+        for event in events:
+            dispatcher.submit(event)
+        
         return 'OK'
     
     @app.route("/health")
     def health():
         return "LINE Bot is running!"
     
+    @app.route("/metrics")
+    def metrics():
+        return metrics_response()
+    
+    @app.route("/stats")
+    def stats():
+        return jsonify({
+            'agent_cache': line_service.user_agents.stats(),
+            'pending_events': dispatcher.pending(),
+            'duplicate_events': dispatcher.dedup.duplicates,
+        })
+    
     return app
 
 if __name__ == "__main__":
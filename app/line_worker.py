@@ -0,0 +1,119 @@
+import os
+import threading
+import time
+import traceback
+from collections import OrderedDict, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Callable, Deque, Dict, Optional
+
+from sqlalchemy import delete, insert
+
+from .models import Base, LineWebhookEvent, get_engine
+from .tracing import capture, span
+
+# LINE webhook 事件的背景處理：不同使用者並行，同一使用者依收到順序逐筆處理
+LINE_WORKERS = int(os.environ.get("APP_LINE_WORKERS", "8"))
+# webhookEventId 保留多久（LINE 重送通常在數分鐘內）
+DEDUP_TTL = float(os.environ.get("APP_LINE_DEDUP_TTL", "3600"))
+DEDUP_MEMORY_SIZE = 10000
+
+_events_table = LineWebhookEvent.__table__
+
+
+class EventDeduplicator:
+    """以 webhookEventId 去除重複事件：先查 process 內的 LRU，再用資料庫主鍵跨 process 確認"""
+
+    def __init__(self, engine=None, ttl: float = DEDUP_TTL, persist: bool = True):
+        self.ttl = ttl
+        self._recent: "OrderedDict[str, None]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._engine = None
+        self._inserts = 0
+        if persist:
+            self._engine = engine or get_engine()
+            Base.metadata.create_all(self._engine, tables=[_events_table])
+        self.duplicates = 0
+
+    def seen(self, event_id: Optional[str]) -> bool:
+        """第一次看到回傳 False 並記錄；重複的回傳 True"""
+        if not event_id:
+            return False
+        with self._lock:
+            if event_id in self._recent:
+                self.duplicates += 1
+                return True
+            self._recent[event_id] = None
+            while len(self._recent) > DEDUP_MEMORY_SIZE:
+                self._recent.popitem(last=False)
+        if self._engine is not None and not self._claim(event_id):
+            with self._lock:
+                self.duplicates += 1
+            return True
+        return False
+
+    def _claim(self, event_id: str) -> bool:
+        with self._engine.begin() as conn:
+            result = conn.execute(insert(_events_table).prefix_with("OR IGNORE"), [{"webhook_event_id": event_id}])
+            self._inserts += 1
+            if self._inserts % 500 == 0:
+                cutoff = datetime.utcnow() - timedelta(seconds=self.ttl)
+                conn.execute(delete(_events_table).where(_events_table.c.received_at < cutoff))
+        return result.rowcount == 1
+
+
+class LineEventDispatcher:
+    """webhook 驗證簽章後把事件丟進來就回 200；worker pool 在背景跑 agent 並回覆"""
+
+    def __init__(self, handle: Callable, workers: int = LINE_WORKERS, dedup: Optional[EventDeduplicator] = None):
+        self._handle = handle
+        self.dedup = dedup
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="line")
+        self._lock = threading.Lock()
+        self._queues: Dict[str, Deque] = defaultdict(deque)
+        self._active = set()
+
+    @staticmethod
+    def sequence_key(event) -> str:
+        source = getattr(event, "source", None)
+        return (getattr(source, "user_id", None) or getattr(source, "group_id", None)
+                or getattr(source, "room_id", None) or "")
+
+    def submit(self, event) -> bool:
+        """排入事件；重送的重複事件直接略過並回傳 False"""
+        if self.dedup is not None and self.dedup.seen(getattr(event, "webhook_event_id", None)):
+            return False
+        key = self.sequence_key(event)
+        # worker thread 不會帶著 webhook 請求的 context，把目前的 trace 一起排入
+        with self._lock:
+            self._queues[key].append((event, capture(), time.perf_counter()))
+            if key in self._active:
+                # 這位使用者已有 worker 在處理，會接著處理這筆
+                return True
+            self._active.add(key)
+        self._executor.submit(self._drain, key)
+        return True
+
+    def _drain(self, key: str) -> None:
+        while True:
+            with self._lock:
+                queue = self._queues.get(key)
+                if not queue:
+                    self._queues.pop(key, None)
+                    self._active.discard(key)
+                    return
+                event, parent, queued_at = queue.popleft()
+            try:
+                with span("line.event", root=True, parent=parent, **{
+                        "line.event_type": getattr(event, "type", None),
+                        "line.queued_ms": round((time.perf_counter() - queued_at) * 1000, 1)}):
+                    self._handle(event)
+            except Exception:
+                traceback.print_exc()
+
+    def pending(self) -> int:
+        with self._lock:
+            return sum(len(q) for q in self._queues.values())
+
+    def shutdown(self, wait: bool = True) -> None:
+        self._executor.shutdown(wait=wait)
@@ -0,0 +1,459 @@
+import asyncio
+import logging
+import os
+import random
+import threading
+import time
+import weakref
+from collections import Counter, deque
+from contextlib import asynccontextmanager, contextmanager
+from functools import lru_cache
+from typing import Any, Dict, Optional
+
+import httpx
+from pydantic import PrivateAttr
+from llama_index.llms.ollama import Ollama
+from llama_index.llms.openai_like import OpenAILike
+
+# 設定（可由環境變數覆寫）
+LLM_MODEL = os.environ.get("APP_LLM_MODEL", "gemini-2.5-flash")
+LLM_API_BASE = os.environ.get("APP_LLM_API_BASE", "https://gemini.kzm.pw/openai/v1")
+LLM_API_KEY = os.environ.get("APP_LLM_API_KEY", "sk-G@ry1203")
+LLM_TIMEOUT = float(os.environ.get("APP_LLM_TIMEOUT", "60"))
+
+LLM_MAX_CONCURRENCY = int(os.environ.get("APP_LLM_MAX_CONCURRENCY", "8"))   # 同時送往上游的請求數
+LLM_RATE_PER_SEC = float(os.environ.get("APP_LLM_RATE", "5"))              # token bucket 補充速度
+LLM_BURST = int(os.environ.get("APP_LLM_BURST", "10"))                     # token bucket 容量
+LLM_MAX_RETRIES = int(os.environ.get("APP_LLM_MAX_RETRIES", "4"))
+LLM_RETRY_BASE = float(os.environ.get("APP_LLM_RETRY_BASE", "0.5"))
+LLM_RETRY_CAP = float(os.environ.get("APP_LLM_RETRY_CAP", "8"))
+LLM_POOL_SIZE = int(os.environ.get("APP_LLM_POOL_SIZE", "20"))
+
+# 備援後端：設定 APP_LLM_FALLBACK=ollama 啟用；APP_LLM_HEDGE_DELAY > 0 時，主後端超過此秒數未回應就同時送往備援
+LLM_FALLBACK = os.environ.get("APP_LLM_FALLBACK", "")
+LLM_HEDGE_DELAY = float(os.environ.get("APP_LLM_HEDGE_DELAY", "0"))
+OLLAMA_MODEL = os.environ.get("OLLAMA_MODEL", "qwen3:8b")
+OLLAMA_BASE_URL = os.environ.get("OLLAMA_BASE_URL", "http://localhost:11434")
+
+RETRYABLE_STATUS = {408, 409, 429, 500, 502, 503, 504}
+RETRYABLE_ERRORS = {"APITimeoutError", "APIConnectionError", "RateLimitError", "InternalServerError"}
+
+logger = logging.getLogger("app.llm_client")
+
+LLM_CLIENT_METRICS: Counter = Counter()
+_metrics_lock = threading.Lock()
+
+
+def record_metric(name: str, value: int = 1) -> None:
+    with _metrics_lock:
+        LLM_CLIENT_METRICS[name] += value
+
+
+def get_llm_metrics() -> Dict[str, int]:
+    with _metrics_lock:
+        return dict(LLM_CLIENT_METRICS)
+
+
+# =========================
+# 連線池
+# =========================
+
+def _limits() -> httpx.Limits:
+    return httpx.Limits(max_connections=LLM_POOL_SIZE, max_keepalive_connections=LLM_POOL_SIZE, keepalive_expiry=30)
+
+
+class _SharedClient(httpx.Client):
+    """openai SDK 在 reuse_client=False 時會用 with 關閉傳入的 http_client；共用連線池不能被單次呼叫關掉"""
+
+    def close(self) -> None:
+        pass
+
+
+class _SharedAsyncClient(httpx.AsyncClient):
+    async def aclose(self) -> None:
+        pass
+
+
+@lru_cache(maxsize=1)
+def get_http_client() -> httpx.Client:
+    """同步呼叫共用的 keep-alive 連線池（thread-safe）"""
+    return _SharedClient(limits=_limits(), timeout=LLM_TIMEOUT)
+
+
+_async_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, httpx.AsyncClient]" = weakref.WeakKeyDictionary()
+
+
+def get_async_http_client() -> httpx.AsyncClient:
+    """非同步連線池綁定 event loop，每個 loop（例如 LINE worker thread）各自一個"""
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        client = _SharedAsyncClient(limits=_limits(), timeout=LLM_TIMEOUT)
+        _async_clients[loop] = client
+    return client
+
+
+# =========================
+# 流量控制
+# =========================
+
+class TokenBucket:
+    """跨 thread 與 event loop 共用的 token bucket；reserve() 先預約，回傳需要等待的秒數"""
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self) -> float:
+        if self.rate <= 0:
+            return 0.0
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            return 0.0 if self._tokens >= 0 else -self._tokens / self.rate
+
+
+class FairSemaphore:
+    """跨 thread 與 event loop 共用、先到先服務的 semaphore。
+    釋放時直接把名額交給佇列最前面的等待者（thread 等 Event，coroutine 等自己 loop 上的 future），不需要輪詢"""
+
+    def __init__(self, value: int):
+        self._value = value
+        self._lock = threading.Lock()
+        self._waiters: deque = deque()
+
+    def acquire(self) -> None:
+        with self._lock:
+            if self._value > 0 and not self._waiters:
+                self._value -= 1
+                return
+            event = threading.Event()
+            self._waiters.append(event)
+        event.wait()
+
+    async def aacquire(self) -> None:
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if self._value > 0 and not self._waiters:
+                self._value -= 1
+                return
+            waiter = (loop, loop.create_future())
+            self._waiters.append(waiter)
+        try:
+            await waiter[1]
+        except asyncio.CancelledError:
+            with self._lock:
+                try:
+                    self._waiters.remove(waiter)
+                    owned = False
+                except ValueError:
+                    # 已經輪到：名額已交付就歸還；交付還在路上的話由 _hand_over 轉交下一位
+                    owned = waiter[1].done() and not waiter[1].cancelled()
+            if owned:
+                self.release()
+            raise
+
+    def release(self) -> None:
+        with self._lock:
+            while self._waiters:
+                waiter = self._waiters.popleft()
+                if isinstance(waiter, threading.Event):
+                    waiter.set()
+                    return
+                loop, future = waiter
+                try:
+                    loop.call_soon_threadsafe(self._hand_over, future)
+                    return
+                except RuntimeError:
+                    continue  # 等待者的 loop 已關閉
+            self._value += 1
+
+    def _hand_over(self, future: "asyncio.Future") -> None:
+        if future.done():
+            self.release()  # 等待者已取消，名額往下傳
+        else:
+            future.set_result(None)
+
+
+class LLMGate:
+    """全域併發上限 + 速率限制；同一個 gate 可同時給多個 thread 與 event loop 使用"""
+
+    def __init__(self, max_concurrency: int = LLM_MAX_CONCURRENCY, rate: float = LLM_RATE_PER_SEC, burst: int = LLM_BURST):
+        self._semaphore = FairSemaphore(max_concurrency)
+        self.bucket = TokenBucket(rate, burst)
+
+    @contextmanager
+    def slot(self):
+        started = time.monotonic()
+        self._semaphore.acquire()
+        try:
+            wait = self.bucket.reserve()
+            if wait:
+                time.sleep(wait)
+            record_metric("throttled_ms", int((time.monotonic() - started) * 1000))
+            yield
+        finally:
+            self._semaphore.release()
+
+    @asynccontextmanager
+    async def aslot(self):
+        started = time.monotonic()
+        await self._semaphore.aacquire()
+        try:
+            wait = self.bucket.reserve()
+            if wait:
+                await asyncio.sleep(wait)
+            record_metric("throttled_ms", int((time.monotonic() - started) * 1000))
+            yield
+        finally:
+            self._semaphore.release()
+
+
+@lru_cache(maxsize=1)
+def get_llm_gate() -> LLMGate:
+    return LLMGate()
+
+
+# =========================
+# 重試
+# =========================
+
+def is_retryable(exc: BaseException) -> bool:
+    if isinstance(exc, (httpx.TimeoutException, httpx.TransportError)):
+        return True
+    if type(exc).__name__ in RETRYABLE_ERRORS:
+        return True
+    status = getattr(exc, "status_code", None) or getattr(getattr(exc, "response", None), "status_code", None)
+    return status in RETRYABLE_STATUS
+
+
+def retry_delay(attempt: int, exc: Optional[BaseException] = None) -> float:
+    """full-jitter 指數退避；上游有給 Retry-After 時以它為下限"""
+    delay = random.uniform(0, min(LLM_RETRY_CAP, LLM_RETRY_BASE * (2 ** attempt)))
+    response = getattr(exc, "response", None)
+    retry_after = getattr(response, "headers", {}).get("retry-after") if response is not None else None
+    try:
+        return max(delay, min(LLM_RETRY_CAP, float(retry_after))) if retry_after else delay
+    except ValueError:
+        return delay
+
+
+# =========================
+# LLM
+# =========================
+
+class PooledOpenAILike(OpenAILike):
+    """OpenAILike 加上共用連線池、全域流量控制、重試與備援後端。
+
+    重試只發生在收到第一個 token 之前；串流開始後的錯誤直接往上拋。
+    備援後端只用於非串流呼叫（主後端失敗，或設定 hedge delay 時的競速）。
+    """
+
+    _gate: Any = PrivateAttr(default=None)
+    _fallback: Any = PrivateAttr(default=None)
+    _hedge_delay: float = PrivateAttr(default=0.0)
+    _retries: int = PrivateAttr(default=LLM_MAX_RETRIES)
+
+    def __init__(self, gate: Optional[LLMGate] = None, fallback=None, hedge_delay: float = LLM_HEDGE_DELAY,
+                 retries: int = LLM_MAX_RETRIES, **kwargs: Any):
+        # 重試由 gate 統一處理，避免 openai SDK 在 semaphore 內自行重試
+        kwargs.setdefault("max_retries", 0)
+        kwargs.setdefault("timeout", LLM_TIMEOUT)
+        kwargs.setdefault("reuse_client", False)
+        super().__init__(**kwargs)
+        self._gate = gate or get_llm_gate()
+        self._fallback = fallback
+        self._hedge_delay = hedge_delay
+        self._retries = retries
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "PooledOpenAILike"
+
+    def _get_credential_kwargs(self, is_async: bool = False, **kwargs: Any) -> Dict[str, Any]:
+        credential_kwargs = super()._get_credential_kwargs(is_async=is_async, **kwargs)
+        credential_kwargs["http_client"] = get_async_http_client() if is_async else get_http_client()
+        return credential_kwargs
+
+    # --- 共用的呼叫流程 ---
+
+    def _call(self, method: str, *args: Any, **kwargs: Any):
+        primary = getattr(super(PooledOpenAILike, self), method)
+        try:
+            return self._with_retry(lambda: primary(*args, **kwargs))
+        except Exception as exc:
+            if self._fallback is None:
+                raise
+            record_metric("fallback_calls")
+            logger.warning("LLM primary failed (%s), using fallback", type(exc).__name__)
+            return getattr(self._fallback, method)(*args, **kwargs)
+
+    def _with_retry(self, fn):
+        for attempt in range(self._retries + 1):
+            with self._gate.slot():
+                try:
+                    record_metric("requests")
+                    return fn()
+                except Exception as exc:
+                    if attempt >= self._retries or not is_retryable(exc):
+                        record_metric("errors")
+                        raise
+                    record_metric("retries")
+                    delay = retry_delay(attempt, exc)
+            time.sleep(delay)
+
+    async def _awith_retry(self, fn):
+        for attempt in range(self._retries + 1):
+            async with self._gate.aslot():
+                try:
+                    record_metric("requests")
+                    return await fn()
+                except Exception as exc:
+                    if attempt >= self._retries or not is_retryable(exc):
+                        record_metric("errors")
+                        raise
+                    record_metric("retries")
+                    delay = retry_delay(attempt, exc)
+            await asyncio.sleep(delay)
+
+    async def _acall(self, method: str, *args: Any, **kwargs: Any):
+        primary = getattr(super(PooledOpenAILike, self), method)
+        primary_task = asyncio.ensure_future(self._awith_retry(lambda: primary(*args, **kwargs)))
+        if self._fallback is None:
+            return await primary_task
+
+        fallback_call = getattr(self._fallback, method)
+        if self._hedge_delay > 0:
+            done, _ = await asyncio.wait({primary_task}, timeout=self._hedge_delay)
+            if not done:
+                # 主後端太慢：同時送往備援，取先成功的結果
+                record_metric("hedged_calls")
+                fallback_task = asyncio.ensure_future(fallback_call(*args, **kwargs))
+                return await self._first_success(primary_task, fallback_task)
+        try:
+            return await primary_task
+        except Exception as exc:
+            record_metric("fallback_calls")
+            logger.warning("LLM primary failed (%s), using fallback", type(exc).__name__)
+            return await fallback_call(*args, **kwargs)
+
+    @staticmethod
+    async def _first_success(primary_task, fallback_task):
+        pending = {primary_task, fallback_task}
+        error = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    for other in pending:
+                        other.cancel()
+                    if task is fallback_task:
+                        record_metric("fallback_wins")
+                    return task.result()
+                error = error or task.exception()
+        raise error
+
+    # --- 串流：在第一個 chunk 之前可重試，整段串流期間占用 gate ---
+
+    def _stream(self, method: str, *args: Any, **kwargs: Any):
+        primary = getattr(super(PooledOpenAILike, self), method)
+
+        def gen():
+            for attempt in range(self._retries + 1):
+                with self._gate.slot():
+                    try:
+                        record_metric("requests")
+                        stream = primary(*args, **kwargs)
+                        first = next(stream, None)
+                    except Exception as exc:
+                        if attempt >= self._retries or not is_retryable(exc):
+                            record_metric("errors")
+                            raise
+                        record_metric("retries")
+                        delay = retry_delay(attempt, exc)
+                    else:
+                        if first is not None:
+                            yield first
+                            yield from stream
+                        return
+                time.sleep(delay)
+
+        return gen()
+
+    async def _astream(self, method: str, *args: Any, **kwargs: Any):
+        primary = getattr(super(PooledOpenAILike, self), method)
+
+        async def gen():
+            for attempt in range(self._retries + 1):
+                async with self._gate.aslot():
+                    try:
+                        record_metric("requests")
+                        stream = await primary(*args, **kwargs)
+                        first = await stream.__anext__()
+                    except StopAsyncIteration:
+                        return
+                    except Exception as exc:
+                        if attempt >= self._retries or not is_retryable(exc):
+                            record_metric("errors")
+                            raise
+                        record_metric("retries")
+                        delay = retry_delay(attempt, exc)
+                    else:
+                        yield first
+                        async for chunk in stream:
+                            yield chunk
+                        return
+                await asyncio.sleep(delay)
+
+        return gen()
+
+    # --- 對外介面 ---
+
+    def chat(self, messages, **kwargs: Any):
+        return self._call("chat", messages, **kwargs)
+
+    def complete(self, prompt: str, formatted: bool = False, **kwargs: Any):
+        return self._call("complete", prompt, formatted=formatted, **kwargs)
+
+    def stream_chat(self, messages, **kwargs: Any):
+        return self._stream("stream_chat", messages, **kwargs)
+
+    def stream_complete(self, prompt: str, formatted: bool = False, **kwargs: Any):
+        return self._stream("stream_complete", prompt, formatted=formatted, **kwargs)
+
+    async def achat(self, messages, **kwargs: Any):
+        return await self._acall("achat", messages, **kwargs)
+
+    async def acomplete(self, prompt: str, formatted: bool = False, **kwargs: Any):
+        return await self._acall("acomplete", prompt, formatted=formatted, **kwargs)
+
+    async def astream_chat(self, messages, **kwargs: Any):
+        return await self._astream("astream_chat", messages, **kwargs)
+
+    async def astream_complete(self, prompt: str, formatted: bool = False, **kwargs: Any):
+        return await self._astream("astream_complete", prompt, formatted=formatted, **kwargs)
+
+
+def get_fallback_llm():
+    if LLM_FALLBACK == "ollama":
+        return Ollama(model=OLLAMA_MODEL, base_url=OLLAMA_BASE_URL, request_timeout=LLM_TIMEOUT)
+    return None
+
+
+@lru_cache(maxsize=1)
+def get_llm() -> PooledOpenAILike:
+    """每個 process 共用一個 LLM client（連線池、併發上限與速率限制都是全域的）"""
+    return PooledOpenAILike(
+        model=LLM_MODEL,
+        api_base=LLM_API_BASE,
+        api_key=LLM_API_KEY,
+        context_window=128000,
+        is_chat_model=True,
+        is_function_calling_model=True,
+        fallback=get_fallback_llm(),
+    )
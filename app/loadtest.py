@@ -0,0 +1,349 @@
+"""
+web_api 壓力測試與延遲基準
+
+    python -m app.loadtest --db storage/bench.db --seed-scale 1 --concurrency 32 --duration 60
+    python -m app.loadtest --url http://localhost:5000 --db storage/bench.db --mix browse=50,checkout=30,admin=20
+    python -m app.loadtest ... --compare storage/benchmarks/web-<舊版>.json
+
+未指定 --url 時在本機以 threaded WSGI server 啟動 web_api（使用 --db 指定的資料庫，不存在時先產生）；
+夾具資料（商品細項、優惠券、帳號）一律直接從 --db 讀取，因此 --url 目標必須使用同一個資料庫。
+每個虛擬使用者依 --mix 權重重複執行 browse / checkout / admin 腳本，
+結果依路由統計吞吐量與 p50/p95/p99，另存成 JSON 供不同 commit 比較。
+錯誤率超過 --max-error-rate 的路由量到的是錯誤處理的延遲，不是正常路徑：列出警告並以 exit 1 結束。
+"""
+
+import argparse
+import json
+import math
+import os
+import random
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional
+
+import requests
+
+RESULTS_DIR = os.path.join(os.getcwd(), "storage", "benchmarks")
+DEFAULT_MIX = {"browse": 70, "checkout": 20, "admin": 10}
+MAX_ERROR_RATE = 0.01
+# 由 seed_scale 產生的會員密碼；沒有壓測帳號時改用 init_db 的示範帳號
+LOAD_PASSWORD = "loadtest1234"
+DEMO_ACCOUNT = ("user", "user1234")
+ADMIN_ACCOUNT = "admin"
+
+
+def percentile(sorted_values: List[float], p: float) -> Optional[float]:
+    """nearest-rank 百分位數"""
+    if not sorted_values:
+        return None
+    rank = max(1, math.ceil(p / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+class Fixtures:
+    """腳本會用到的 id 與帳號，啟動前從資料庫一次讀好"""
+
+    def __init__(self, db_path: str, accounts: int = 200):
+        conn = sqlite3.connect(db_path)
+        try:
+            self.items = [r[0] for r in conn.execute(
+                "SELECT id FROM product_items WHERE status = 'NORMAL' AND stock > 0 ORDER BY id")]
+            self.store_ids = [r[0] for r in conn.execute("SELECT id FROM stores ORDER BY id")]
+            # (id, 最低消費)：只挑還有剩餘數量的優惠券，套用時再依訂單金額篩選
+            self.coupons = conn.execute("SELECT id, min_price FROM coupons WHERE remain_count > 0 ORDER BY id").fetchall()
+            self.orders = conn.execute("SELECT id, total FROM orders ORDER BY id DESC LIMIT 10000").fetchall()
+            load_accounts = [r[0] for r in conn.execute(
+                "SELECT account FROM users WHERE account LIKE 'load%' ORDER BY id LIMIT ?", (accounts,))]
+        finally:
+            conn.close()
+        self.accounts = [(a, LOAD_PASSWORD) for a in load_accounts] or [DEMO_ACCOUNT]
+
+
+class VirtualUser:
+    """一個虛擬使用者：自己的 cookie session，登入一次後重複執行腳本"""
+
+    def __init__(self, base_url: str, fixtures: Fixtures, record: Callable, rng: random.Random):
+        self.base_url = base_url.rstrip("/")
+        self.fx = fixtures
+        self.record = record
+        self.rng = rng
+        self.user = requests.Session()
+        self.admin = requests.Session()
+        self.user_logged_in = False
+        self.admin_logged_in = False
+
+    def call(self, http: requests.Session, label: str, method: str, path: str, **kwargs) -> Optional[requests.Response]:
+        start = time.perf_counter()
+        try:
+            resp = http.request(method, self.base_url + path, allow_redirects=False, timeout=60, **kwargs)
+            status = resp.status_code
+        except requests.RequestException:
+            resp, status = None, 0
+        self.record(label, status, (time.perf_counter() - start) * 1000)
+        return resp
+
+    def browse(self) -> None:
+        store_id = self.rng.choice(self.fx.store_ids) if self.fx.store_ids else 1
+        self.call(self.user, "GET /", "GET", "/")
+        self.call(self.user, "GET /api/products", "GET", "/api/products", params={"store_id": store_id})
+
+    def checkout(self) -> None:
+        if not self.user_logged_in:
+            account, password = self.rng.choice(self.fx.accounts)
+            self.call(self.user, "POST /user/login", "POST", "/user/login",
+                      data={"username": account, "password": password})
+            self.user_logged_in = True
+        items = self.rng.sample(self.fx.items, min(len(self.fx.items), self.rng.choice((1, 1, 2, 3))))
+        resp = self.call(self.user, "POST /api/orders", "POST", "/api/orders",
+                         json={"items": [{"product_item_id": i, "quantity": 1} for i in items]})
+        order_id, total = None, 0
+        if resp is not None and resp.status_code == 200:
+            order_id, total = resp.json().get("order_id"), resp.json().get("total", 0)
+        if not order_id and self.fx.orders:
+            order_id, total = self.rng.choice(self.fx.orders)
+        # 未達最低消費的優惠券會被拒絕（400），只挑這張訂單能用的，避免量到的是錯誤路徑
+        coupons = [coupon_id for coupon_id, min_price in self.fx.coupons if min_price <= total]
+        if order_id and coupons:
+            self.call(self.user, "POST /api/orders/{id}/apply-coupon", "POST", f"/api/orders/{order_id}/apply-coupon",
+                      data={"coupon_code": str(self.rng.choice(coupons))})
+
+    def admin_pages(self) -> None:
+        if not self.admin_logged_in:
+            self.call(self.admin, "POST /admin/login", "POST", "/admin/login", data={"username": ADMIN_ACCOUNT})
+            self.admin_logged_in = True
+        self.call(self.admin, "GET /admin", "GET", "/admin")
+        self.call(self.admin, "GET /admin/orders", "GET", "/admin/orders")
+        self.call(self.admin, "GET /api/stats", "GET", "/api/stats")
+
+
+class LoadTest:
+    def __init__(self, base_url: str, fixtures: Fixtures, mix: Dict[str, int], concurrency: int,
+                 duration: float, warmup: float = 5.0, seed: int = 42):
+        self.base_url = base_url
+        self.fixtures = fixtures
+        self.mix = mix
+        self.concurrency = concurrency
+        self.duration = duration
+        self.warmup = warmup
+        self.seed = seed
+        self.samples: Dict[str, List[float]] = defaultdict(list)
+        self.errors: Dict[str, int] = defaultdict(int)
+        self.statuses: Dict[str, Dict[int, int]] = defaultdict(lambda: defaultdict(int))
+        self._lock = threading.Lock()
+        self._measuring = False
+
+    def record(self, label: str, status: int, latency_ms: float) -> None:
+        if not self._measuring:
+            return
+        with self._lock:
+            self.samples[label].append(latency_ms)
+            self.statuses[label][status] += 1
+            if status == 0 or status >= 400:
+                self.errors[label] += 1
+
+    def _run_user(self, index: int, stop_at: float) -> None:
+        rng = random.Random(self.seed * 1000 + index)
+        vu = VirtualUser(self.base_url, self.fixtures, self.record, rng)
+        scenarios = {"browse": vu.browse, "checkout": vu.checkout, "admin": vu.admin_pages}
+        names = list(self.mix)
+        weights = [self.mix[n] for n in names]
+        while time.monotonic() < stop_at:
+            scenarios[rng.choices(names, weights)[0]]()
+
+    def run(self) -> Dict[str, Any]:
+        start = time.monotonic()
+        stop_at = start + self.warmup + self.duration
+        measure_timer = threading.Timer(self.warmup, lambda: setattr(self, "_measuring", True))
+        measure_timer.start()
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            for i in range(self.concurrency):
+                pool.submit(self._run_user, i, stop_at)
+        self._measuring = False
+        elapsed = time.monotonic() - start - self.warmup
+        return self.report(elapsed)
+
+    def report(self, elapsed: float) -> Dict[str, Any]:
+        routes = {}
+        all_latencies: List[float] = []
+        for label, values in sorted(self.samples.items()):
+            values.sort()
+            all_latencies.extend(values)
+            routes[label] = _summarize(values, elapsed, self.errors[label])
+            routes[label]["status"] = {str(k): v for k, v in sorted(self.statuses[label].items())}
+        all_latencies.sort()
+        return {
+            "routes": routes,
+            "total": _summarize(all_latencies, elapsed, sum(self.errors.values())),
+        }
+
+
+def _summarize(values: List[float], elapsed: float, errors: int) -> Dict[str, Any]:
+    def rounded(v):
+        return round(v, 2) if v is not None else None
+    return {
+        "requests": len(values),
+        "errors": errors,
+        "rps": round(len(values) / elapsed, 2) if elapsed > 0 else None,
+        "mean_ms": rounded(sum(values) / len(values)) if values else None,
+        "p50_ms": rounded(percentile(values, 50)),
+        "p95_ms": rounded(percentile(values, 95)),
+        "p99_ms": rounded(percentile(values, 99)),
+        "max_ms": rounded(values[-1]) if values else None,
+    }
+
+
+def prepare_database(db_path: str, scale: Optional[float], seed: int) -> None:
+    """資料庫不存在時建立並灌入 seed_scale 資料"""
+    if os.path.exists(db_path):
+        return
+    from .models import init_db
+    from .seed_scale import seed_scale
+    print(f"🗄️  Generating benchmark database {db_path} (scale={scale or 1.0})")
+    init_db(seed=True)
+    seed_scale(scale or 1.0, seed=seed)
+
+
+def start_local_server(port: int) -> Callable[[], None]:
+    """以 threaded WSGI server 在背景啟動 web_api，回傳停止函式"""
+    from werkzeug.serving import WSGIRequestHandler, make_server
+    from .web_api import app
+
+    class QuietHandler(WSGIRequestHandler):
+        def log_request(self, *args, **kwargs):
+            pass
+
+    server = make_server("127.0.0.1", port, app, threaded=True, request_handler=QuietHandler)
+    thread = threading.Thread(target=server.serve_forever, name="loadtest-server", daemon=True)
+    thread.start()
+    return server.shutdown
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parse_mix(value: str) -> Dict[str, int]:
+    mix = {}
+    for part in value.split(","):
+        name, _, weight = part.partition("=")
+        name = name.strip()
+        if name not in DEFAULT_MIX:
+            raise argparse.ArgumentTypeError(f"unknown scenario: {name}")
+        mix[name] = int(weight or 1)
+    return mix
+
+
+def print_report(result: Dict[str, Any], baseline: Optional[Dict[str, Any]] = None) -> None:
+    header = f"{'route':<38} {'reqs':>7} {'err':>5} {'rps':>8} {'p50':>8} {'p95':>8} {'p99':>8}"
+    if baseline:
+        header += f" {'Δp95':>8} {'Δrps':>8}"
+    print(header)
+    rows = list(result["routes"].items()) + [("TOTAL", result["total"])]
+    base_routes = dict(baseline["routes"], TOTAL=baseline["total"]) if baseline else {}
+    for label, r in rows:
+        line = (f"{label:<38} {r['requests']:>7} {r['errors']:>5} {r['rps'] or 0:>8.1f} "
+                f"{r['p50_ms'] or 0:>8.1f} {r['p95_ms'] or 0:>8.1f} {r['p99_ms'] or 0:>8.1f}")
+        old = base_routes.get(label)
+        if baseline:
+            line += f" {_delta(old and old['p95_ms'], r['p95_ms']):>8} {_delta(old and old['rps'], r['rps']):>8}"
+        print(line)
+
+
+def failed_routes(result: Dict[str, Any], max_error_rate: float) -> Dict[str, float]:
+    """{路由: 錯誤率}，只列出超過門檻的路由"""
+    failed = {}
+    for label, r in result["routes"].items():
+        rate = r["errors"] / r["requests"] if r["requests"] else 0.0
+        if rate > max_error_rate:
+            failed[label] = round(rate, 4)
+    return failed
+
+
+def _delta(old: Optional[float], new: Optional[float]) -> str:
+    if not old or new is None:
+        return "-"
+    return f"{(new - old) / old * 100:+.0f}%"
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="HTTP load test for web_api")
+    parser.add_argument("--db", default=os.path.join("storage", "bench.db"), help="Benchmark database path")
+    parser.add_argument("--seed-scale", type=float, default=None, help="Generate the database at this scale if missing")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--url", default=None, help="Target an already running server instead of booting one")
+    parser.add_argument("--port", type=int, default=5055, help="Port for the locally booted server")
+    parser.add_argument("--concurrency", type=int, default=16, help="Virtual users")
+    parser.add_argument("--duration", type=float, default=30, help="Measured seconds")
+    parser.add_argument("--warmup", type=float, default=5, help="Unmeasured warm-up seconds")
+    parser.add_argument("--mix", type=parse_mix, default=DEFAULT_MIX, help="e.g. browse=70,checkout=20,admin=10")
+    parser.add_argument("--accounts", type=int, default=200, help="Distinct user accounts used by checkout")
+    parser.add_argument("--output", default=None, help="JSON result path (default: storage/benchmarks/web-<time>-<commit>.json)")
+    parser.add_argument("--compare", default=None, help="Previous JSON result to diff against")
+    parser.add_argument("--max-error-rate", type=float, default=MAX_ERROR_RATE,
+                        help="Fail when a route's error rate (status 0 or >= 400) exceeds this fraction (default: 0.01)")
+    args = parser.parse_args(argv)
+
+    db_path = os.path.abspath(args.db)
+    # models / web_api 在 import 時讀取 APP_DB_PATH
+    os.environ["APP_DB_PATH"] = db_path
+    prepare_database(db_path, args.seed_scale, args.seed)
+    fixtures = Fixtures(db_path, accounts=args.accounts)
+
+    stop_server = None
+    base_url = args.url
+    if base_url is None:
+        stop_server = start_local_server(args.port)
+        base_url = f"http://127.0.0.1:{args.port}"
+    print(f"🏋️  {base_url}  concurrency={args.concurrency} duration={args.duration}s mix={args.mix}")
+    try:
+        result = LoadTest(base_url, fixtures, args.mix, args.concurrency, args.duration,
+                          warmup=args.warmup, seed=args.seed).run()
+    finally:
+        if stop_server:
+            stop_server()
+
+    commit = git_commit()
+    result["meta"] = {
+        "commit": commit,
+        "time": datetime.now().isoformat(timespec="seconds"),
+        "url": args.url or "local",
+        "db": db_path,
+        "concurrency": args.concurrency,
+        "duration": args.duration,
+        "warmup": args.warmup,
+        "mix": args.mix,
+        "python": sys.version.split()[0],
+    }
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+    print_report(result, baseline)
+    failed = failed_routes(result, args.max_error_rate)
+    result["failed_routes"] = failed
+
+    output = args.output or os.path.join(
+        RESULTS_DIR, f"web-{datetime.now():%Y%m%d-%H%M%S}-{commit or 'nogit'}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    print(f"💾 Saved {output}")
+    if failed:
+        for label, rate in failed.items():
+            statuses = ", ".join(f"{k}×{v}" for k, v in result["routes"][label]["status"].items())
+            print(f"❌ {label}: {rate:.1%} errors ({statuses}); its latency measures the error path")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
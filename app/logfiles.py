@@ -0,0 +1,74 @@
+"""
+每個 process 各寫一份的 JSONL 記錄檔（agent 用量、SQL 報告）
+
+--prod 多個 worker 共用同一個 RotatingFileHandler 時，各自判斷大小、各自 rename，輪替後其他 worker
+仍寫到舊檔，行會遺失或互相覆蓋。改成每個 process 寫 <name>.<pid>.jsonl，只有單一寫入者，輪替才安全；
+讀取端合併所有檔案，並且只讀最後 max_bytes，不會把整份記錄載入記憶體。
+"""
+
+import glob
+import logging
+import os
+from logging.handlers import RotatingFileHandler
+from typing import Iterator, List, Optional
+
+
+def process_log_path(path: str, pid: Optional[int] = None) -> str:
+    """storage/logs/agent_turns.jsonl → storage/logs/agent_turns.<pid>.jsonl"""
+    root, ext = os.path.splitext(path)
+    return f"{root}.{pid or os.getpid()}{ext}"
+
+
+def process_log_files(path: str, modified_since: Optional[float] = None) -> List[str]:
+    """所有 process 的檔案與輪替備份，最近修改的在前；可略過 modified_since 之後沒有寫入的檔案"""
+    root, ext = os.path.splitext(path)
+    pattern = f"{glob.escape(root)}.*{ext}"
+    files = []
+    for p in glob.glob(pattern) + glob.glob(f"{pattern}.*"):
+        try:
+            mtime = os.path.getmtime(p)
+        except OSError:
+            continue  # 剛好被輪替掉
+        if modified_since is None or mtime >= modified_since:
+            files.append((mtime, p))
+    return [p for _, p in sorted(files, reverse=True)]
+
+
+def open_process_log(name: str, path: str, max_bytes: int, backups: int) -> logging.Logger:
+    """logger 改寫到本 process 的檔案；fork 後在子 process 再呼叫一次，會換掉從父 process 繼承的 handler"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    logger = logging.getLogger(name)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+        handler.close()
+    handler = RotatingFileHandler(process_log_path(path), maxBytes=max_bytes, backupCount=backups,
+                                  encoding="utf-8", delay=True)
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    logger.addHandler(handler)
+    return logger
+
+
+def tail_lines(paths: List[str], max_bytes: int) -> Iterator[str]:
+    """依序讀每份檔案的最後一段，合計不超過 max_bytes；從行中間開始的第一行捨棄"""
+    budget = max_bytes
+    for path in paths:
+        if budget <= 0:
+            break
+        try:
+            with open(path, "rb") as f:
+                size = f.seek(0, os.SEEK_END)
+                start = max(0, size - budget)
+                partial = False
+                if start:
+                    f.seek(start - 1)
+                    partial = f.read(1) != b"\n"
+                f.seek(start)
+                data = f.read(size - start)
+        except OSError:
+            continue
+        budget -= len(data)
+        lines = data.splitlines()
+        for line in lines[1:] if partial else lines:
+            yield line.decode("utf-8", errors="replace")
@@ -0,0 +1,166 @@
+import asyncio
+import logging
+import re
+import threading
+from typing import Any, List, Optional
+
+from pydantic import PrivateAttr
+from llama_index.core.llms import ChatMessage, MessageRole
+from llama_index.core.memory import ChatMemoryBuffer
+
+RECENT_TURNS = 3   # 保留原文的最近幾輪對話
+FOLD_BATCH = 2     # 超出幾輪後才觸發一次摘要，避免每輪都呼叫 LLM
+
+logger = logging.getLogger("app.memory")
+
+TRACE_LINE = re.compile(r"^\s*(Thought|Action|Action Input|Observation)\s*:", re.IGNORECASE)
+
+SUMMARY_PROMPT = """你是客服對話紀錄的整理助手。請將「既有摘要」與「新的對話」合併成一段精簡的繁體中文摘要。
+必須保留：訂單編號、商品名稱與數量、金額、收件地址或電子郵件、使用者尚未完成的需求。
+不要加入對話中沒有的資訊，不超過 200 字。
+
+既有摘要：
+{summary}
+
+新的對話：
+{transcript}
+
+摘要："""
+
+
+def strip_tool_trace(content: str) -> str:
+    """移除 ReAct 的 Thought/Action/Observation 軌跡，只保留給使用者的回答"""
+    if not content:
+        return content
+    if "Answer:" in content:
+        return content[content.rfind("Answer:") + len("Answer:"):].strip()
+    lines = [line for line in content.splitlines() if not TRACE_LINE.match(line)]
+    return "\n".join(lines).strip()
+
+
+class RollingSummaryMemory(ChatMemoryBuffer):
+    """最近幾輪保留原文，較舊的對話在背景摺疊成一段摘要。
+
+    摘要存在 chat store 的摘要表（get_summary/set_summary），不會出現在 get_keys() 的對話 key 中。
+    """
+
+    recent_turns: int = RECENT_TURNS
+    fold_batch: int = FOLD_BATCH
+    _llm: Any = PrivateAttr(default=None)
+    _summary_lock: Any = PrivateAttr(default_factory=threading.Lock)
+    _summary_task: Any = PrivateAttr(default=None)
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "RollingSummaryMemory"
+
+    @classmethod
+    def from_defaults(cls, llm=None, recent_turns: int = RECENT_TURNS, fold_batch: int = FOLD_BATCH, **kwargs: Any) -> "RollingSummaryMemory":
+        memory = super().from_defaults(**kwargs)
+        memory.recent_turns = recent_turns
+        memory.fold_batch = fold_batch
+        memory._llm = llm
+        return memory
+
+    @property
+    def llm(self):
+        if self._llm is None:
+            from llama_index.core import Settings
+            self._llm = Settings.llm
+        return self._llm
+
+    def get_summary(self) -> Optional[str]:
+        return self.chat_store.get_summary(self.chat_store_key)
+
+    def set_summary(self, summary: str) -> None:
+        self.chat_store.set_summary(self.chat_store_key, summary)
+
+    def clear_summary(self) -> None:
+        self.chat_store.delete_summary(self.chat_store_key)
+
+    # --- 寫入 ---
+
+    def _clean(self, message: ChatMessage) -> ChatMessage:
+        if message.role == MessageRole.ASSISTANT and isinstance(message.content, str):
+            return ChatMessage(role=message.role, content=strip_tool_trace(message.content))
+        return message
+
+    def put(self, message: ChatMessage) -> None:
+        super().put(self._clean(message))
+        if self._should_fold():
+            threading.Thread(target=self.fold, daemon=True).start()
+
+    async def aput(self, message: ChatMessage) -> None:
+        await super().aput(self._clean(message))
+        if self._summary_task is not None and not self._summary_task.done():
+            return
+        # _should_fold 會讀整段對話（SQLite），不在 event loop 上執行
+        if await asyncio.to_thread(self._should_fold):
+            self._summary_task = asyncio.get_running_loop().create_task(self.afold())
+            self._summary_task.add_done_callback(self._log_fold_error)
+
+    def _log_fold_error(self, task: "asyncio.Task") -> None:
+        """背景摘要失敗只記錄，舊對話保留原文，下次再摺疊"""
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("summary fold failed for %s", self.chat_store_key, exc_info=task.exception())
+
+    # --- 讀取 ---
+
+    def get(self, input: Optional[str] = None, initial_token_count: int = 0, **kwargs: Any) -> List[ChatMessage]:
+        summary = self.get_summary()
+        if not summary:
+            return super().get(input=input, initial_token_count=initial_token_count, **kwargs)
+        summary_msg = ChatMessage(role=MessageRole.SYSTEM, content=f"先前對話摘要：{summary}")
+        summary_tokens = self._token_count_for_messages([summary_msg])
+        return [summary_msg] + super().get(input=input, initial_token_count=initial_token_count + summary_tokens, **kwargs)
+
+    # --- 摘要 ---
+
+    def _split(self, messages: List[ChatMessage]):
+        """回傳 (要摺疊的舊訊息, 保留原文的最近訊息)"""
+        user_positions = [i for i, m in enumerate(messages) if m.role == MessageRole.USER]
+        if len(user_positions) <= self.recent_turns:
+            return [], messages
+        cut = user_positions[-self.recent_turns]
+        return messages[:cut], messages[cut:]
+
+    def _should_fold(self) -> bool:
+        messages = self.get_all()
+        turns = sum(1 for m in messages if m.role == MessageRole.USER)
+        return turns > self.recent_turns + self.fold_batch and not self._summary_lock.locked()
+
+    def _prompt(self, older: List[ChatMessage]) -> str:
+        transcript = "\n".join(f"{m.role.value}: {m.content}" for m in older)
+        return SUMMARY_PROMPT.format(summary=self.get_summary() or "（無）", transcript=transcript)
+
+    def _commit(self, older: List[ChatMessage], summary: str) -> None:
+        self.set_summary(summary)
+        # 只刪掉被摺疊的最舊訊息，摘要期間新加入的訊息不受影響
+        if hasattr(self.chat_store, "delete_oldest"):
+            self.chat_store.delete_oldest(self.chat_store_key, len(older))
+        else:
+            for _ in older:
+                self.chat_store.delete_message(self.chat_store_key, 0)
+
+    def fold(self) -> None:
+        if not self._summary_lock.acquire(blocking=False):
+            return
+        try:
+            older, _ = self._split(self.get_all())
+            if older:
+                summary = str(self.llm.complete(self._prompt(older))).strip()
+                self._commit(older, summary)
+        finally:
+            self._summary_lock.release()
+
+    async def afold(self) -> None:
+        if not self._summary_lock.acquire(blocking=False):
+            return
+        try:
+            older, _ = self._split(await self.aget_all())
+            if older:
+                prompt = await asyncio.to_thread(self._prompt, older)
+                summary = str(await self.llm.acomplete(prompt)).strip()
+                await asyncio.to_thread(self._commit, older, summary)
+        finally:
+            self._summary_lock.release()
@@ -0,0 +1,524 @@
+"""
+Prometheus 文字格式的服務指標
+
+計數器與直方圖放在 process 內的 registry，請求與 agent 回合結束時累加；連線池、快取這類即時數值
+由 collector 在輸出前讀取。業務數字（使用者、商品、訂單、已付款）不在每次抓取時 COUNT 整張表：
+快取的基準值每 APP_METRICS_BUSINESS_TTL 秒才重新計算一次，期間由本 process 提交的新增 / 刪除增量更新。
+
+--prod 多 worker 時（設定 APP_METRICS_DIR），每個 process 定期把自己的數值寫到 <dir>/<pid>.json，
+/metrics 合併所有檔案後輸出：計數器與直方圖加總（已結束的 worker 也保留），即時數值只取仍在執行的 process。
+"""
+
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter as TallyCounter
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from flask import Response, g, request
+from sqlalchemy import event, func, inspect, select
+from sqlalchemy.orm import Session as OrmSession
+
+from .models import Order, Payment, PaymentStatus, Product, User, get_default_engine
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+TURN_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.0, 4.0, 8.0, 15.0, 30.0, 60.0)
+FLUSH_INTERVAL = float(os.environ.get("APP_METRICS_FLUSH_INTERVAL", "1"))
+BUSINESS_TTL = float(os.environ.get("APP_METRICS_BUSINESS_TTL", "300"))
+
+
+def _metrics_dir() -> Optional[str]:
+    # 由 server.run_prefork 在 fork 前設定，不能在 import 時讀取
+    return os.environ.get("APP_METRICS_DIR") or None
+
+
+# =========================
+# Registry
+# =========================
+
+class _Metric:
+    type = ""
+
+    def __init__(self, name: str, help: str, labelnames: Tuple[str, ...] = (), merge: str = "sum"):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.merge = merge   # 多 process 合併方式：sum 或 max
+        self._values: Dict[Tuple[str, ...], Any] = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, Any]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def reset(self) -> None:
+        with self._lock:
+            self._values.clear()
+
+    def dump(self) -> Dict[str, Any]:
+        with self._lock:
+            values = [[list(k), v] for k, v in self._values.items()]
+        return {"type": self.type, "help": self.help, "labelnames": list(self.labelnames), "merge": self.merge,
+                "values": values}
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def inc(self, amount: float = 1.0, **labels: Any) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def set_total(self, value: float, **labels: Any) -> None:
+        """鏡像其他模組自行累計的次數（例如 AgentCache.hits）"""
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+
+class Gauge(_Metric):
+    type = "gauge"
+
+    def set(self, value: float, **labels: Any) -> None:
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1.0, **labels: Any) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1.0, **labels: Any) -> None:
+        self.inc(-amount, **labels)
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: Tuple[str, ...] = (), buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels: Any) -> None:
+        key = self._key(labels)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = {"buckets": [0] * (len(self.buckets) + 1), "sum": 0.0, "count": 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry["buckets"][i] += 1
+                    break
+            else:
+                entry["buckets"][-1] += 1
+            entry["sum"] += value
+            entry["count"] += 1
+
+    def dump(self) -> Dict[str, Any]:
+        with self._lock:
+            values = [[list(k), {"buckets": list(v["buckets"]), "sum": v["sum"], "count": v["count"]}]
+                      for k, v in self._values.items()]
+        return {"type": self.type, "help": self.help, "labelnames": list(self.labelnames), "merge": self.merge,
+                "buckets": list(self.buckets), "values": values}
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+        self._collectors: List[Callable[[], None]] = []
+        self._lock = threading.Lock()
+        self._flushed_at = 0.0
+
+    def _register(self, metric: _Metric) -> Any:
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name: str, help: str, labelnames: Tuple[str, ...] = ()) -> Counter:
+        return self._register(Counter(name, help, labelnames))
+
+    def gauge(self, name: str, help: str, labelnames: Tuple[str, ...] = (), merge: str = "sum") -> Gauge:
+        return self._register(Gauge(name, help, labelnames, merge=merge))
+
+    def histogram(self, name: str, help: str, labelnames: Tuple[str, ...] = (),
+                  buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, help, labelnames, buckets=buckets))
+
+    def register_collector(self, collector: Callable[[], None]) -> None:
+        """collector 在輸出前呼叫，負責把即時數值寫進 gauge"""
+        with self._lock:
+            self._collectors.append(collector)
+
+    def collect(self) -> Dict[str, Dict[str, Any]]:
+        for collector in list(self._collectors):
+            try:
+                collector()
+            except Exception as e:
+                print(f"metrics: collector {getattr(collector, '__name__', collector)} failed: {e}")
+        return {name: metric.dump() for name, metric in list(self._metrics.items())}
+
+    def reset(self) -> None:
+        """fork 出的 worker 不沿用父 process 累積的數值"""
+        for metric in list(self._metrics.values()):
+            metric.reset()
+        self._flushed_at = 0.0
+
+    # --- 多 process ---
+
+    def flush(self, force: bool = False) -> None:
+        directory = _metrics_dir()
+        if directory is None:
+            return
+        now = time.monotonic()
+        if not force and now - self._flushed_at < FLUSH_INTERVAL:
+            return
+        self._flushed_at = now
+        path = os.path.join(directory, f"{os.getpid()}.json")
+        tmp = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"pid": os.getpid(), "families": self.collect()}, f)
+        os.replace(tmp, path)
+
+    def snapshots(self) -> List[Dict[str, Any]]:
+        directory = _metrics_dir()
+        if directory is None:
+            return [{"pid": os.getpid(), "families": self.collect()}]
+        self.flush(force=True)
+        result = []
+        for name in os.listdir(directory):
+            if not name.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(directory, name), "r", encoding="utf-8") as f:
+                    result.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+        return result
+
+    def render(self) -> str:
+        return render_snapshots(self.snapshots())
+
+
+def _alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _merge(snapshots: List[Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+    merged: Dict[str, Dict[str, Any]] = {}
+    for snapshot in snapshots:
+        alive = snapshot["pid"] == os.getpid() or _alive(snapshot["pid"])
+        for name, family in snapshot["families"].items():
+            if family["type"] == "gauge" and not alive:
+                continue
+            target = merged.setdefault(name, {**family, "values": {}})
+            values = target["values"]
+            for labels, value in family["values"]:
+                key = tuple(labels)
+                if family["type"] == "histogram":
+                    entry = values.setdefault(key, {"buckets": [0] * len(value["buckets"]), "sum": 0.0, "count": 0})
+                    entry["buckets"] = [a + b for a, b in zip(entry["buckets"], value["buckets"])]
+                    entry["sum"] += value["sum"]
+                    entry["count"] += value["count"]
+                elif family["merge"] == "max":
+                    values[key] = max(values.get(key, value), value)
+                else:
+                    values[key] = values.get(key, 0) + value
+    return merged
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: Iterable[str], values: Iterable[str], extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = [(n, v) for n, v in zip(names, values)]
+    if extra is not None:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{n}="{_escape(str(v))}"' for n, v in pairs) + "}"
+
+
+def _number(value: float) -> str:
+    if isinstance(value, float) and not value.is_integer():
+        return repr(value)
+    return str(int(value))
+
+
+def render_snapshots(snapshots: List[Dict[str, Any]]) -> str:
+    lines: List[str] = []
+    for name, family in sorted(_merge(snapshots).items()):
+        if not family["values"]:
+            continue
+        lines.append(f"# HELP {name} {family['help']}")
+        lines.append(f"# TYPE {name} {family['type']}")
+        for key, value in sorted(family["values"].items()):
+            if family["type"] == "histogram":
+                cumulative = 0
+                for bound, count in zip(family["buckets"] + ["+Inf"], value["buckets"]):
+                    cumulative += count
+                    le = bound if bound == "+Inf" else _number(float(bound))
+                    lines.append(f"{name}_bucket{_labels(family['labelnames'], key, ('le', le))} {cumulative}")
+                lines.append(f"{name}_sum{_labels(family['labelnames'], key)} {_number(value['sum'])}")
+                lines.append(f"{name}_count{_labels(family['labelnames'], key)} {value['count']}")
+            else:
+                lines.append(f"{name}{_labels(family['labelnames'], key)} {_number(value)}")
+    return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+HTTP_REQUESTS = REGISTRY.counter("http_requests_total", "HTTP requests by endpoint and status",
+                                 ("service", "method", "endpoint", "status"))
+HTTP_LATENCY = REGISTRY.histogram("http_request_duration_seconds", "Time until the response headers are ready",
+                                  ("service", "method", "endpoint"))
+HTTP_IN_FLIGHT = REGISTRY.gauge("http_requests_in_flight", "Requests currently being handled", ("service",))
+
+AGENT_TURNS = REGISTRY.counter("agent_turns_total", "Agent conversation turns", ("route", "status"))
+AGENT_TURN_LATENCY = REGISTRY.histogram("agent_turn_duration_seconds", "End-to-end agent turn latency",
+                                        ("route",), buckets=TURN_BUCKETS)
+AGENT_TTFT = REGISTRY.histogram("agent_turn_ttft_seconds", "Time to first LLM token within a turn",
+                                buckets=TURN_BUCKETS)
+AGENT_TOOL_LATENCY = REGISTRY.histogram("agent_tool_duration_seconds", "Tool time per turn", ("tool",),
+                                        buckets=TURN_BUCKETS)
+LLM_CALLS = REGISTRY.counter("llm_calls_total", "LLM requests made by agent turns")
+LLM_TOKENS = REGISTRY.counter("llm_tokens_total", "LLM tokens used by agent turns", ("type",))
+LLM_COST = REGISTRY.counter("llm_cost_usd_total", "Estimated LLM cost in USD")
+LLM_CLIENT_EVENTS = REGISTRY.counter("llm_client_events_total", "LLM client retries, throttling and fallbacks", ("event",))
+SQL_GUARD_EVENTS = REGISTRY.counter("sql_guard_events_total", "Generated SQL checks and rejections", ("event",))
+
+DB_POOL = REGISTRY.gauge("db_pool_connections", "SQLAlchemy pool connections by state", ("database", "state"))
+CACHE_HITS = REGISTRY.counter("cache_hits_total", "Cache hits", ("cache",))
+CACHE_MISSES = REGISTRY.counter("cache_misses_total", "Cache misses", ("cache",))
+CACHE_ENTRIES = REGISTRY.gauge("cache_entries", "Entries currently cached", ("cache",))
+BUSINESS = REGISTRY.gauge("business_entities", "Row counts, cached and updated from this process's commits",
+                          ("entity",), merge="max")
+
+
+def metrics_response() -> Response:
+    return Response(REGISTRY.render(), content_type=CONTENT_TYPE)
+
+
+# =========================
+# HTTP
+# =========================
+
+def instrument_flask(app, service: str) -> None:
+    """以 before_request / after_request 記錄每個路由的次數與延遲"""
+
+    @app.before_request
+    def _metrics_start():
+        g._metrics_started = time.perf_counter()
+        g._metrics_in_flight = True
+        HTTP_IN_FLIGHT.inc(service=service)
+
+    @app.after_request
+    def _metrics_record(response):
+        started = g.pop("_metrics_started", None)
+        if started is not None:
+            # 以路由樣板當標籤，避免 id 造成標籤爆量；串流回應只計到送出 header 為止
+            endpoint = request.url_rule.rule if request.url_rule is not None else "<unmatched>"
+            HTTP_REQUESTS.inc(service=service, method=request.method, endpoint=endpoint, status=response.status_code)
+            HTTP_LATENCY.observe(time.perf_counter() - started, service=service, method=request.method, endpoint=endpoint)
+        return response
+
+    @app.teardown_request
+    def _metrics_done(exc=None):
+        if g.pop("_metrics_in_flight", False):
+            HTTP_IN_FLIGHT.dec(service=service)
+        REGISTRY.flush()
+
+
+# =========================
+# Agent 回合（由 usage.track_turn 呼叫）
+# =========================
+
+def observe_turn(stats) -> None:
+    route = stats.routed or "react"
+    AGENT_TURNS.inc(route=route, status="error" if stats.error else "ok")
+    AGENT_TURN_LATENCY.observe(stats.total_ms / 1000, route=route)
+    if stats.ttft_ms is not None:
+        AGENT_TTFT.observe(stats.ttft_ms / 1000)
+    for tool, ms in stats.tool_ms.items():
+        AGENT_TOOL_LATENCY.observe(ms / 1000, tool=tool)
+    LLM_CALLS.inc(stats.llm_calls)
+    LLM_TOKENS.inc(stats.prompt_tokens, type="prompt")
+    LLM_TOKENS.inc(stats.completion_tokens, type="completion")
+    LLM_COST.inc(stats.cost_usd)
+
+
+# =========================
+# 即時數值
+# =========================
+
+def _pool_stats(engine) -> Dict[str, int]:
+    pool = engine.pool
+    stats = {}
+    for state, method in (("size", "size"), ("checked_out", "checkedout"), ("checked_in", "checkedin"),
+                          ("overflow", "overflow")):
+        fn = getattr(pool, method, None)
+        if fn is not None:
+            # QueuePool.overflow() 在連線還沒建滿時是負數
+            stats[state] = max(0, fn())
+    return stats
+
+
+def watch_engines(engines: Callable[[], Iterable[Any]]) -> None:
+    """engines 回傳要回報連線池狀態的 engine；同一個資料庫檔案的多個 engine 合併計算"""
+
+    def collect_pools():
+        totals: Dict[Tuple[str, str], int] = TallyCounter()
+        for engine in engines():
+            database = os.path.basename(engine.url.database or "") or engine.url.get_backend_name()
+            for state, value in _pool_stats(engine).items():
+                totals[(database, state)] += value
+        for (database, state), value in totals.items():
+            DB_POOL.set(value, database=database, state=state)
+
+    REGISTRY.register_collector(collect_pools)
+
+
+def watch_cache(name: str, stats: Callable[[], Optional[Dict[str, Any]]]) -> None:
+    """stats 回傳含 hits / misses / size 的 dict（例如 AgentCache.counters），尚未建立時回傳 None"""
+
+    def collect_cache():
+        current = stats()
+        if current is None:
+            return
+        CACHE_HITS.set_total(current.get("hits", 0), cache=name)
+        CACHE_MISSES.set_total(current.get("misses", 0), cache=name)
+        if "size" in current:
+            CACHE_ENTRIES.set(current["size"], cache=name)
+
+    REGISTRY.register_collector(collect_cache)
+
+
+def _model_engines():
+    from .models import _engines
+    return list(_engines)
+
+
+def _loaded(module: str):
+    # 只讀取已經載入的模組，抓取指標不應觸發 LlamaIndex 等重量級 import
+    return sys.modules.get(f"{__package__}.{module}")
+
+
+def _collect_counters():
+    llm_client, sql_guard = _loaded("llm_client"), _loaded("sql_guard")
+    if llm_client is not None:
+        for name, value in llm_client.get_llm_metrics().items():
+            LLM_CLIENT_EVENTS.set_total(value, event=name)
+    if sql_guard is not None:
+        for name, value in sql_guard.get_guard_metrics().items():
+            SQL_GUARD_EVENTS.set_total(value, event=name)
+
+
+def _collect_lru_caches():
+    schema_context = _loaded("schema_context")
+    if schema_context is None:
+        return
+    info = schema_context.get_pruned_sql_database.cache_info()
+    CACHE_HITS.set_total(info.hits, cache="schema_context")
+    CACHE_MISSES.set_total(info.misses, cache="schema_context")
+    CACHE_ENTRIES.set(info.currsize, cache="schema_context")
+
+
+def _collect_catalog():
+    module = _loaded("catalog_cache")
+    if module is not None:
+        # 版本改變才重建，重建次數即 miss
+        CACHE_MISSES.set_total(module.catalog_cache.rebuilds, cache="catalog")
+
+
+# =========================
+# 業務數字
+# =========================
+
+def _entity_deltas(obj, sign: int, delta: TallyCounter) -> None:
+    for entity, model in (("users", User), ("products", Product), ("orders", Order)):
+        if isinstance(obj, model):
+            delta[entity] += sign
+    if isinstance(obj, Payment) and obj.status == PaymentStatus.PAID:
+        delta["payments_paid"] += sign
+
+
+@event.listens_for(OrmSession, "before_flush")
+def _track_business_changes(session, flush_context, instances):
+    delta = session.info.setdefault("business_delta", TallyCounter())
+    for obj in session.new:
+        _entity_deltas(obj, 1, delta)
+    for obj in session.deleted:
+        _entity_deltas(obj, -1, delta)
+    for obj in session.dirty:
+        if isinstance(obj, Payment):
+            history = inspect(obj).attrs.status.history
+            if PaymentStatus.PAID in history.added:
+                delta["payments_paid"] += 1
+            if PaymentStatus.PAID in history.deleted:
+                delta["payments_paid"] -= 1
+
+
+@event.listens_for(OrmSession, "after_commit")
+def _apply_business_changes(session):
+    delta = session.info.pop("business_delta", None)
+    if delta:
+        business_counts.apply(delta)
+
+
+@event.listens_for(OrmSession, "after_rollback")
+def _discard_business_changes(session):
+    session.info.pop("business_delta", None)
+
+
+class BusinessCounts:
+    """COUNT 只在快取過期時執行；其間以本 process 提交的增量更新"""
+
+    def __init__(self, ttl: float = BUSINESS_TTL):
+        self.ttl = ttl
+        self._base: Dict[str, int] = {}
+        self._delta: TallyCounter = TallyCounter()
+        self._loaded_at: Optional[float] = None
+        self._lock = threading.Lock()
+
+    def _load(self) -> Dict[str, int]:
+        queries = {
+            "users": select(func.count()).select_from(User),
+            "products": select(func.count()).select_from(Product),
+            "orders": select(func.count()).select_from(Order),
+            "payments_paid": select(func.count()).select_from(Payment).where(Payment.status == PaymentStatus.PAID),
+        }
+        with get_default_engine().connect() as conn:
+            return {name: conn.execute(query).scalar() or 0 for name, query in queries.items()}
+
+    def apply(self, delta: Dict[str, int]) -> None:
+        with self._lock:
+            self._delta.update(delta)
+
+    def values(self) -> Dict[str, int]:
+        with self._lock:
+            now = time.monotonic()
+            if self._loaded_at is None or now - self._loaded_at >= self.ttl:
+                self._base = self._load()
+                self._delta.clear()
+                self._loaded_at = now
+            return {name: value + self._delta.get(name, 0) for name, value in self._base.items()}
+
+
+business_counts = BusinessCounts()
+
+
+def _collect_business():
+    for entity, value in business_counts.values().items():
+        BUSINESS.set(value, entity=entity)
+
+
+watch_engines(_model_engines)
+for _collector in (_collect_counters, _collect_lru_caches, _collect_catalog, _collect_business):
+    REGISTRY.register_collector(_collector)
@@ -0,0 +1,238 @@
+"""
+本機的確定性 mock LLM（OpenAI 相容 /v1/chat/completions）
+
+依 prompt 的種類回傳預先寫好的輸出：ReAct 的 Thought/Action、text-to-SQL 的 SQL、
+SQL 結果與文件問答的彙整、記憶摘要。延遲固定（TTFT + 每 token 時間），同樣的輸入一定得到同樣的輸出，
+讓 agent 基準測試量到的是應用程式本身的開銷，而不是上游模型的抖動。
+
+    python -m app.mock_llm --port 8808 --ttft-ms 300 --tokens-per-sec 80
+    APP_LLM_API_BASE=http://127.0.0.1:8808/v1 python -m app.run
+"""
+
+import argparse
+import json
+import re
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+
+MOCK_MODEL = "mock-react"
+CHARS_PER_TOKEN = 3   # 估算 token 數用，與 usage._count_tokens 的退路一致
+
+POLICY_WORDS = ["退貨", "退款", "換貨", "保固", "維修", "售後", "運費", "配送", "付款", "政策", "refund", "warranty", "shipping"]
+ORDER_WORDS = ["訂單", "出貨", "物流", "包裹", "order"]
+AGGREGATE_WORDS = ["最便宜", "最貴", "平均", "比較", "幾款", "統計", "排行", "cheapest"]
+BUY_WORDS = ["下單", "幫我買", "我要買", "我想買", "購買", "buy"]
+
+QUOTED = re.compile(r"[「\"]([^」\"]+)[」\"]")
+
+
+def _tokens(text: str) -> int:
+    return max(1, len(text) // CHARS_PER_TOKEN)
+
+
+def _has(text: str, words: List[str]) -> bool:
+    lowered = text.lower()
+    return any(w in lowered for w in words)
+
+
+class ScriptedReplies:
+    """依 prompt 內容決定回覆；回傳 (種類, 文字)"""
+
+    def reply(self, messages: List[Dict]) -> Tuple[str, str]:
+        contents = [str(m.get("content") or "") for m in messages]
+        prompt = "\n".join(contents)
+        last = contents[-1] if contents else ""
+        if "SQL Response:" in last:
+            return "sql_synthesis", self.synthesize(last.split("SQL Response:", 1)[1])
+        if last.rstrip().endswith("SQLQuery:"):
+            return "text_to_sql", self.text_to_sql(last)
+        if "Context information is below" in last:
+            return "docs_answer", self.docs_answer(last)
+        if last.rstrip().endswith("摘要："):
+            return "summary", "使用者詢問過商品價格與訂單狀態，尚無未完成的下單需求。"
+        if "Action Input" in prompt:
+            if last.lstrip().startswith("Observation:"):
+                return "react_answer", self.react_answer(last)
+            return "react_action", self.react_action(self._question(messages))
+        return "chat", "好的，請問還有什麼需要協助的嗎？"
+
+    @staticmethod
+    def _question(messages: List[Dict]) -> str:
+        for m in reversed(messages):
+            content = str(m.get("content") or "")
+            if m.get("role") == "user" and not content.lstrip().startswith("Observation:"):
+                return content
+        return ""
+
+    def react_action(self, question: str) -> str:
+        quoted = QUOTED.search(question)
+        keyword = quoted.group(1) if quoted else question
+        if _has(question, BUY_WORDS):
+            tool, args = "request_more_info", {"missing_fields": ["quantity", "destination"], "context": f"您想購買{keyword}"}
+        elif _has(question, POLICY_WORDS):
+            tool, args = "policy_docs_tool", {"input": question}
+        elif _has(question, ORDER_WORDS):
+            tool, args = "order_sql_tool", {"input": question}
+        elif _has(question, AGGREGATE_WORDS):
+            tool, args = "product_sql_tool", {"input": question}
+        else:
+            tool, args = "product_search_tool", {"query": keyword, "limit": 5}
+        return (f"Thought: The current language of the user is: 中文. I need to use a tool to help me answer the question.\n"
+                f"Action: {tool}\nAction Input: {json.dumps(args, ensure_ascii=False)}")
+
+    def react_answer(self, observation: str) -> str:
+        summary = observation.split("Observation:", 1)[1].strip().replace("\n", " ")[:160]
+        return ("Thought: I can answer without using any more tools. I'll use the user's language to answer.\n"
+                f"Answer: 以下是查詢結果：{summary}")
+
+    def text_to_sql(self, prompt: str) -> str:
+        question = prompt.rsplit("Question:", 1)[-1].rsplit("SQLQuery:", 1)[0].strip()
+        store = re.search(r"store_id = (\d+)", prompt)
+        user = re.search(r"user_id = ([^`\s]+)`", prompt)
+        if _has(question, ORDER_WORDS) and user:
+            return (f"SELECT orders.id, orders.total, orders.status FROM orders "
+                    f"WHERE orders.user_id = {user.group(1)} ORDER BY orders.id DESC LIMIT 5")
+        order_by = "price DESC" if _has(question, ["最貴"]) else "price"
+        return (f"SELECT full_name, price, stock FROM product_full_view "
+                f"WHERE store_id = {store.group(1) if store else 1} ORDER BY {order_by} LIMIT 5")
+
+    def synthesize(self, sql_response: str) -> str:
+        return f"查詢結果如下：{sql_response.strip()[:200]}"
+
+    def docs_answer(self, prompt: str) -> str:
+        context = prompt.split("---------------------")[1].strip() if "---------------------" in prompt else ""
+        return f"依據商店政策：{context.replace(chr(10), ' ')[:160]}"
+
+
+class MockLLMServer(ThreadingHTTPServer):
+    daemon_threads = True
+    handler_class = None   # 子類別可換成自己的 handler（例如測試用的錯誤注入）
+
+    def __init__(self, address: Tuple[str, int], ttft_ms: float = 300, tokens_per_sec: float = 80):
+        super().__init__(address, self.handler_class or MockLLMHandler)
+        self.ttft = ttft_ms / 1000
+        self.token_delay = 1 / tokens_per_sec if tokens_per_sec > 0 else 0.0
+        self.replies = ScriptedReplies()
+        self.calls: Counter = Counter()
+        self._lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def count(self, kind: str) -> None:
+        with self._lock:
+            self.calls[kind] += 1
+
+
+class MockLLMHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: MockLLMServer
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status: int, payload: Dict) -> None:
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path.rstrip("/").endswith("/models"):
+            self._send_json(200, {"object": "list", "data": [{"id": MOCK_MODEL, "object": "model"}]})
+        else:
+            self._send_json(404, {"error": {"message": "not found"}})
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        try:
+            body = json.loads(self.rfile.read(length) or b"{}")
+        except ValueError:
+            self._send_json(400, {"error": {"message": "invalid JSON"}})
+            return
+        if self.path.rstrip("/").endswith("/chat/completions"):
+            messages = body.get("messages") or []
+        elif self.path.rstrip("/").endswith("/completions"):
+            messages = [{"role": "user", "content": body.get("prompt") or ""}]
+        else:
+            self._send_json(404, {"error": {"message": "not found"}})
+            return
+
+        kind, text = self.server.replies.reply(messages)
+        self.server.count(kind)
+        prompt_tokens = _tokens("".join(str(m.get("content") or "") for m in messages))
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": _tokens(text),
+                 "total_tokens": prompt_tokens + _tokens(text)}
+        model = body.get("model") or MOCK_MODEL
+        if body.get("stream"):
+            self._stream(text, usage, model)
+        else:
+            time.sleep(self.server.ttft + self.server.token_delay * usage["completion_tokens"])
+            self._send_json(200, {
+                "id": "mock-completion", "object": "chat.completion", "created": int(time.time()), "model": model,
+                "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": text}}],
+                "usage": usage,
+            })
+
+    def _stream(self, text: str, usage: Dict, model: str) -> None:
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+
+        def event(delta: Dict, finish: Optional[str] = None, extra: Optional[Dict] = None) -> None:
+            chunk = {"id": "mock-completion", "object": "chat.completion.chunk", "created": int(time.time()),
+                     "model": model, "choices": [{"index": 0, "delta": delta, "finish_reason": finish}]}
+            chunk.update(extra or {})
+            self.wfile.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+
+        time.sleep(self.server.ttft)
+        event({"role": "assistant", "content": ""})
+        for i in range(0, len(text), CHARS_PER_TOKEN):
+            event({"content": text[i:i + CHARS_PER_TOKEN]})
+            if self.server.token_delay:
+                time.sleep(self.server.token_delay)
+        event({}, finish="stop", extra={"usage": usage})
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+
+
+def start_mock_llm(host: str = "127.0.0.1", port: int = 0, ttft_ms: float = 300,
+                   tokens_per_sec: float = 80) -> MockLLMServer:
+    """在背景 thread 啟動 mock LLM；port=0 時自動選用空閒的 port"""
+    server = MockLLMServer((host, port), ttft_ms=ttft_ms, tokens_per_sec=tokens_per_sec)
+    threading.Thread(target=server.serve_forever, name="mock-llm", daemon=True).start()
+    return server
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Deterministic OpenAI-compatible mock LLM")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8808)
+    parser.add_argument("--ttft-ms", type=float, default=300, help="Delay before the first token")
+    parser.add_argument("--tokens-per-sec", type=float, default=80, help="Streaming speed; 0 = no delay")
+    args = parser.parse_args(argv)
+
+    server = MockLLMServer((args.host, args.port), ttft_ms=args.ttft_ms, tokens_per_sec=args.tokens_per_sec)
+    print(f"🤖 Mock LLM listening on {server.url} (ttft {args.ttft_ms:g} ms, {args.tokens_per_sec:g} tokens/s)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(f"Calls: {dict(server.calls)}")
+
+
+if __name__ == "__main__":
+    main()
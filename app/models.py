@@ -3,17 +3,20 @@ import os
 import json
 import random
 import enum
+import sqlite3
+import weakref
 from sqlalchemy import (
     create_engine, Column, Integer, String, Float, ForeignKey, Text,
-    DateTime, Boolean, Enum, Date
+    DateTime, Boolean, Enum, Date, Index
 )
 from sqlalchemy.orm import declarative_base, relationship, sessionmaker, scoped_session
 from sqlalchemy.engine import Engine
 from sqlalchemy.sql import func
 from datetime import date
-from llama_index.core import SQLDatabase
 from sqlalchemy import event, DDL, text
 from werkzeug.security import generate_password_hash
+
+from .search import register_sqlite_functions, ensure_product_search_index
 # =========================
 # SQLAlchemy Base
 # =========================
@@ -22,16 +25,46 @@ Base = declarative_base()
 DB_PATH = os.environ.get("APP_DB_PATH", os.path.join(os.getcwd(), "storage", "app.db"))
 DB_URI = f"sqlite:///{DB_PATH}"
 
-SessionLocal = None  # will be initialized in get_engine
+_engines = weakref.WeakSet()  # 所有建立過的 engine，fork 後需要丟棄繼承來的連線
+_default_engine = None
+
+
+class _LazySessionmaker(sessionmaker):
+    """第一次建立 session 時才建立 engine，import models 不會連線或建立檔案"""
+
+    def __call__(self, **local_kw):
+        if self.kw.get("bind") is None:
+            self.configure(bind=get_default_engine())
+        return super().__call__(**local_kw)
+
+
+SessionLocal = _LazySessionmaker(autoflush=False, autocommit=False, future=True)  # 綁定最近一次 get_engine 的 engine
 
 def get_engine(echo: bool = False) -> Engine:
     os.makedirs(os.path.dirname(DB_PATH), exist_ok=True)
     engine = create_engine(DB_URI, echo=echo, future=True)
-    global SessionLocal
-    SessionLocal = sessionmaker(bind=engine, autoflush=False, autocommit=False, future=True)
+    _engines.add(engine)
+    SessionLocal.configure(bind=engine)
     return engine
 
-Session = scoped_session(sessionmaker(bind=get_engine()))
+def get_default_engine() -> Engine:
+    global _default_engine
+    if _default_engine is None:
+        _default_engine = get_engine()
+    return _default_engine
+
+def dispose_engines() -> None:
+    """pre-fork server 的子 process 啟動時呼叫：不關閉父 process 的連線，只讓連線池重新連線"""
+    for engine in list(_engines):
+        engine.dispose(close=False)
+
+@event.listens_for(Engine, "connect")
+def _register_sqlite_functions(dbapi_connection, connection_record):
+    # FTS5 trigger 需要的自訂函式，每條 SQLite 連線都要註冊
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        register_sqlite_functions(dbapi_connection)
+
+Session = scoped_session(_LazySessionmaker())
 Base.query = Session.query_property()
 # =========================
 # Enums（保留原列舉）
@@ -214,7 +247,7 @@ class Product(Base, TimestampMixin):
     __tablename__ = "products"
 
     id = Column(Integer, primary_key=True, comment="商品唯一 ID", key="id")
-    store_id = Column(Integer, ForeignKey("stores.id"), nullable=False, comment="商店 ID", key="store_id")
+    store_id = Column(Integer, ForeignKey("stores.id"), nullable=False, index=True, comment="商店 ID", key="store_id")
     catalog = Column(String(100), nullable=False, comment="商品分類", key="catalog")
     name = Column(String(255), nullable=False, comment="商品名稱", key="name")
     descriptions = Column(Text, nullable=True, comment="商品簡介", key="descriptions")
@@ -230,7 +263,7 @@ class ProductItem(Base, TimestampMixin):
     __tablename__ = "product_items"
 
     id = Column(Integer, primary_key=True, comment="商品細項唯一 ID", key="id")
-    product_id = Column(Integer, ForeignKey("products.id"), nullable=False, comment="商品 ID", key="product_id")
+    product_id = Column(Integer, ForeignKey("products.id"), nullable=False, index=True, comment="商品 ID", key="product_id")
     name = Column(String(255), nullable=False, comment="商品細項名稱", key="name")
     price = Column(Integer, nullable=False, comment="商品細項價格", key="price")
     stock = Column(Integer, nullable=False, comment="商品細項庫存數量", key="stock")
@@ -263,12 +296,48 @@ class ChatMessage(Base, TimestampMixin):
 
     session = relationship("ChatSession", back_populates="messages")
 
+# --- Agent memory (LlamaIndex chat store) ---
+class ChatStoreMessage(Base):
+    __tablename__ = "chat_store_messages"
+    __table_args__ = (Index("ix_chat_store_messages_key_id", "chat_store_key", "id"),)
+
+    id = Column(Integer, primary_key=True, autoincrement=True, comment="訊息唯一 ID（遞增，代表順序）", key="id")
+    chat_store_key = Column(String(255), nullable=False, comment="記憶範圍（使用者 ID）", key="chat_store_key")
+    role = Column(String(20), nullable=False, comment="訊息角色", key="role")
+    payload = Column(Text, nullable=False, comment="ChatMessage JSON", key="payload")
+    created_at = Column(DateTime, server_default=func.now(), nullable=False, comment="建立時間（自動）", key="created_at")
+
+class ChatStoreSummary(Base):
+    """摘要記憶的舊對話摘要；與 chat_store_messages 分開，get_keys() 只會列出對話"""
+    __tablename__ = "chat_store_summaries"
+
+    chat_store_key = Column(String(255), primary_key=True, comment="記憶範圍（使用者 ID）", key="chat_store_key")
+    summary = Column(Text, nullable=False, comment="摘要內容", key="summary")
+    updated_at = Column(DateTime, server_default=func.now(), onupdate=func.now(), nullable=False, comment="更新時間（自動）", key="updated_at")
+
+class ChatToolChoice(Base):
+    """每輪對話 agent 第一個呼叫的工具，作為意圖分類器的訓練資料；不受記憶摘要與修剪影響"""
+    __tablename__ = "chat_tool_choices"
+
+    id = Column(Integer, primary_key=True, autoincrement=True, comment="唯一 ID（遞增）", key="id")
+    chat_store_key = Column(String(255), nullable=False, comment="記憶範圍（使用者 ID）", key="chat_store_key")
+    user_message = Column(Text, nullable=False, comment="使用者訊息", key="user_message")
+    tool_name = Column(String(64), nullable=False, comment="第一個呼叫的工具", key="tool_name")
+    created_at = Column(DateTime, server_default=func.now(), nullable=False, comment="建立時間（自動）", key="created_at")
+
+class LineWebhookEvent(Base):
+    """已處理的 LINE webhookEventId，用來吸收 LINE 的重送（多個 worker process 共用）"""
+    __tablename__ = "line_webhook_events"
+
+    webhook_event_id = Column(String(64), primary_key=True, comment="LINE webhookEventId", key="webhook_event_id")
+    received_at = Column(DateTime, server_default=func.now(), nullable=False, index=True, comment="收到時間（自動）", key="received_at")
+
 class Order(Base, TimestampMixin):
     __tablename__ = "orders"
 
     id = Column(Integer, primary_key=True, comment="訂單唯一 ID", key="id")
     store_id = Column(Integer, ForeignKey("stores.id"), nullable=False, comment="商店 ID", key="store_id")
-    user_id = Column(Integer, ForeignKey("users.id"), nullable=False, comment="使用者 ID", key="user_id")
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False, index=True, comment="使用者 ID", key="user_id")
     total = Column(Integer, nullable=False, comment="訂單總金額", key="total")
     status = Column(Enum(OrderStatus), nullable=False, default=OrderStatus.PENDING, comment="訂單狀態", key="status")
     remark = Column(Text, nullable=True, comment="訂單備註", key="remark")
@@ -287,7 +356,7 @@ class OrderItem(Base, TimestampMixin):
     __tablename__ = "order_items"
 
     id = Column(Integer, primary_key=True, comment="訂單項目唯一 ID", key="id")
-    order_id = Column(Integer, ForeignKey("orders.id"), nullable=False, comment="訂單 ID", key="order_id")
+    order_id = Column(Integer, ForeignKey("orders.id"), nullable=False, index=True, comment="訂單 ID", key="order_id")
     product_item_id = Column(Integer, ForeignKey("product_items.id"), nullable=False, comment="訂單細項 ID", key="product_item_id")
     quantity = Column(Integer, nullable=False, comment="商品購買數量", key="quantity")
 
@@ -394,6 +463,11 @@ def init_db(seed: bool = True, echo: bool = False) -> None:
         except Exception:
             pass
     Base.metadata.create_all(engine)
+    # create_all 不會替已存在的表補索引；SQL guard 的範圍 CTE 依賴這些索引，舊資料庫也要建立
+    for table in (Order.__table__, OrderItem.__table__, Product.__table__, ProductItem.__table__):
+        for index in table.indexes:
+            index.create(engine, checkfirst=True)
+    ensure_product_search_index(engine)
 
     if not seed:
         return
@@ -694,7 +768,9 @@ def init_db(seed: bool = True, echo: bool = False) -> None:
         session.commit()
 
 def get_sql_database():
-    if SQLDatabase is None:
+    try:
+        from llama_index.core import SQLDatabase
+    except ImportError:
         raise RuntimeError("LlamaIndex is not installed")
     engine = get_engine()
     # 將所有表都包含進去
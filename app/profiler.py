@@ -0,0 +1,231 @@
+"""
+管理員限定的單一請求 profiler
+
+已登入的管理員在請求加上 `X-Profile: 1` header 或 `?_profile=1`，該請求就會在 profiler 下執行：
+
+    sample（預設）  背景 thread 每 APP_PROFILER_INTERVAL_MS 取樣一次請求 thread 的 call stack，
+                    輸出 folded stacks（flamegraph.pl、speedscope 可直接開啟）
+    cprofile        `X-Profile: cprofile`，決定性的 cProfile，輸出 .pstats（snakeviz、flameprof）
+
+結果依路由存到 storage/profiles/<路由>/，回應帶 X-Profile-Path，從 /admin/profiles 下載；
+每個路由只保留最新 APP_PROFILER_KEEP 份。沒有帶旗標的請求只多一次 header / query string 檢查。
+每個 process 每分鐘最多 APP_PROFILER_MAX_PER_MINUTE 次，同時只跑一個；超過時請求照常執行，回應帶 X-Profile: rate-limited。
+串流回應（例如 /chat/stream 的 SSE）在 view 回傳後才產生內容，量到的只是建立 generator，
+因此不儲存，回應帶 X-Profile: unsupported。
+"""
+
+import cProfile
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter, deque
+from typing import Callable, Deque, Dict, List, Optional
+
+from flask import g, request
+
+PROFILE_HEADER = "X-Profile"
+PROFILE_ARG = "_profile"
+PROFILE_DIR = os.environ.get("APP_PROFILE_DIR", os.path.join(os.getcwd(), "storage", "profiles"))
+PROFILER_ENABLED = os.environ.get("APP_PROFILER", "1") != "0"
+MAX_PER_MINUTE = int(os.environ.get("APP_PROFILER_MAX_PER_MINUTE", "6"))
+SAMPLE_INTERVAL = float(os.environ.get("APP_PROFILER_INTERVAL_MS", "2")) / 1000
+KEEP_PER_ROUTE = int(os.environ.get("APP_PROFILER_KEEP", "20"))
+
+_ROUTE_SLUG = re.compile(r"[^A-Za-z0-9_.-]+")
+
+
+def route_slug(rule: str) -> str:
+    """/admin/orders/<int:order_id> -> admin_orders_int_order_id"""
+    return _ROUTE_SLUG.sub("_", rule).strip("_") or "root"
+
+
+class RateLimiter:
+    """滑動視窗：60 秒內最多 limit 次，且同時只允許一個"""
+
+    def __init__(self, limit: int, window: float = 60.0):
+        self.limit = limit
+        self.window = window
+        self._started: Deque[float] = deque()
+        self._running = False
+        self._lock = threading.Lock()
+
+    def acquire(self) -> bool:
+        now = time.monotonic()
+        with self._lock:
+            while self._started and now - self._started[0] > self.window:
+                self._started.popleft()
+            if self._running or len(self._started) >= self.limit:
+                return False
+            self._started.append(now)
+            self._running = True
+            return True
+
+    def release(self) -> None:
+        with self._lock:
+            self._running = False
+
+
+# =========================
+# Profilers
+# =========================
+
+class SamplingProfiler:
+    """在背景 thread 定期讀取目標 thread 的 frame，累計 folded stacks"""
+
+    suffix = ".folded"
+
+    def __init__(self, interval: float = SAMPLE_INTERVAL):
+        self.interval = interval
+        self.stacks: Counter = Counter()
+        self.samples = 0
+        self._target = threading.get_ident()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="request-profiler", daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._thread.join()
+
+    @staticmethod
+    def _label(frame) -> str:
+        code = frame.f_code
+        module = frame.f_globals.get("__name__") or os.path.basename(code.co_filename)
+        return f"{module}:{code.co_name}:{code.co_firstlineno}"
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self._target)
+            stack: List[str] = []
+            while frame is not None:
+                stack.append(self._label(frame))
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+                self.samples += 1
+
+    def dump(self, path: str) -> None:
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+class DeterministicProfiler:
+    """cProfile 只量測呼叫 enable() 的 thread，也就是處理這個請求的 thread"""
+
+    suffix = ".pstats"
+
+    def __init__(self):
+        self.profile = cProfile.Profile()
+
+    def start(self) -> None:
+        self.profile.enable()
+
+    def stop(self) -> None:
+        self.profile.disable()
+
+    def dump(self, path: str) -> None:
+        self.profile.dump_stats(path)
+
+
+PROFILERS = {"1": SamplingProfiler, "sample": SamplingProfiler, "cprofile": DeterministicProfiler}
+
+
+# =========================
+# 儲存
+# =========================
+
+def _prune(directory: str, keep: int) -> None:
+    files = sorted(os.listdir(directory))
+    for name in files[:max(0, len(files) - keep)]:
+        os.remove(os.path.join(directory, name))
+
+
+def save_profile(profiler, rule: str, method: str, seconds: float) -> str:
+    """寫到 <PROFILE_DIR>/<路由>/<時間>-<method>-<毫秒><副檔名>，回傳相對於 PROFILE_DIR 的路徑"""
+    slug = route_slug(rule)
+    directory = os.path.join(PROFILE_DIR, slug)
+    os.makedirs(directory, exist_ok=True)
+    name = f"{time.strftime('%Y%m%d-%H%M%S')}-{int(time.time() * 1000) % 1000:03d}-{method}-{seconds * 1000:.0f}ms{profiler.suffix}"
+    profiler.dump(os.path.join(directory, name))
+    _prune(directory, KEEP_PER_ROUTE)
+    return f"{slug}/{name}"
+
+
+def list_profiles() -> List[Dict]:
+    """依路由列出已儲存的 profile，新的在前"""
+    if not os.path.isdir(PROFILE_DIR):
+        return []
+    profiles = []
+    for slug in sorted(os.listdir(PROFILE_DIR)):
+        directory = os.path.join(PROFILE_DIR, slug)
+        if not os.path.isdir(directory):
+            continue
+        for name in sorted(os.listdir(directory), reverse=True):
+            stat = os.stat(os.path.join(directory, name))
+            profiles.append({"route": slug, "path": f"{slug}/{name}", "bytes": stat.st_size,
+                             "created_at": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(stat.st_mtime))})
+    return profiles
+
+
+# =========================
+# Flask
+# =========================
+
+def _requested_mode() -> Optional[str]:
+    mode = request.headers.get(PROFILE_HEADER)
+    # 先比對原始 query string，沒有旗標的請求不需要解析 request.args
+    if mode is None and PROFILE_ARG.encode() in request.query_string:
+        mode = request.args.get(PROFILE_ARG)
+    return mode.lower() if mode else None
+
+
+def instrument_profiler(app, is_admin: Callable[[], bool], enabled: bool = PROFILER_ENABLED) -> None:
+    """is_admin 在請求內呼叫，判斷目前登入者能否 profile；權限應與下載 profile 的頁面一致"""
+    if not enabled:
+        return
+    limiter = RateLimiter(MAX_PER_MINUTE)
+
+    @app.before_request
+    def _profile_start():
+        mode = _requested_mode()
+        if mode not in PROFILERS or not is_admin():
+            return
+        if not limiter.acquire():
+            g._profile_status = "rate-limited"
+            return
+        profiler = PROFILERS[mode]()
+        g._profiler = (profiler, time.perf_counter())
+        profiler.start()
+
+    @app.after_request
+    def _profile_save(response):
+        status = g.pop("_profile_status", None)
+        if status:
+            response.headers[PROFILE_HEADER] = status
+        active = g.pop("_profiler", None)
+        if active is None:
+            return response
+        profiler, started = active
+        try:
+            profiler.stop()
+            if response.is_streamed:
+                response.headers[PROFILE_HEADER] = "unsupported"
+                return response
+            rule = request.url_rule.rule if request.url_rule is not None else "<unmatched>"
+            response.headers["X-Profile-Path"] = save_profile(profiler, rule, request.method, time.perf_counter() - started)
+        finally:
+            limiter.release()
+        return response
+
+    @app.teardown_request
+    def _profile_abort(exc=None):
+        # after_request 沒有執行時（例如回應前斷線）也要停下 profiler 並釋放名額
+        active = g.pop("_profiler", None)
+        if active is not None:
+            active[0].stop()
+            limiter.release()
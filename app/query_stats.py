@@ -0,0 +1,351 @@
+"""
+每個請求的 SQL 查詢統計與 N+1 偵測（預設關閉）
+
+    APP_SQL_INSTRUMENT=1       計數與計時、回傳 Server-Timing header、把可疑請求寫入報告
+    APP_SQL_INSTRUMENT=strict  另外讓超過查詢預算的請求回傳 500（測試 / CI 用）
+    python -m app.query_stats --db storage/app.db      逐一請求主要頁面，任何路由超過預算或不是 2xx 時 exit 1
+
+以 SQLAlchemy 的 before/after_cursor_execute 計時，統計放在 ContextVar，只記錄請求範圍內的查詢；
+沒有開啟時不掛任何事件，對請求沒有額外開銷。字面值與 IN 清單正規化後形狀相同的語句，
+在同一個請求中出現 APP_SQL_NPLUS1_THRESHOLD 次以上視為 N+1，報告中附上第一次觸發的程式位置；
+IN 清單帶多個參數的語句（selectinload 分批載入）不算在內。
+"""
+
+import argparse
+import json
+import logging
+import os
+import re
+import sqlite3
+import sys
+import time
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from functools import lru_cache, wraps
+from typing import Any, Callable, Dict, List, Optional
+
+from flask import g, jsonify, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from .logfiles import open_process_log
+
+SQL_INSTRUMENT = os.environ.get("APP_SQL_INSTRUMENT", "").lower()
+NPLUS1_THRESHOLD = int(os.environ.get("APP_SQL_NPLUS1_THRESHOLD", "5"))
+DEFAULT_QUERY_BUDGET = int(os.environ.get("APP_SQL_QUERY_BUDGET", "30"))
+# 每個 process 寫 sql_report.<pid>.jsonl（見 logfiles）
+SQL_REPORT_PATH = os.environ.get("APP_SQL_REPORT", os.path.join(os.getcwd(), "storage", "logs", "sql_report.jsonl"))
+SQL_REPORT_MAX_BYTES = 5 * 1024 * 1024
+SQL_REPORT_BACKUPS = 3
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r"\b\d+(?:\.\d+)?\b")
+_IN_LIST = re.compile(r"\bIN\s*\((?:\s*\?\s*,)*\s*\?\s*\)", re.IGNORECASE)
+_SPACES = re.compile(r"\s+")
+
+
+class QueryBudgetExceeded(RuntimeError):
+    pass
+
+
+@lru_cache(maxsize=4096)
+def statement_shape(statement: str) -> str:
+    """去掉字面值、把 IN (?, ?, ...) 合併，讓只差參數的語句視為同一形狀"""
+    shape = _STRING.sub("?", statement)
+    shape = _NUMBER.sub("?", shape)
+    shape = _SPACES.sub(" ", shape).strip()
+    return _IN_LIST.sub("IN (?...)", shape)
+
+
+@lru_cache(maxsize=4096)
+def is_batched(statement: str) -> bool:
+    """IN 清單有兩個以上參數：一次載入多筆的批次查詢（例如 selectinload 每 500 筆一批），不是 N+1"""
+    return any(match.group().count("?") > 1 for match in _IN_LIST.finditer(statement))
+
+
+def _caller() -> Optional[str]:
+    """第一個位於 app/ 內、不是本模組的 frame"""
+    frame = sys._getframe(2)
+    while frame is not None:
+        filename = frame.f_code.co_filename
+        if filename.startswith(APP_DIR) and filename != __file__:
+            lineno = frame.f_lineno
+            template = frame.f_globals.get("__jinja_template__")
+            if template is not None:
+                # 編譯後的模板行號換回 .html 內的行號
+                lineno = template.get_corresponding_lineno(lineno)
+            return f"{os.path.relpath(filename, os.path.dirname(APP_DIR))}:{lineno} in {frame.f_code.co_name}"
+        frame = frame.f_back
+    return None
+
+
+@dataclass
+class ShapeStats:
+    count: int = 0
+    batched: int = 0
+    ms: float = 0.0
+    location: Optional[str] = None
+
+
+@dataclass
+class RequestQueries:
+    count: int = 0
+    ms: float = 0.0
+    shapes: Dict[str, ShapeStats] = field(default_factory=dict)
+
+    def record(self, statement: str, ms: float) -> None:
+        self.count += 1
+        self.ms += ms
+        shape = statement_shape(statement)
+        stats = self.shapes.get(shape)
+        if stats is None:
+            stats = self.shapes[shape] = ShapeStats(location=_caller())
+        stats.count += 1
+        stats.batched += is_batched(statement)
+        stats.ms += ms
+
+    def repeated(self, threshold: int = NPLUS1_THRESHOLD) -> List[Dict[str, Any]]:
+        offenders = [(shape, s) for shape, s in self.shapes.items() if s.count - s.batched >= threshold]
+        offenders.sort(key=lambda item: item[1].count - item[1].batched, reverse=True)
+        return [{"shape": shape, "count": s.count - s.batched, "ms": round(s.ms, 2), "location": s.location}
+                for shape, s in offenders]
+
+    def server_timing(self) -> str:
+        return f'db;dur={self.ms:.1f};desc="{self.count} queries"'
+
+
+_current: ContextVar[Optional[RequestQueries]] = ContextVar("request_queries", default=None)
+
+
+def current_queries() -> Optional[RequestQueries]:
+    return _current.get()
+
+
+# =========================
+# SQLAlchemy 事件
+# =========================
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _current.get() is not None:
+        conn.info.setdefault("query_stats_started", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = _current.get()
+    started = conn.info.get("query_stats_started")
+    if stats is None or not started:
+        return
+    stats.record(statement, (time.perf_counter() - started.pop()) * 1000)
+
+
+@lru_cache(maxsize=1)
+def install() -> None:
+    """掛在 Engine 類別上，之後建立的 engine 也會套用；只會掛一次"""
+    event.listen(Engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(Engine, "after_cursor_execute", _after_cursor_execute)
+
+
+# =========================
+# 報告
+# =========================
+
+@lru_cache(maxsize=1)
+def _report_logger(pid: int) -> logging.Logger:
+    # 以 pid 為快取鍵：fork 出的 worker 第一次寫入時換成自己的檔案
+    return open_process_log("app.query_stats", SQL_REPORT_PATH, SQL_REPORT_MAX_BYTES, SQL_REPORT_BACKUPS)
+
+
+def query_budget(limit: int):
+    """設定路由的查詢預算（預設 APP_SQL_QUERY_BUDGET）；放在 @app.route 之下"""
+    def decorator(f):
+        f.query_budget = limit
+        return f
+    return decorator
+
+
+def budget_for(view: Optional[Callable]) -> int:
+    return getattr(view, "query_budget", DEFAULT_QUERY_BUDGET)
+
+
+# 每個請求結束時呼叫 listener(endpoint, summary)，query_stats 指令用來收集結果
+_listeners: List[Callable[[str, Dict[str, Any]], None]] = []
+
+
+def add_listener(listener: Callable[[str, Dict[str, Any]], None]) -> None:
+    _listeners.append(listener)
+
+
+def instrument_queries(app, mode: str = SQL_INSTRUMENT) -> None:
+    """mode 為空字串時不做任何事"""
+    if not mode:
+        return
+    install()
+    strict = mode == "strict"
+
+    @app.before_request
+    def _queries_start():
+        g._queries_token = _current.set(RequestQueries())
+
+    @app.after_request
+    def _queries_report(response):
+        stats = _current.get()
+        if stats is None:
+            return response
+        endpoint = request.url_rule.rule if request.url_rule is not None else "<unmatched>"
+        budget = budget_for(app.view_functions.get(request.endpoint))
+        repeated = stats.repeated()
+        summary = {
+            "time": time.time(), "method": request.method, "path": request.path, "endpoint": endpoint,
+            "status": response.status_code, "queries": stats.count, "db_ms": round(stats.ms, 2),
+            "budget": budget, "over_budget": stats.count > budget, "nplus1": repeated,
+        }
+        for listener in _listeners:
+            listener(endpoint, summary)
+        if repeated or summary["over_budget"]:
+            _report_logger(os.getpid()).info(json.dumps(summary, ensure_ascii=False))
+        if strict and summary["over_budget"]:
+            message = f"{request.method} {endpoint} ran {stats.count} queries (budget {budget})"
+            response = jsonify({"error": "query budget exceeded", "detail": message, "nplus1": repeated})
+            response.status_code = 500
+        response.headers.add("Server-Timing", stats.server_timing())
+        return response
+
+    @app.teardown_request
+    def _queries_done(exc=None):
+        token = g.pop("_queries_token", None)
+        if token is not None:
+            _current.reset(token)
+
+
+# =========================
+# 查詢預算檢查（python -m app.query_stats）
+# =========================
+
+def _first(conn: sqlite3.Connection, sql: str) -> Any:
+    row = conn.execute(sql).fetchone()
+    return row[0] if row else None
+
+
+def _audit_sessions(db_path: str) -> Dict[str, Dict[str, Any]]:
+    """直接寫入 session，和 admin_login / user_login 設定的內容相同，不依賴帳號密碼"""
+    conn = sqlite3.connect(db_path)
+    try:
+        admin = conn.execute("SELECT admins.user_id, users.name, admins.store_id, admins.level FROM admins "
+                             "JOIN users ON users.id = admins.user_id ORDER BY admins.id LIMIT 1").fetchone()
+        user = conn.execute("SELECT users.id, users.name FROM users JOIN orders ON orders.user_id = users.id "
+                            "GROUP BY users.id ORDER BY COUNT(*) DESC LIMIT 1").fetchone()
+    finally:
+        conn.close()
+    sessions: Dict[str, Dict[str, Any]] = {"guest": {}}
+    if admin:
+        sessions["admin"] = {"user_id": admin[0], "user_type": "admin", "username": admin[1],
+                             "store_id": admin[2], "admin_level": admin[3]}
+    if user:
+        sessions["user"] = {"user_id": user[0], "user_type": "user", "username": user[1]}
+    return sessions
+
+
+def _audit_paths(db_path: str) -> List[tuple]:
+    """(身分, 路徑)；id 從資料庫挑一筆存在的資料"""
+    conn = sqlite3.connect(db_path)
+    try:
+        def first(sql: str) -> Any:
+            return _first(conn, sql)
+        order_id = first("SELECT id FROM orders WHERE store_id = 1 ORDER BY id DESC LIMIT 1")
+        user_id = first("SELECT user_id FROM orders WHERE store_id = 1 ORDER BY id DESC LIMIT 1")
+        product_id = first("SELECT id FROM products WHERE store_id = 1 ORDER BY id LIMIT 1")
+        chat_id = first("SELECT id FROM chat_sessions WHERE store_id = 1 ORDER BY id DESC LIMIT 1")
+        keyword = first("SELECT name FROM products WHERE store_id = 1 ORDER BY id LIMIT 1") or "商品"
+    finally:
+        conn.close()
+
+    paths = [
+        ("guest", "/"), ("guest", "/api/products"), ("guest", f"/api/search?q={keyword.split()[0]}"),
+        ("user", "/user/dashboard"),
+        ("admin", "/admin"), ("admin", "/admin/orders"), ("admin", "/admin/users"), ("admin", "/admin/products"),
+        ("admin", "/admin/coupons"), ("admin", "/admin/raw-pages"), ("admin", "/admin/customer-service"),
+        ("admin", "/api/stats"), ("admin", "/api/orders"), ("admin", "/api/users"),
+    ]
+    if order_id is not None:
+        paths += [("admin", f"/admin/orders/{order_id}"), ("admin", f"/api/orders/{order_id}")]
+    if user_id is not None:
+        paths += [("admin", f"/admin/users/{user_id}/details"), ("admin", f"/api/users/{user_id}")]
+    if product_id is not None:
+        paths += [("admin", f"/admin/products/{product_id}/items"), ("guest", f"/api/products/{product_id}")]
+    if chat_id is not None:
+        paths.append(("admin", f"/admin/customer-service/{chat_id}"))
+    return paths
+
+
+def parse_budget(value: str) -> tuple:
+    route, _, limit = value.rpartition("=")
+    if not route:
+        raise argparse.ArgumentTypeError("expected <route>=<queries>, e.g. /admin/orders=10")
+    return route, int(limit)
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Request every main page once and check per-route SQL query budgets")
+    parser.add_argument("--db", default=os.path.join("storage", "app.db"), help="Database to read (GET requests only)")
+    parser.add_argument("--budget", type=parse_budget, action="append", default=[],
+                        help="Override a route budget, e.g. --budget /admin/orders=10 (repeatable)")
+    parser.add_argument("--default-budget", type=int, default=None, help="Budget for routes without @query_budget")
+    parser.add_argument("--output", default=None, help="Write the per-route results as JSON")
+    args = parser.parse_args(argv)
+
+    # web_api 在 import 時讀取資料庫路徑
+    os.environ["APP_DB_PATH"] = os.path.abspath(args.db)
+    from .web_api import app
+
+    overrides = dict(args.budget)
+    default_budget = args.default_budget if args.default_budget is not None else DEFAULT_QUERY_BUDGET
+    results: List[Dict[str, Any]] = []
+    add_listener(lambda endpoint, summary: results.append(summary))
+    # 已經以 APP_SQL_INSTRUMENT 啟用時 web_api 已掛好 hook，不要重複掛
+    if not SQL_INSTRUMENT:
+        instrument_queries(app, mode="1")
+
+    clients = {}
+    for role, values in _audit_sessions(args.db).items():
+        clients[role] = app.test_client()
+        with clients[role].session_transaction() as sess:
+            sess.update(values)
+
+    failures = 0
+    print(f"{'route':<44} {'status':>6} {'queries':>8} {'budget':>7} {'db ms':>8}  N+1")
+    for role, path in _audit_paths(args.db):
+        if role not in clients:
+            print(f"  {path[:42]:<42} skipped: no {role} account in the database")
+            continue
+        results.clear()
+        response = clients[role].get(path)
+        if not results:
+            continue
+        summary = results[-1]
+        view = app.view_functions.get(app.url_map.bind("localhost").match(path.split("?")[0])[0])
+        budget = overrides.get(summary["endpoint"], budget_for(view) if hasattr(view, "query_budget") else default_budget)
+        over = summary["queries"] > budget
+        # 錯誤頁面的查詢數沒有意義，非 2xx 也算失敗
+        failed = over or not 200 <= response.status_code < 300
+        failures += failed
+        summary.update({"role": role, "budget": budget, "over_budget": over})
+        worst = summary["nplus1"][0] if summary["nplus1"] else None
+        nplus1 = f"{worst['count']}× {worst['location'] or ''}" if worst else ""
+        print(f"{'❌' if failed else '  '}{path[:42]:<42} {response.status_code:>6} {summary['queries']:>8} {budget:>7} "
+              f"{summary['db_ms']:>8.1f}  {nplus1}")
+        for offender in summary["nplus1"]:
+            print(f"      {offender['count']:>4}× {offender['shape'][:110]}")
+        if args.output:
+            with open(args.output, "a", encoding="utf-8") as f:
+                f.write(json.dumps(summary, ensure_ascii=False) + "\n")
+
+    if failures:
+        print(f"❌ {failures} route(s) over their query budget or not returning 2xx")
+        sys.exit(1)
+    print("✅ All routes returned 2xx within their query budget")
+
+
+if __name__ == "__main__":
+    main()
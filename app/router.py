@@ -0,0 +1,225 @@
+import asyncio
+import math
+import os
+import re
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple
+
+# 意圖 -> 直接呼叫的工具名稱
+INTENT_TOOLS = {
+    "product_lookup": "product_search_tool",
+    "order_status": "order_sql_tool",
+    "policy_question": "policy_docs_tool",
+}
+
+# 明確意圖的關鍵字規則
+KEYWORD_RULES: Dict[str, List[str]] = {
+    "product_lookup": ["價格", "多少錢", "庫存", "規格", "有什麼商品", "商品有哪些", "產品有什麼", "sku", "price", "stock"],
+    "order_status": ["我的訂單", "訂單狀態", "查詢訂單", "查訂單", "出貨了嗎", "物流", "order status", "my order"],
+    "policy_question": ["退貨", "退款", "換貨", "保固", "維修", "售後", "運費", "配送", "付款方式", "購買流程", "refund", "return policy", "warranty", "shipping"],
+}
+
+# 這些字眼代表需要多步驟（下單、補資料），一律交給 agent
+AGENT_ONLY_KEYWORDS = ["下單", "幫我買", "我要買", "我想買", "購買", "取消", "修改", "place order", "buy"]
+
+# 分類器的種子語句，會與歷史對話中挖出的語句一起訓練
+SEED_EXAMPLES: Dict[str, List[str]] = {
+    "product_lookup": [
+        "產品有什麼？",
+        "查詢 SKU-1002 的價格與庫存",
+        "這個商品還有貨嗎",
+        "有沒有推薦的電子產品",
+    ],
+    "order_status": [
+        "查詢 alice@example.com 的訂單",
+        "我最新一筆訂單的狀態",
+        "我的包裹寄出了沒",
+        "幫我看一下上次買的東西到哪了",
+    ],
+    "policy_question": [
+        "如何退貨？售後服務怎麼處理？",
+        "保固多久",
+        "運費怎麼計算",
+        "七天鑑賞期的規定是什麼",
+    ],
+}
+
+AGENT_ONLY = "agent"
+# 所有關鍵字 -> 意圖（AGENT_ONLY 代表交給 agent）；由長到短比對，「購買流程」不會被「購買」搶先
+KEYWORD_INTENTS: Dict[str, str] = {w: AGENT_ONLY for w in AGENT_ONLY_KEYWORDS}
+KEYWORD_INTENTS.update({w: intent for intent, words in KEYWORD_RULES.items() for w in words})
+KEYWORD_PATTERN = re.compile("|".join(re.escape(w) for w in sorted(KEYWORD_INTENTS, key=len, reverse=True)))
+
+# 路由到商品搜尋時，去掉意圖關鍵字與口語贅詞，剩下的當作搜尋關鍵字
+SEARCH_FILLERS = re.compile(r"請問|想問|幫我|查詢|查一下|看看|有沒有|有什麼|有哪些|哪些|多少|什麼|還有|目前|這個|一下|[的嗎呢吧了是與和跟及]|[^\w]+")
+
+EMBED_THRESHOLD = float(os.environ.get("APP_ROUTER_THRESHOLD", "0.75"))
+EMBED_MARGIN = float(os.environ.get("APP_ROUTER_MARGIN", "0.05"))
+
+
+@dataclass
+class Route:
+    intent: str
+    tool_name: str
+    confidence: float
+    source: str  # "keyword" or "embedding"
+
+
+def search_terms(text: str) -> str:
+    """從使用者句子取出商品搜尋關鍵字；沒有剩下任何字時回傳空字串"""
+    text = KEYWORD_PATTERN.sub(" ", text.lower())
+    return " ".join(SEARCH_FILLERS.sub(" ", text).split())
+
+
+def _cosine(a: List[float], b: List[float]) -> float:
+    dot = sum(x * y for x, y in zip(a, b))
+    na = math.sqrt(sum(x * x for x in a))
+    nb = math.sqrt(sum(y * y for y in b))
+    if na == 0 or nb == 0:
+        return 0.0
+    return dot / (na * nb)
+
+
+def load_logged_examples() -> Dict[str, List[str]]:
+    """以 agent 每輪記錄的「使用者訊息 → 第一個呼叫的工具」作為訓練資料。
+    記憶中的回答會去掉 Action 軌跡（摘要模式），所以不從對話內容推回工具"""
+    from .chat_store import get_chat_store
+
+    examples: Dict[str, List[str]] = {intent: [] for intent in INTENT_TOOLS}
+    tool_intents = {tool: intent for intent, tool in INTENT_TOOLS.items()}
+    for text, tool_name in get_chat_store().get_tool_choices():
+        intent = tool_intents.get(tool_name)
+        if intent and text:
+            examples[intent].append(text)
+    return examples
+
+
+class EmbeddingIntentClassifier:
+    """Nearest-centroid 分類器，用本地 embedding 模型，不需呼叫 LLM"""
+
+    def __init__(self, embed_model, examples: Dict[str, List[str]]):
+        self.embed_model = embed_model
+        self.centroids: Dict[str, List[float]] = {}
+        for intent, texts in examples.items():
+            if not texts:
+                continue
+            vectors = embed_model.get_text_embedding_batch(texts)
+            dim = len(vectors[0])
+            self.centroids[intent] = [sum(v[i] for v in vectors) / len(vectors) for i in range(dim)]
+
+    def classify(self, text: str) -> Optional[Tuple[str, float, float]]:
+        """回傳 (intent, 最高相似度, 與第二名的差距)"""
+        if not self.centroids:
+            return None
+        vector = self.embed_model.get_query_embedding(text)
+        scores = sorted(((_cosine(vector, c), intent) for intent, c in self.centroids.items()), reverse=True)
+        best_score, best_intent = scores[0]
+        margin = best_score - scores[1][0] if len(scores) > 1 else best_score
+        return best_intent, best_score, margin
+
+
+@lru_cache(maxsize=1)
+def get_intent_classifier() -> Optional[EmbeddingIntentClassifier]:
+    """每個 process 只訓練一次；沒有 embedding 模型時停用分類器"""
+    from llama_index.core import Settings
+
+    embed_model = Settings.embed_model
+    if embed_model is None:
+        return None
+    examples = {intent: list(texts) for intent, texts in SEED_EXAMPLES.items()}
+    for intent, texts in load_logged_examples().items():
+        examples[intent].extend(texts)
+    return EmbeddingIntentClassifier(embed_model, examples)
+
+
+_warmup: Optional[Future] = None
+_warmup_lock = threading.Lock()
+
+
+def warm_intent_classifier() -> Future:
+    """在背景 thread 訓練分類器（讀取整個 chat store 並計算 embedding），只啟動一次"""
+    global _warmup
+    with _warmup_lock:
+        if _warmup is None:
+            executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="router-warmup")
+            _warmup = executor.submit(get_intent_classifier)
+            executor.shutdown(wait=False)
+        return _warmup
+
+
+def ready_intent_classifier() -> Optional[EmbeddingIntentClassifier]:
+    """已訓練好的分類器；還在訓練或訓練失敗時回傳 None，不等待"""
+    warmup = warm_intent_classifier()
+    if not warmup.done() or warmup.exception() is not None:
+        return None
+    return warmup.result()
+
+
+class IntentRouter:
+    """在 ReAct 迴圈之前先判斷意圖，明確的問題直接交給對應工具"""
+
+    def __init__(self, classifier: Optional[EmbeddingIntentClassifier] = None,
+                 threshold: float = EMBED_THRESHOLD, margin: float = EMBED_MARGIN):
+        self._classifier = classifier
+        self.threshold = threshold
+        self.margin = margin
+
+    @property
+    def classifier(self) -> Optional[EmbeddingIntentClassifier]:
+        if self._classifier is None:
+            self._classifier = get_intent_classifier()
+        return self._classifier
+
+    def keyword_intents(self, text: str) -> List[str]:
+        """比對到的意圖；含 AGENT_ONLY 表示需要多步驟處理"""
+        intents = []
+        for match in KEYWORD_PATTERN.finditer(text.lower()):
+            intent = KEYWORD_INTENTS[match.group()]
+            if intent not in intents:
+                intents.append(intent)
+        return intents
+
+    def keyword_route(self, text: str) -> Tuple[Optional[Route], Optional[List[str]]]:
+        """只用關鍵字判斷：(Route, None) 已決定、(None, None) 交給 agent、(None, 候選意圖) 需要分類器"""
+        candidates = self.keyword_intents(text)
+        if AGENT_ONLY in candidates:
+            return None, None
+        if len(candidates) == 1:
+            intent = candidates[0]
+            return Route(intent=intent, tool_name=INTENT_TOOLS[intent], confidence=1.0, source="keyword"), None
+        return None, candidates
+
+    def embedding_route(self, classifier: EmbeddingIntentClassifier, text: str, candidates: List[str]) -> Optional[Route]:
+        result = classifier.classify(text)
+        if result is None:
+            return None
+        intent, score, margin = result
+        # 關鍵字有多個候選時，分類器結果必須落在候選之中
+        if candidates and intent not in candidates:
+            return None
+        if score < self.threshold or margin < self.margin:
+            return None
+        return Route(intent=intent, tool_name=INTENT_TOOLS[intent], confidence=score, source="embedding")
+
+    def route(self, text: str) -> Optional[Route]:
+        """回傳 Route；不確定時回傳 None，由 agent 處理"""
+        route, candidates = self.keyword_route(text)
+        if candidates is None:
+            return route
+        classifier = self.classifier
+        if classifier is None:
+            return None
+        return self.embedding_route(classifier, text, candidates)
+
+    async def aroute(self, text: str) -> Optional[Route]:
+        """event loop 上使用的版本：分類器還沒訓練好就交給 agent，不等待；embedding 推論在 thread 中執行"""
+        route, candidates = self.keyword_route(text)
+        if candidates is None:
+            return route
+        classifier = self._classifier or ready_intent_classifier()
+        if classifier is None:
+            return None
+        return await asyncio.to_thread(self.embedding_route, classifier, text, candidates)
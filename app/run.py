@@ -12,8 +12,25 @@ from dotenv import load_dotenv
 # Load environment variables
 load_dotenv()
 
-def run_web_api():
+def run_prod(service: str, workers: int = None, threads: int = None, asgi: bool = False):
+    """Run a service under the pre-fork server (preloaded app, shared warm models)"""
+    try:
+        import gunicorn  # noqa: F401
+    except ImportError:
+        print("❌ --prod requires gunicorn: pip install gunicorn")
+        sys.exit(1)
+    from .server import DEFAULT_THREADS, DEFAULT_WORKERS, SERVICE_PORTS, run_prefork
+    workers = workers or DEFAULT_WORKERS
+    threads = threads or DEFAULT_THREADS
+    print(f"🏭 Starting {service} in production mode ({workers} workers x {threads} threads)...")
+    print(f"🌐 Listening on http://0.0.0.0:{SERVICE_PORTS[service]}")
+    run_prefork(service, workers=workers, threads=threads, asgi=asgi)
+
+def run_web_api(asgi: bool = False):
     """Run the Flask web API"""
+    if asgi:
+        run_web_asgi()
+        return
     from .web_api import app
     print("🚀 Starting Flask Web API...")
     print(f"📱 Web Interface: http://localhost:5000")
@@ -21,6 +38,14 @@ def run_web_api():
     print(f"📊 API Endpoints: http://localhost:5000/api/*")
     app.run(debug=True, host='0.0.0.0', port=5000)
 
+def run_web_asgi():
+    """Run the web API under uvicorn; agent routes share one event loop"""
+    import uvicorn
+    print("🚀 Starting Web API (ASGI)...")
+    print(f"📱 Web Interface: http://localhost:5000")
+    print(f"💬 Agent Stream: http://localhost:5000/api/chat/stream")
+    uvicorn.run("app.asgi:app", host='0.0.0.0', port=5000, log_level="info")
+
 def run_line_bot():
     """Run the LINE Bot service"""
     from .line_bot import create_line_app
@@ -30,22 +55,13 @@ def run_line_bot():
     print(f"💚 Health Check: http://localhost:5001/health")
     app.run(debug=True, host='0.0.0.0', port=5001)
 
-def run_both():
-    """Run both web API and LINE bot"""
-    import threading
-    import time
-    
-    print("🚀 Starting both services...")
-    
-    # Start web API in a separate thread
-    web_thread = threading.Thread(target=run_web_api, daemon=True)
-    web_thread.start()
-    
-    # Give web API time to start
-    time.sleep(2)
-    
-    # Start LINE bot in main thread
-    run_line_bot()
+def run_both(asgi: bool = False, prod: bool = False, workers: int = None, threads: int = None):
+    """Run web API and LINE bot as supervised child processes"""
+    from .supervisor import run_supervised
+    print("🚀 Starting both services (supervised processes)...")
+    print(f"📱 Web Interface: http://localhost:5000")
+    print(f"📡 Webhook URL: http://localhost:5001/callback")
+    run_supervised(['web', 'line'], prod=prod, asgi=asgi, workers=workers, threads=threads)
 
 def check_environment():
     """Check if required environment variables are set"""
@@ -87,11 +103,41 @@ def main():
                        help='Service to run (default: web)')
     parser.add_argument('--init-db', action='store_true',
                        help='Initialize database before starting')
+    parser.add_argument('--seed-scale', type=float, default=None,
+                       help='Bulk-load synthetic load-test data (1.0 = ~100k users / 300k orders) and exit')
+    parser.add_argument('--seed', type=int, default=42,
+                       help='Random seed for --seed-scale (default: 42)')
     parser.add_argument('--check-env', action='store_true',
                        help='Check environment variables and exit')
+    parser.add_argument('--asgi', action='store_true',
+                       help='Serve the web API with uvicorn (async agent routes)')
+    parser.add_argument('--startup-profile', action='store_true',
+                       help='Print an import-time breakdown of the selected service and exit')
+    parser.add_argument('--startup-budget', type=float, default=None,
+                       help='With --startup-profile, exit non-zero if imports take longer than this (seconds)')
+    parser.add_argument('--prod', action='store_true',
+                       help='Run with the pre-fork production server (gunicorn)')
+    parser.add_argument('--workers', type=int, default=None,
+                       help='Worker processes in --prod mode (default: CPU count)')
+    parser.add_argument('--threads', type=int, default=None,
+                       help='Threads per worker in --prod mode (default: 4)')
     
     args = parser.parse_args()
     
+    if args.startup_profile:
+        from .startup_profile import print_startup_profile
+        services = ['web', 'line'] if args.service == 'both' else [args.service]
+        if args.asgi:
+            services = ['asgi' if s == 'web' else s for s in services]
+        ok = True
+        for service in services:
+            try:
+                ok = print_startup_profile(service, budget=args.startup_budget) and ok
+            except RuntimeError as e:
+                print(f"❌ Could not profile {service}: {e}")
+                ok = False
+        sys.exit(0 if ok else 1)
+
     # Check environment if requested
     if args.check_env:
         check_environment()
@@ -108,17 +154,27 @@ def main():
             print(f"❌ Failed to initialize database: {e}")
             return
     
+    if args.seed_scale is not None:
+        from .models import init_db
+        from .seed_scale import seed_scale
+        init_db(seed=True)
+        seed_scale(args.seed_scale, seed=args.seed)
+        print("✅ Synthetic data loaded")
+        return
+
     # Check environment
     check_environment()
     
     # Run selected service
     try:
-        if args.service == 'web':
-            run_web_api()
+        if args.service == 'both':
+            run_both(asgi=args.asgi, prod=args.prod, workers=args.workers, threads=args.threads)
+        elif args.prod:
+            run_prod(args.service, workers=args.workers, threads=args.threads, asgi=args.asgi)
+        elif args.service == 'web':
+            run_web_api(asgi=args.asgi)
         elif args.service == 'line':
             run_line_bot()
-        elif args.service == 'both':
-            run_both()
     except KeyboardInterrupt:
         print("\n👋 Shutting down gracefully...")
     except Exception as e:
@@ -0,0 +1,109 @@
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Dict, List
+
+from llama_index.core import SQLDatabase
+from sqlalchemy import Enum as SAEnum
+
+from .models import get_engine
+from .models import Order, OrderItem, User, Product, ProductItem, ProductFullView
+
+# 每個 SQL 工具只給 LLM 看必要的欄位（白名單），其餘欄位（如 users.password、register_ip）不放進 prompt
+SCHEMA_PROFILES = {
+    "product": {
+        "tables": {
+            ProductFullView.__table__: ["full_name", "product_id", "product_item_id", "store_id", "catalog", "descriptions", "price", "stock", "discount"],
+        },
+        "hints": {
+            "full_name": "商品名稱 - 細項名稱",
+            "descriptions": "商品簡介",
+            "price": "價格",
+            "stock": "庫存",
+            "discount": "折扣描述",
+        },
+        "joins": [],
+    },
+    "order": {
+        "tables": {
+            Order.__table__: ["id", "store_id", "user_id", "total", "status", "coupon", "created_at"],
+            OrderItem.__table__: ["id", "order_id", "product_item_id", "quantity"],
+            User.__table__: ["id", "name", "email"],
+            Product.__table__: ["id", "store_id", "name", "catalog"],
+            ProductItem.__table__: ["id", "product_id", "name", "price", "stock"],
+        },
+        "hints": {},
+        "joins": [
+            "orders.user_id = users.id",
+            "order_items.order_id = orders.id",
+            "order_items.product_item_id = product_items.id",
+            "product_items.product_id = products.id",
+        ],
+    },
+}
+
+
+@dataclass(frozen=True)
+class SchemaContext:
+    profile: str
+    table_info: Dict[str, str]
+    text: str
+    token_count: int
+
+
+def _count_tokens(text: str) -> int:
+    try:
+        from llama_index.core.utils import get_tokenizer
+        return len(get_tokenizer()(text))
+    except ImportError:
+        # 沒有 tiktoken 時粗估
+        return len(text) // 3
+
+
+def _describe_column(column, hints: Dict[str, str]) -> str:
+    desc = f"{column.name} {column.type.__class__.__name__.upper()}"
+    if isinstance(column.type, SAEnum):
+        desc += " in (" + ", ".join(f"'{v}'" for v in column.type.enums) + ")"
+    note = hints.get(column.name) or column.comment
+    if note:
+        desc += f" -- {note}"
+    return desc
+
+
+def describe_table(table, columns: List[str], hints: Dict[str, str], joins: List[str]) -> str:
+    lines = [f"Table {table.name}:"]
+    lines.extend("  " + _describe_column(table.c[name], hints) for name in columns)
+    table_joins = [j for j in joins if j.startswith(f"{table.name}.")]
+    if table_joins:
+        lines.append("  JOIN " + "; ".join(table_joins))
+    return "\n".join(lines)
+
+
+@lru_cache(maxsize=None)
+def get_schema_context(profile: str) -> SchemaContext:
+    """依工具 profile 產生精簡 schema 描述，每個 process 只計算一次"""
+    spec = SCHEMA_PROFILES[profile]
+    table_info = {
+        table.name: describe_table(table, columns, spec["hints"], spec["joins"])
+        for table, columns in spec["tables"].items()
+    }
+    text = "\n\n".join(table_info.values())
+    return SchemaContext(profile=profile, table_info=table_info, text=text, token_count=_count_tokens(text))
+
+
+class PrunedSQLDatabase(SQLDatabase):
+    """回傳預先計算好的精簡 table info，而不是每次從 inspector 重組完整欄位與註解"""
+
+    def __init__(self, engine, schema_context: SchemaContext, **kwargs):
+        super().__init__(engine, include_tables=list(schema_context.table_info), view_support=True, **kwargs)
+        self.schema_context = schema_context
+
+    def get_single_table_info(self, table_name: str) -> str:
+        info = self.schema_context.table_info.get(table_name)
+        if info is None:
+            return super().get_single_table_info(table_name)
+        return info
+
+
+@lru_cache(maxsize=None)
+def get_pruned_sql_database(profile: str) -> PrunedSQLDatabase:
+    return PrunedSQLDatabase(get_engine(), get_schema_context(profile))
@@ -0,0 +1,166 @@
+import re
+from typing import Any, Dict, List
+
+from sqlalchemy import text
+
+# =========================
+# CJK bigram 斷詞
+# =========================
+# FTS5 內建的 unicode61 會把整串中文當成一個 token，所以先把中文切成重疊的兩字詞（bigram），
+# 英數字則保留為小寫單字，再交給 FTS5 建索引。查詢字串也用同一套規則切詞。
+CJK_RANGES = (
+    "㐀-䶿"   # CJK Extension A
+    "一-鿿"   # CJK Unified Ideographs
+    "豈-﫿"   # CJK Compatibility Ideographs
+    "぀-ヿ"   # Hiragana / Katakana
+    "가-힯"   # Hangul
+)
+TOKEN_PATTERN = re.compile(rf"[{CJK_RANGES}]+|[0-9a-zA-Z]+")
+CJK_PATTERN = re.compile(rf"^[{CJK_RANGES}]+$")
+
+
+def bigram_tokens(value: str) -> List[str]:
+    tokens: List[str] = []
+    for run in TOKEN_PATTERN.findall(value or ""):
+        if CJK_PATTERN.match(run):
+            if len(run) == 1:
+                tokens.append(run)
+            else:
+                tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+        else:
+            tokens.append(run.lower())
+    return tokens
+
+
+def cjk_bigrams(value) -> str:
+    """註冊為 SQLite 函式，供 trigger 在寫入時切詞"""
+    if value is None:
+        return ""
+    return " ".join(bigram_tokens(str(value)))
+
+
+def build_match_query(query: str) -> str:
+    """把使用者輸入轉成 FTS5 MATCH 語法：每個 token 加上引號後以 AND 串接。
+    單一個中文字在索引裡只會出現在 bigram 開頭，改用前綴查詢（"茶"*）"""
+    terms = []
+    for t in bigram_tokens(query):
+        term = '"' + t.replace('"', '""') + '"'
+        terms.append(term + "*" if len(t) == 1 and CJK_PATTERN.match(t) else term)
+    return " AND ".join(terms)
+
+
+# =========================
+# FTS5 索引與同步 trigger
+# =========================
+PRODUCT_SEARCH_TABLE = "product_search"
+
+# rowid = product_items.id
+PRODUCT_SEARCH_DDL = f"""
+CREATE VIRTUAL TABLE IF NOT EXISTS {PRODUCT_SEARCH_TABLE} USING fts5(
+    name, item_name, catalog, descriptions, detail,
+    product_id UNINDEXED,
+    tokenize = 'unicode61'
+)
+"""
+
+_INDEX_ITEM_SELECT = """
+    SELECT pi.id, cjk_bigrams(p.name), cjk_bigrams(pi.name), cjk_bigrams(p.catalog),
+           cjk_bigrams(p.descriptions), cjk_bigrams(p.detail), p.id
+    FROM product_items pi JOIN products p ON p.id = pi.product_id
+"""
+
+PRODUCT_SEARCH_TRIGGERS = [
+    f"""
+    CREATE TRIGGER IF NOT EXISTS product_search_item_ai AFTER INSERT ON product_items BEGIN
+        INSERT INTO {PRODUCT_SEARCH_TABLE}(rowid, name, item_name, catalog, descriptions, detail, product_id)
+        {_INDEX_ITEM_SELECT} WHERE pi.id = new.id;
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS product_search_item_au AFTER UPDATE OF name, product_id ON product_items BEGIN
+        DELETE FROM {PRODUCT_SEARCH_TABLE} WHERE rowid = old.id;
+        INSERT INTO {PRODUCT_SEARCH_TABLE}(rowid, name, item_name, catalog, descriptions, detail, product_id)
+        {_INDEX_ITEM_SELECT} WHERE pi.id = new.id;
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS product_search_item_ad AFTER DELETE ON product_items BEGIN
+        DELETE FROM {PRODUCT_SEARCH_TABLE} WHERE rowid = old.id;
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS product_search_product_au AFTER UPDATE OF name, catalog, descriptions, detail ON products BEGIN
+        DELETE FROM {PRODUCT_SEARCH_TABLE} WHERE product_id = old.id;
+        INSERT INTO {PRODUCT_SEARCH_TABLE}(rowid, name, item_name, catalog, descriptions, detail, product_id)
+        {_INDEX_ITEM_SELECT} WHERE p.id = new.id;
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS product_search_product_ad AFTER DELETE ON products BEGIN
+        DELETE FROM {PRODUCT_SEARCH_TABLE} WHERE product_id = old.id;
+    END
+    """,
+]
+
+# bm25 欄位權重：商品名稱 > 細項名稱 > 分類 > 簡介 > 詳情
+BM25_WEIGHTS = (10.0, 5.0, 3.0, 2.0, 1.0)
+
+
+def register_sqlite_functions(dbapi_connection) -> None:
+    dbapi_connection.create_function("cjk_bigrams", 1, cjk_bigrams, deterministic=True)
+
+
+def rebuild_product_search(connection) -> None:
+    connection.execute(text(f"DELETE FROM {PRODUCT_SEARCH_TABLE}"))
+    connection.execute(text(
+        f"INSERT INTO {PRODUCT_SEARCH_TABLE}(rowid, name, item_name, catalog, descriptions, detail, product_id) {_INDEX_ITEM_SELECT}"
+    ))
+
+
+def ensure_product_search_index(engine) -> None:
+    """建立 FTS5 表與 trigger；索引為空時從現有資料重建"""
+    if engine.dialect.name != "sqlite":
+        return
+    with engine.begin() as connection:
+        connection.execute(text(PRODUCT_SEARCH_DDL))
+        for ddl in PRODUCT_SEARCH_TRIGGERS:
+            connection.execute(text(ddl))
+        indexed = connection.execute(text(f"SELECT COUNT(*) FROM {PRODUCT_SEARCH_TABLE}")).scalar()
+        if not indexed:
+            rebuild_product_search(connection)
+
+
+def search_products(connection, query: str, store_id: int, limit: int = 10) -> List[Dict[str, Any]]:
+    """以 bm25 排序搜尋上架中的商品細項；connection 可為 Session 或 Connection"""
+    match = build_match_query(query)
+    if not match:
+        return []
+    weights = ", ".join(str(w) for w in BM25_WEIGHTS)
+    rows = connection.execute(text(f"""
+        SELECT p.id AS product_id, pi.id AS product_item_id, p.name, pi.name AS item_name,
+               p.catalog, p.descriptions, pi.price, pi.stock, pi.discount,
+               bm25({PRODUCT_SEARCH_TABLE}, {weights}) AS score
+        FROM {PRODUCT_SEARCH_TABLE}
+        JOIN product_items pi ON pi.id = {PRODUCT_SEARCH_TABLE}.rowid
+        JOIN products p ON p.id = pi.product_id
+        WHERE {PRODUCT_SEARCH_TABLE} MATCH :match
+          AND p.store_id = :store_id
+          AND p.status = 'NORMAL' AND pi.status = 'NORMAL'
+          AND p.deleted_at IS NULL AND pi.deleted_at IS NULL
+        ORDER BY score
+        LIMIT :limit
+    """), {"match": match, "store_id": store_id, "limit": limit}).mappings().all()
+    return [
+        {
+            "product_id": r["product_id"],
+            "product_item_id": r["product_item_id"],
+            "full_name": f"{r['name']} - {r['item_name']}",
+            "catalog": r["catalog"],
+            "descriptions": r["descriptions"],
+            "price": r["price"],
+            "stock": r["stock"],
+            "discount": r["discount"],
+            "score": round(-r["score"], 4),
+        }
+        for r in rows
+    ]
@@ -0,0 +1,345 @@
+"""
+壓力測試用的大量合成資料
+
+    python -m app.run --seed-scale 1     # 約 10 萬會員、30 萬訂單
+    python -m app.run --seed-scale 20    # 數百萬筆訂單與訂單明細
+
+- 商品熱門度、會員活躍度、商店規模都是 Zipf 分布（少數商品佔大部分銷量）
+- 時間戳依一天內的時段權重（午休、晚間尖峰）分布在過去 DAYS 天
+- 直接用 sqlite3 executemany 分批寫入，每張表一個 transaction；密碼只雜湊一次
+- 相同 seed 產生相同資料；新資料的 id 接在現有資料之後，可疊加在 init_db 的範例資料上
+"""
+
+import bisect
+import itertools
+import random
+import time
+from datetime import date, datetime, timedelta
+from typing import Callable, Dict, Iterable, Iterator, List, Sequence, Tuple
+
+from sqlalchemy import text
+from werkzeug.security import generate_password_hash
+
+from .models import CATEGORIES, FIRST_NAMES, LAST_NAMES, get_engine
+from .search import PRODUCT_SEARCH_TABLE, PRODUCT_SEARCH_TRIGGERS, rebuild_product_search
+
+# scale = 1 時各表的筆數
+BASE_COUNTS = {
+    "stores": 20,
+    "users": 100_000,
+    "products": 10_000,
+    "orders": 300_000,
+    "chat_sessions": 50_000,
+    "wallet_records": 200_000,
+}
+BATCH_SIZE = 50_000
+DAYS = 365
+SEED_PASSWORD = "loadtest1234"
+
+# 一天 24 小時的下單 / 對話權重：凌晨低、午休與晚間尖峰
+HOURLY_WEIGHTS = [2, 1, 1, 1, 1, 2, 4, 7, 9, 10, 11, 13, 15, 12, 10, 10, 11, 13, 15, 18, 21, 22, 17, 8]
+# 星期一到日
+WEEKDAY_WEIGHTS = [0.9, 0.9, 0.95, 1.0, 1.1, 1.25, 1.2]
+
+ITEM_VARIANTS = ["標準款", "加大款", "輕量款", "黑色", "白色", "藍色", "限定版", "家庭號", "旅行組"]
+ADJECTIVES = ["經典", "輕巧", "高效", "防水", "智慧", "天然", "多功能", "極簡", "專業", "舒適"]
+NOUNS = {
+    "電子產品": ["藍牙耳機", "行動電源", "智慧手錶", "無線滑鼠", "機械鍵盤", "平板支架"],
+    "配件": ["手機殼", "充電線", "保護貼", "收納包", "轉接頭", "掛繩"],
+    "居家": ["保溫杯", "香氛蠟燭", "收納盒", "抱枕", "桌燈", "砧板"],
+    "戶外": ["登山背包", "露營燈", "睡袋", "折疊椅", "水壺", "防風外套"],
+    "美食": ["手工餅乾", "滴濾咖啡", "堅果禮盒", "茶包", "果乾", "辣椒醬"],
+    "美妝": ["保濕乳液", "防曬乳", "洗面乳", "護手霜", "面膜", "唇膏"],
+}
+CHAT_USER_LINES = ["請問這個商品還有庫存嗎？", "我的訂單什麼時候出貨？", "可以退貨嗎？", "有沒有推薦的禮物？",
+                   "運費怎麼算？", "我想改收件地址", "有折扣碼嗎？", "保固多久？"]
+CHAT_AI_LINES = ["目前仍有庫存，歡迎下單。", "訂單預計 2-3 個工作天內出貨。", "收到商品 7 天內可申請退貨。",
+                 "為您推薦本週熱銷商品。", "滿千免運，未滿酌收 80 元。", "已為您更新收件資料。",
+                 "目前全館滿千折百。", "電子產品享一年保固。"]
+
+TS_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+def zipf_cum_weights(n: int, s: float) -> List[float]:
+    """排名 1..n 的 Zipf 累積權重，搭配 random.choices(cum_weights=...) 使用"""
+    return list(itertools.accumulate(1.0 / (rank ** s) for rank in range(1, n + 1)))
+
+
+class ZipfSampler:
+    """把 Zipf 排名隨機對應到實際 id，避免熱門商品集中在最小的 id"""
+
+    def __init__(self, rng: random.Random, ids: Sequence[int], s: float):
+        self.rng = rng
+        self.ids = list(ids)
+        rng.shuffle(self.ids)
+        self.cum = zipf_cum_weights(len(self.ids), s)
+        self.total = self.cum[-1]
+
+    def sample(self) -> int:
+        return self.ids[bisect.bisect_left(self.cum, self.rng.random() * self.total)]
+
+
+class DiurnalClock:
+    """產生截至 end（預設今天）前 days 天內、符合星期與時段分布的時間"""
+
+    def __init__(self, rng: random.Random, days: int = DAYS, end: date = None):
+        self.rng = rng
+        end = end or date.today()
+        self.days = [end - timedelta(days=d) for d in range(days)]
+        self.day_cum = list(itertools.accumulate(WEEKDAY_WEIGHTS[d.weekday()] for d in self.days))
+        self.hour_cum = list(itertools.accumulate(HOURLY_WEIGHTS))
+
+    def sample(self) -> datetime:
+        rng = self.rng
+        day = self.days[bisect.bisect_left(self.day_cum, rng.random() * self.day_cum[-1])]
+        hour = bisect.bisect_left(self.hour_cum, rng.random() * self.hour_cum[-1])
+        return datetime(day.year, day.month, day.day, hour, rng.randrange(60), rng.randrange(60))
+
+
+def _next_id(conn, table: str) -> int:
+    return (conn.execute(f"SELECT COALESCE(MAX(id), 0) FROM {table}").fetchone()[0] or 0) + 1
+
+
+def bulk_insert(conn, table: str, columns: Sequence[str], rows: Iterable[tuple], batch_size: int = BATCH_SIZE) -> int:
+    """分批 executemany，整張表一個 transaction；回傳寫入筆數"""
+    sql = f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})"
+    rows = iter(rows)
+    total = 0
+    while True:
+        batch = list(itertools.islice(rows, batch_size))
+        if not batch:
+            break
+        conn.executemany(sql, batch)
+        total += len(batch)
+    conn.commit()
+    return total
+
+
+class ScaleSeeder:
+    def __init__(self, conn, scale: float, seed: int = 42):
+        self.conn = conn
+        self.rng = random.Random(seed)
+        self.counts = {k: max(1, int(v * scale)) for k, v in BASE_COUNTS.items()}
+        self.clock = DiurnalClock(self.rng)
+        self.password = generate_password_hash(SEED_PASSWORD)
+        self.store_ids: List[int] = []
+        self.user_ids: List[int] = []
+        self.product_store: Dict[int, int] = {}
+        self.item_price: Dict[int, int] = {}
+        self.item_product: Dict[int, int] = {}
+
+    def _ts(self) -> str:
+        return self.clock.sample().strftime(TS_FORMAT)
+
+    def stores(self) -> Iterator[tuple]:
+        start = _next_id(self.conn, "stores")
+        for sid in range(start, start + self.counts["stores"]):
+            self.store_ids.append(sid)
+            ts = self._ts()
+            yield (sid, f"LOAD{sid}", f"壓測商店 {sid}", f"load{sid}@shop.example.com", "[]", ts, ts)
+
+    def users(self) -> Iterator[tuple]:
+        rng = self.rng
+        start = _next_id(self.conn, "users")
+        levels = ["FIRST", "SECOND", "THIRD"]
+        for uid in range(start, start + self.counts["users"]):
+            self.user_ids.append(uid)
+            name = f"{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}"
+            ts = self._ts()
+            yield (uid, f"load{uid}", self.password, name, f"load{uid}@example.com",
+                   f"09{rng.randrange(10_000_000, 100_000_000)}", f"台灣某市某區{rng.randrange(1, 300)}號",
+                   f"{rng.randrange(1960, 2006)}-{rng.randrange(1, 13):02d}-{rng.randrange(1, 29):02d}",
+                   f"10.{rng.randrange(256)}.{rng.randrange(256)}.{rng.randrange(1, 255)}",
+                   rng.randrange(0, 5000), rng.randrange(0, 1000), rng.choices(levels, (70, 22, 8))[0], ts, ts)
+
+    def products(self) -> Iterator[tuple]:
+        rng = self.rng
+        stores = ZipfSampler(rng, self.store_ids, s=1.0)
+        start = _next_id(self.conn, "products")
+        for pid in range(start, start + self.counts["products"]):
+            store_id = stores.sample()
+            self.product_store[pid] = store_id
+            catalog = rng.choice(CATEGORIES)
+            name = f"{rng.choice(ADJECTIVES)}{rng.choice(NOUNS.get(catalog, ['商品']))} {pid}"
+            status = "NORMAL" if rng.random() < 0.9 else "HIDE"
+            ts = self._ts()
+            yield (pid, store_id, catalog, name, f"{catalog}精選：{name}", "規格、材質與保固說明。",
+                   f"https://img.example.com/product/{pid}.png", "[]", status, ts, ts)
+
+    def product_items(self) -> Iterator[tuple]:
+        rng = self.rng
+        item_id = _next_id(self.conn, "product_items")
+        for pid in self.product_store:
+            base_price = int(rng.lognormvariate(6.5, 0.9)) + 50
+            for variant in rng.sample(ITEM_VARIANTS, rng.choices((1, 2, 3, 4, 5), (30, 30, 20, 12, 8))[0]):
+                price = max(10, int(base_price * rng.uniform(0.8, 1.3)))
+                self.item_price[item_id] = price
+                self.item_product[item_id] = pid
+                ts = self._ts()
+                discount = rng.choice(("9折", "買一送一", "滿千折百")) if rng.random() < 0.1 else None
+                yield (item_id, pid, variant, price, rng.randrange(0, 500), discount, "NORMAL", ts, ts)
+                item_id += 1
+
+    def orders_and_items(self) -> Iterator[Tuple[List[tuple], List[tuple]]]:
+        """訂單與明細一起產生（訂單金額由明細加總），每批回傳 (訂單, 明細)"""
+        rng = self.rng
+        items = ZipfSampler(rng, list(self.item_price), s=1.1)
+        by_store: Dict[int, List[int]] = {}
+        for item, pid in self.item_product.items():
+            by_store.setdefault(self.product_store[pid], []).append(item)
+        store_items = {store_id: ZipfSampler(rng, ids, s=1.1) for store_id, ids in by_store.items()}
+        buyers = ZipfSampler(rng, self.user_ids, s=0.8)
+        order_id = _next_id(self.conn, "orders")
+        order_item_id = _next_id(self.conn, "order_items")
+        statuses, status_weights = ("PENDING", "PAID", "SHIPPED", "REFUND"), (10, 30, 55, 5)
+        orders: List[tuple] = []
+        order_items: List[tuple] = []
+
+        def flush():
+            nonlocal orders, order_items
+            out = (orders, order_items)
+            orders, order_items = [], []
+            return out
+
+        for _ in range(self.counts["orders"]):
+            created = self.clock.sample()
+            ts = created.strftime(TS_FORMAT)
+            # 一筆訂單只屬於一家商店：第一個商品決定商店，其餘商品從同一家商店挑
+            first = items.sample()
+            store_id = self.product_store[self.item_product[first]]
+            same_store = store_items[store_id]
+            picked = {first} | {same_store.sample() for _ in range(rng.choices((1, 2, 3, 4, 5), (50, 25, 13, 8, 4))[0] - 1)}
+            total = 0
+            for item in picked:
+                quantity = rng.choices((1, 2, 3), (80, 15, 5))[0]
+                total += self.item_price[item] * quantity
+                order_items.append((order_item_id, order_id, item, quantity, ts, ts))
+                order_item_id += 1
+            orders.append((order_id, store_id, buyers.sample(), total, rng.choices(statuses, status_weights)[0], ts, ts))
+            order_id += 1
+            if len(orders) >= BATCH_SIZE:
+                yield flush()
+        if orders:
+            yield flush()
+
+    def chats(self) -> Iterator[Tuple[List[tuple], List[tuple]]]:
+        rng = self.rng
+        users = ZipfSampler(rng, self.user_ids, s=0.9)
+        stores = ZipfSampler(rng, self.store_ids, s=1.0)
+        session_id = _next_id(self.conn, "chat_sessions")
+        message_id = _next_id(self.conn, "chat_messages")
+        sessions, messages = [], []
+        for _ in range(self.counts["chat_sessions"]):
+            created = self.clock.sample()
+            status = rng.choices(("ai", "human", "resolved"), (70, 10, 20))[0]
+            sessions.append((session_id, stores.sample(), users.sample(), status,
+                             created.strftime(TS_FORMAT), created.strftime(TS_FORMAT)))
+            for turn in range(rng.randrange(1, 6)):
+                for sender, lines in (("user", CHAT_USER_LINES), ("ai", CHAT_AI_LINES)):
+                    created += timedelta(seconds=rng.randrange(5, 90))
+                    ts = created.strftime(TS_FORMAT)
+                    messages.append((message_id, session_id, sender, rng.choice(lines), ts, ts))
+                    message_id += 1
+            session_id += 1
+            if len(sessions) >= BATCH_SIZE // 4:
+                yield sessions, messages
+                sessions, messages = [], []
+        if sessions:
+            yield sessions, messages
+
+    def wallet_records(self) -> Iterator[tuple]:
+        rng = self.rng
+        users = ZipfSampler(rng, self.user_ids, s=0.8)
+        record_id = _next_id(self.conn, "wallet_records")
+        types, weights, signs = ("RECHARGE", "PAY", "WITHDRAW", "AWARD"), (30, 45, 10, 15), (1, -1, -1, 1)
+        for rid in range(record_id, record_id + self.counts["wallet_records"]):
+            kind = rng.choices(range(4), weights)[0]
+            amount = round(signs[kind] * rng.lognormvariate(5.5, 1.0), 2)
+            ts = self._ts()
+            yield (rid, users.sample(), None, amount, types[kind], None, ts, ts)
+
+
+def _timed(label: str, fn: Callable[[], int], report: Dict[str, int]) -> None:
+    start = time.perf_counter()
+    n = fn()
+    elapsed = time.perf_counter() - start
+    report[label] = n
+    print(f"   {label:<15} {n:>10,} rows  {elapsed:7.1f}s  ({n / max(elapsed, 1e-9):,.0f} rows/s)")
+
+
+def seed_scale(scale: float, seed: int = 42, engine=None) -> Dict[str, int]:
+    """在現有資料庫上疊加 scale 倍的合成資料，回傳各表寫入筆數"""
+    engine = engine or get_engine()
+    raw = engine.raw_connection()
+    conn = raw.driver_connection
+    report: Dict[str, int] = {}
+    try:
+        # 只在匯入期間放寬耐久性；FTS trigger 先拿掉，最後一次重建索引
+        conn.execute("PRAGMA synchronous = OFF")
+        conn.execute("PRAGMA temp_store = MEMORY")
+        conn.execute("PRAGMA cache_size = -262144")
+        for name in ("product_search_item_ai", "product_search_item_au", "product_search_item_ad",
+                     "product_search_product_au", "product_search_product_ad"):
+            conn.execute(f"DROP TRIGGER IF EXISTS {name}")
+        conn.commit()
+
+        seeder = ScaleSeeder(conn, scale, seed)
+        print(f"🌱 Seeding scale={scale} seed={seed}")
+        _timed("stores", lambda: bulk_insert(
+            conn, "stores", ("id", "prefix", "store_name", "email", "marquee", "created_at", "updated_at"),
+            seeder.stores()), report)
+        _timed("users", lambda: bulk_insert(
+            conn, "users", ("id", "account", "password", "name", "email", "phone", "address", "birthday",
+                            "register_ip", "wallet", "award", "level", "created_at", "updated_at"),
+            seeder.users()), report)
+        _timed("products", lambda: bulk_insert(
+            conn, "products", ("id", "store_id", "catalog", "name", "descriptions", "detail", "picture", "carousel",
+                               "status", "created_at", "updated_at"),
+            seeder.products()), report)
+        _timed("product_items", lambda: bulk_insert(
+            conn, "product_items", ("id", "product_id", "name", "price", "stock", "discount", "status",
+                                    "created_at", "updated_at"),
+            seeder.product_items()), report)
+
+        def orders() -> int:
+            n = 0
+            for order_rows, item_rows in seeder.orders_and_items():
+                conn.executemany("INSERT INTO orders (id, store_id, user_id, total, status, created_at, updated_at) "
+                                 "VALUES (?, ?, ?, ?, ?, ?, ?)", order_rows)
+                conn.executemany("INSERT INTO order_items (id, order_id, product_item_id, quantity, created_at, updated_at) "
+                                 "VALUES (?, ?, ?, ?, ?, ?)", item_rows)
+                n += len(order_rows)
+                report["order_items"] = report.get("order_items", 0) + len(item_rows)
+            conn.commit()
+            return n
+
+        def chats() -> int:
+            n = 0
+            for session_rows, message_rows in seeder.chats():
+                conn.executemany("INSERT INTO chat_sessions (id, store_id, user_id, status, created_at, updated_at) "
+                                 "VALUES (?, ?, ?, ?, ?, ?)", session_rows)
+                conn.executemany("INSERT INTO chat_messages (id, session_id, sender, content, created_at, updated_at) "
+                                 "VALUES (?, ?, ?, ?, ?, ?)", message_rows)
+                n += len(session_rows)
+                report["chat_messages"] = report.get("chat_messages", 0) + len(message_rows)
+            conn.commit()
+            return n
+
+        _timed("orders", orders, report)
+        _timed("chat_sessions", chats, report)
+        _timed("wallet_records", lambda: bulk_insert(
+            conn, "wallet_records", ("id", "user_id", "from_id", "amount", "type", "comment", "created_at", "updated_at"),
+            seeder.wallet_records()), report)
+        print(f"   (order_items {report.get('order_items', 0):,} rows, chat_messages {report.get('chat_messages', 0):,} rows)")
+    finally:
+        # PRAGMA 是連線層級的設定，這條連線不放回連線池
+        raw.invalidate()
+        # 匯入中途失敗也要裝回 trigger，已提交的資料同樣要進索引，否則之後的商品異動不會同步到搜尋表
+        start = time.perf_counter()
+        with engine.begin() as connection:
+            for ddl in PRODUCT_SEARCH_TRIGGERS:
+                connection.execute(text(ddl))
+            rebuild_product_search(connection)
+            connection.execute(text("ANALYZE"))
+        print(f"   {PRODUCT_SEARCH_TABLE} rebuilt + ANALYZE  {time.perf_counter() - start:.1f}s")
+    return report
@@ -0,0 +1,146 @@
+"""
+正式環境的 pre-fork 伺服器（gunicorn）
+
+父 process 先載入 app 並預熱共用模型，再 fork 出多個 worker；模型權重以 copy-on-write 共用。
+收到 SIGTERM 時停止接新請求，等進行中的請求與 LINE 背景佇列處理完才結束。
+"""
+
+import multiprocessing
+import os
+import tempfile
+
+DEFAULT_WORKERS = int(os.environ.get("APP_WORKERS", str(multiprocessing.cpu_count())))
+DEFAULT_THREADS = int(os.environ.get("APP_THREADS", "4"))
+GRACEFUL_TIMEOUT = int(os.environ.get("APP_GRACEFUL_TIMEOUT", "30"))
+# agent 回合可能要數十秒，worker 逾時要放寬
+WORKER_TIMEOUT = int(os.environ.get("APP_WORKER_TIMEOUT", "180"))
+
+SERVICE_PORTS = {"web": 5000, "line": 5001}
+
+
+def load_service_app(service: str, asgi: bool = False):
+    if service == "web":
+        if asgi:
+            from .asgi import app
+            return app
+        from .web_api import app
+        return app
+    if service == "line":
+        from .line_bot import create_line_app
+        return create_line_app()
+    raise ValueError(f"Unknown service: {service}")
+
+
+def warm_shared_models(service: str) -> None:
+    """fork 之前載入唯讀、體積大的共用物件。
+
+    只做載入，不啟動 thread、不建立 HTTP 連線、不跑模型推論（fork 之後這些狀態無法安全沿用）。
+    """
+    steps = []
+    if service in ("web", "line"):
+        def embed():
+            from .agent import get_embed_model
+            get_embed_model()
+
+        def schemas():
+            from .schema_context import get_pruned_sql_database
+            for profile in ("product", "order"):
+                get_pruned_sql_database(profile)
+
+        def llm():
+            from .llm_client import get_llm
+            get_llm()
+
+        steps += [("embedding model", embed), ("schema context", schemas), ("llm client", llm)]
+    if service == "line":
+        def catalog():
+            from .line_bot import LINE_STORE_ID
+            from .catalog_cache import catalog_cache
+            catalog_cache.products(LINE_STORE_ID)
+
+        steps.append(("catalog cache", catalog))
+
+    for name, step in steps:
+        try:
+            step()
+            print(f"🔥 Warmed {name}")
+        except Exception as e:
+            # 預熱失敗不影響啟動，worker 第一次用到時再載入
+            print(f"⚠️  Could not warm {name}: {e}")
+
+
+def _post_fork(service: str):
+    def hook(server, worker):
+        from .metrics import REGISTRY
+        from .models import dispose_engines
+        dispose_engines()
+        REGISTRY.reset()
+        if service == "web":
+            from .web_api import app, db
+            with app.app_context():
+                db.engine.dispose(close=False)
+    return hook
+
+
+def _worker_exit(service: str):
+    def hook(server, worker):
+        if service == "line":
+            # 已回 200 給 LINE 的事件要處理完才離開
+            from .line_bot import dispatcher
+            if dispatcher is not None:
+                dispatcher.shutdown(wait=True)
+        # 結束前寫出最後的計數，worker 重啟後計數器不會倒退
+        from .metrics import REGISTRY
+        REGISTRY.flush(force=True)
+        # worker 以 os._exit 結束，不會執行 atexit；佇列中的 span 在這裡寫出
+        from .tracing import flush
+        flush()
+    return hook
+
+
+def run_prefork(service: str, workers: int = DEFAULT_WORKERS, threads: int = DEFAULT_THREADS,
+                asgi: bool = False, host: str = "0.0.0.0", port: int = None, application=None) -> None:
+    """application 可傳入已載入的 app（由 supervisor 在 fork 前預先載入）"""
+    from gunicorn.app.base import BaseApplication
+
+    # 各 worker 把指標寫到同一個目錄，/metrics 合併後輸出；必須在 fork 前設定
+    metrics_dir = os.environ.get("APP_METRICS_DIR")
+    if not metrics_dir:
+        os.environ["APP_METRICS_DIR"] = tempfile.mkdtemp(prefix=f"app-metrics-{service}-")
+    else:
+        # 沿用指定的目錄時清掉上一次執行留下的計數
+        os.makedirs(metrics_dir, exist_ok=True)
+        for name in os.listdir(metrics_dir):
+            if name.endswith(".json"):
+                os.remove(os.path.join(metrics_dir, name))
+
+    class PreforkApplication(BaseApplication):
+        def __init__(self, options):
+            self.options = options
+            self.application = application
+            super().__init__()
+
+        def load_config(self):
+            for key, value in self.options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            if self.application is None:
+                self.application = load_service_app(service, asgi=asgi)
+                warm_shared_models(service)
+            return self.application
+
+    options = {
+        "bind": f"{host}:{port or SERVICE_PORTS[service]}",
+        "workers": workers,
+        "threads": threads,
+        "worker_class": "uvicorn.workers.UvicornWorker" if asgi else "gthread",
+        "preload_app": True,
+        "timeout": WORKER_TIMEOUT,
+        "graceful_timeout": GRACEFUL_TIMEOUT,
+        "proc_name": f"app-{service}",
+        "accesslog": "-",
+        "post_fork": _post_fork(service),
+        "worker_exit": _worker_exit(service),
+    }
+    PreforkApplication(options).run()
@@ -0,0 +1,267 @@
+import copy
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import Counter
+from functools import partial
+from typing import Dict, List, Set, Tuple
+
+from .tracing import STATEMENT_MAX_CHARS, span
+from .usage import record_sql
+
+# 設定（可由環境變數覆寫）
+SQL_TIMEOUT_SECONDS = float(os.environ.get("APP_SQL_TIMEOUT", "2.0"))
+SQL_ROW_LIMIT = int(os.environ.get("APP_SQL_ROW_LIMIT", "50"))
+SQL_LARGE_TABLE_ROWS = int(os.environ.get("APP_SQL_LARGE_TABLE_ROWS", "100000"))
+SQL_TABLE_SIZE_TTL = 300  # 表格大小快取秒數
+
+# LLM 的 SQL 只能讀這些表；執行前以同名 CTE 蓋過，查詢看到的只有目前使用者 / 商店的資料。
+# main.<表> 指 SQLite 主資料庫中的實體表，不會再解析成 CTE
+SCOPED_TABLES = {
+    "orders": "SELECT * FROM main.orders WHERE user_id = :scope_user_id",
+    "order_items": "SELECT * FROM main.order_items WHERE order_id IN "
+                   "(SELECT id FROM main.orders WHERE user_id = :scope_user_id)",
+    "users": "SELECT * FROM main.users WHERE id = :scope_user_id",
+    "products": "SELECT * FROM main.products WHERE store_id = :scope_store_id",
+    "product_items": "SELECT * FROM main.product_items WHERE product_id IN "
+                     "(SELECT id FROM main.products WHERE store_id = :scope_store_id)",
+    "product_full_view": "SELECT * FROM main.product_full_view WHERE store_id = :scope_store_id",
+}
+
+FORBIDDEN_KEYWORDS = {"insert", "update", "delete", "drop", "alter", "create", "replace", "attach", "detach",
+                      "pragma", "vacuum", "reindex", "truncate", "grant"}
+SQL_TOKEN = re.compile(r"""
+    (?P<space>\s+)
+  | (?P<comment>--[^\n]*|/\*.*?(?:\*/|\Z))
+  | (?P<string>'(?:[^']|'')*')
+  | (?P<quoted>"(?:[^"]|"")*"|`(?:[^`]|``)*`|\[[^\]]*\])
+  | (?P<word>[^\W\d]\w*)
+  | (?P<other>.)
+""", re.VERBOSE | re.DOTALL)
+TABLE_REF = re.compile(r"\b(?:from|join)\s+[\"`\[]?(\w+)[\"`\]]?(?:\s+(?:as\s+)?(\w+))?", re.IGNORECASE)
+NOT_ALIASES = {"where", "join", "left", "right", "inner", "outer", "cross", "natural", "on", "using",
+               "group", "order", "limit", "having", "union", "except", "intersect", "window"}
+PLAN_SCAN = re.compile(r"^SCAN (?:TABLE )?(?:main\.)?(\w+)(.*)$")
+
+# authorizer 一律放行的動作；讀取（SQLITE_READ）另外檢查
+SQLITE_ALLOWED_ACTIONS = {sqlite3.SQLITE_SELECT, sqlite3.SQLITE_FUNCTION, getattr(sqlite3, "SQLITE_RECURSIVE", 33)}
+
+_metrics_lock = threading.Lock()
+SQL_GUARD_METRICS: Counter = Counter()
+
+# (資料庫 URL, 表名) -> (時間, 筆數)；同一個 process 可能同時連到多個資料庫
+_table_sizes: Dict[Tuple[str, str], Tuple[float, int]] = {}
+
+
+class SQLGuardError(ValueError):
+    """LLM 產生的 SQL 不符合執行規則"""
+
+    def __init__(self, reason: str, message: str):
+        super().__init__(message)
+        self.reason = reason
+
+
+def record_metric(name: str, amount: int = 1) -> None:
+    with _metrics_lock:
+        SQL_GUARD_METRICS[name] += amount
+
+
+def get_guard_metrics() -> Dict[str, int]:
+    with _metrics_lock:
+        return dict(SQL_GUARD_METRICS)
+
+
+def tokenize(command: str) -> List[Tuple[str, str, int, int]]:
+    """切成 (種類, 文字, 起點, 終點)，去掉空白與註解；字串常值與加引號的名稱各自是一個 token"""
+    tokens = []
+    for match in SQL_TOKEN.finditer(command):
+        kind = match.lastgroup
+        if kind not in ("space", "comment"):
+            tokens.append((kind, match.group(), match.start(), match.end()))
+    return tokens
+
+
+def _name(token: Tuple[str, str, int, int]) -> str:
+    """名稱 token 的小寫名稱（去掉引號）；其他 token 回傳空字串"""
+    kind, text = token[0], token[1]
+    if kind == "quoted":
+        text = text[1:-1]
+    return text.lower() if kind in ("word", "quoted") else ""
+
+
+def cte_names(tokens: List[Tuple[str, str, int, int]]) -> Set[str]:
+    """查詢自己定義的 CTE 名稱：名稱後面接 `AS (`，或 `(欄位, ...) AS (`"""
+    names = set()
+    for i, token in enumerate(tokens[:-2]):
+        j = i + 1
+        if tokens[j][1] == "(":
+            depth = 0
+            while j < len(tokens):
+                depth += {"(": 1, ")": -1}.get(tokens[j][1], 0)
+                j += 1
+                if depth == 0:
+                    break
+        if j + 1 < len(tokens) and _name(tokens[j]) == "as" and tokens[j + 1][1] == "(" and _name(token):
+            names.add(_name(token))
+    return names
+
+
+class SQLGuard:
+    """包住 SQLDatabase.run_sql：只允許 SELECT、以範圍 CTE 限制讀得到的資料、檢查查詢計畫，並限制時間與筆數"""
+
+    def __init__(self, store_id: int, user_id: str, row_limit: int = SQL_ROW_LIMIT,
+                 timeout: float = SQL_TIMEOUT_SECONDS, large_table_rows: int = SQL_LARGE_TABLE_ROWS):
+        self.store_id = store_id
+        self.user_id = user_id
+        self.row_limit = row_limit
+        self.timeout = timeout
+        self.large_table_rows = large_table_rows
+
+    def _reject(self, reason: str, message: str):
+        record_metric(f"violation.{reason}")
+        raise SQLGuardError(reason, message)
+
+    def check_select_only(self, command: str) -> str:
+        tokens = tokenize(command)
+        while tokens and tokens[-1][1] == ";":
+            tokens.pop()
+        if not tokens or tokens[0][0] != "word" or _name(tokens[0]) not in ("select", "with"):
+            self._reject("not_select", "Only SELECT queries are allowed.")
+        if any(t[0] == "other" and t[1] == ";" for t in tokens):
+            self._reject("multi_statement", "Only a single SQL statement is allowed.")
+        # 只比對關鍵字 token，字串常值裡的 'update' 不算
+        if any(t[0] == "word" and t[1].lower() in FORBIDDEN_KEYWORDS for t in tokens):
+            self._reject("not_select", "Only read-only SELECT queries are allowed.")
+        return command[tokens[0][2]:tokens[-1][3]]
+
+    def referenced_tables(self, sql: str) -> Dict[str, str]:
+        """回傳 {別名或表名: 表名}"""
+        tables = {}
+        for table, alias in TABLE_REF.findall(sql):
+            tables[table.lower()] = table.lower()
+            if alias and alias.lower() not in NOT_ALIASES:
+                tables[alias.lower()] = table.lower()
+        return tables
+
+    def scope(self, sql: str) -> str:
+        """在查詢前加上同名的範圍 CTE；不論 WHERE 怎麼寫（OR、UNION、子查詢），讀到的都只有範圍內的資料"""
+        tokens = tokenize(sql)
+        names = {_name(t) for t in tokens}
+        ctes = ", ".join(f"{table} AS ({body})" for table, body in SCOPED_TABLES.items() if table in names)
+        if not ctes:
+            return sql
+        if _name(tokens[0]) != "with":
+            return f"WITH {ctes} {sql}"
+        # 原本就有 WITH：範圍 CTE 放在最前面，後面的 CTE 也只看得到範圍內的資料；同名的 CTE 會被 SQLite 拒絕
+        recursive = len(tokens) > 1 and _name(tokens[1]) == "recursive"
+        head = tokens[1] if recursive else tokens[0]
+        return f"WITH {'RECURSIVE ' if recursive else ''}{ctes}, {sql[head[3]:].lstrip()}"
+
+    def params(self) -> Dict[str, object]:
+        return {"scope_user_id": self.user_id, "scope_store_id": self.store_id}
+
+    @staticmethod
+    def authorizer(denied: List[str], local: Set[str] = frozenset()):
+        """實體表只能在範圍 CTE（或其中的 view）內讀取，其他表與動作一律拒絕；被拒絕的表記在 denied。
+        local 是查詢自己定義、且不與實體表同名的 CTE；有些 SQLite 版本讀取 CTE（例如 WITH RECURSIVE 的遞迴步驟）也會送出 SQLITE_READ"""
+        def authorize(action, arg1, arg2, db_name, source):
+            if action in SQLITE_ALLOWED_ACTIONS:
+                return sqlite3.SQLITE_OK
+            if action == sqlite3.SQLITE_READ and (source in SCOPED_TABLES or (arg1 or "").lower() in local):
+                return sqlite3.SQLITE_OK
+            denied.append(arg1 or str(action))
+            return sqlite3.SQLITE_DENY
+        return authorize
+
+    def local_ctes(self, connection, sql: str) -> Set[str]:
+        """查詢定義的 CTE 中，不與資料庫物件同名的那些（同名的可能是實體表，不能放行）"""
+        names = cte_names(tokenize(sql)) - set(SCOPED_TABLES)
+        if not names:
+            return set()
+        schema = {row[0].lower() for row in connection.execute("SELECT name FROM sqlite_master")}
+        return {n for n in names if n not in schema and not n.startswith(("sqlite_", "pragma_"))}
+
+    def table_size(self, connection, database: str, table: str) -> int:
+        """以 MAX(rowid) 估計表格大小並快取，避免每次 COUNT(*)"""
+        key = (database, table)
+        cached = _table_sizes.get(key)
+        now = time.monotonic()
+        if cached and now - cached[0] < SQL_TABLE_SIZE_TTL:
+            return cached[1]
+        try:
+            size = connection.execute(f'SELECT MAX(rowid) FROM "{table}"').fetchone()[0] or 0
+        except Exception:
+            size = 0  # view 或無 rowid 的表
+        _table_sizes[key] = (now, size)
+        return size
+
+    def check_plan(self, connection, database: str, sql: str, tables: Dict[str, str]) -> None:
+        for row in connection.execute(f"EXPLAIN QUERY PLAN {sql}", self.params()).fetchall():
+            match = PLAN_SCAN.match(row[-1])
+            if not match:
+                continue
+            table, rest = tables.get(match.group(1).lower(), match.group(1)), match.group(2)
+            if "USING" in rest and "INDEX" in rest:
+                continue
+            if self.table_size(connection, database, table) >= self.large_table_rows:
+                self._reject("unbounded_scan", f"Query would scan the whole '{table}' table; add a more selective condition.")
+
+    def run(self, sql_database, command: str) -> Tuple[str, Dict]:
+        sql = self.check_select_only(command)
+        tables = self.referenced_tables(sql)
+        scoped = self.scope(sql)
+
+        engine = sql_database.engine
+        raw = engine.raw_connection()
+        denied: List[str] = []
+        try:
+            connection = raw.driver_connection if hasattr(raw, "driver_connection") else raw.connection
+            is_sqlite = engine.dialect.name == "sqlite"
+            if is_sqlite:
+                self.check_plan(connection, str(engine.url), scoped, tables)
+                local = self.local_ctes(connection, sql)
+                deadline = time.monotonic() + self.timeout
+                connection.set_progress_handler(lambda: int(time.monotonic() > deadline), 1000)
+                connection.set_authorizer(self.authorizer(denied, local))
+            started = time.monotonic()
+            # 直接用 DBAPI 連線執行，不會觸發 Engine 的 cursor 事件，span 在這裡建立
+            try:
+                with span("sql", **{"db.statement": sql[:STATEMENT_MAX_CHARS], "sql.guarded": True}) as s:
+                    cursor = connection.cursor()
+                    cursor.execute(scoped, self.params())
+                    rows = cursor.fetchmany(self.row_limit + 1)
+                    col_keys = [d[0] for d in cursor.description or []]
+                    if s is not None:
+                        s.set(**{"db.rowcount": len(rows)})
+            except Exception as exc:
+                if denied:
+                    self._reject("out_of_scope", f"Query may only read {', '.join(SCOPED_TABLES)}; '{denied[0]}' is not allowed.")
+                if is_sqlite and time.monotonic() > deadline:
+                    self._reject("timeout", f"Query exceeded the {self.timeout:.1f}s time limit.")
+                raise NotImplementedError(f"Statement {sql!r} is invalid SQL.\nError: {exc}") from exc
+            finally:
+                if is_sqlite:
+                    connection.set_progress_handler(None, 0)
+                    connection.set_authorizer(None)
+            record_metric("queries")
+            elapsed_ms = (time.monotonic() - started) * 1000
+            record_metric("query_ms", int(elapsed_ms))
+            record_sql(elapsed_ms)
+        finally:
+            raw.close()
+
+        if len(rows) > self.row_limit:
+            record_metric("violation.row_limit")
+            rows = rows[: self.row_limit]
+
+        truncated = [tuple(sql_database.truncate_word(c, length=sql_database._max_string_length) for c in row) for row in rows]
+        return str(truncated), {"result": truncated, "col_keys": col_keys}
+
+
+def guard_sql_database(sql_database, guard: SQLGuard):
+    """回傳共用 schema/engine 的淺拷貝，但 run_sql 經過 guard"""
+    guarded = copy.copy(sql_database)
+    guarded.run_sql = partial(guard.run, sql_database)
+    return guarded
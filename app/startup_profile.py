@@ -0,0 +1,76 @@
+"""
+冷啟動 import 時間分析
+
+在新的 Python process 中以 `-X importtime` 載入服務模組，依套件與模組列出耗時；
+可設定預算（秒），超過時回傳非 0，供 CI 當作冷啟動的回歸檢查。
+"""
+
+import os
+import subprocess
+import sys
+import time
+from collections import defaultdict
+from typing import Dict, List, NamedTuple, Optional
+
+SERVICE_MODULES = {"web": "app.web_api", "line": "app.line_bot", "asgi": "app.asgi"}
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class ImportRecord(NamedTuple):
+    name: str
+    depth: int
+    self_us: int
+    cumulative_us: int
+
+
+def profile_imports(module: str) -> Dict:
+    """在乾淨的子 process 中 import module，回傳每個模組的耗時與整體 wall time"""
+    start = time.perf_counter()
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                          cwd=PROJECT_ROOT, capture_output=True, text=True)
+    wall = time.perf_counter() - start
+    records: List[ImportRecord] = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        # 格式：import time:  self [us] | cumulative | 縮排表示巢狀深度的模組名稱
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        stripped = name.lstrip()
+        depth = (len(name) - len(stripped) - 1) // 2
+        records.append(ImportRecord(stripped, depth, int(self_us), int(cumulative_us)))
+    if proc.returncode != 0:
+        raise RuntimeError(proc.stderr.strip().splitlines()[-1] if proc.stderr.strip() else f"import {module} failed")
+    return {"module": module, "wall_seconds": wall, "records": records}
+
+
+def summarize(profile: Dict, top: int = 15) -> Dict:
+    records: List[ImportRecord] = profile["records"]
+    total_us = sum(r.cumulative_us for r in records if r.depth == 0)
+    packages: Dict[str, int] = defaultdict(int)
+    for r in records:
+        packages[r.name.split(".")[0]] += r.self_us
+    return {
+        "module": profile["module"],
+        "wall_seconds": round(profile["wall_seconds"], 3),
+        "import_seconds": round(total_us / 1e6, 3),
+        "packages": sorted(packages.items(), key=lambda kv: kv[1], reverse=True)[:top],
+        "slowest": sorted(records, key=lambda r: r.cumulative_us, reverse=True)[:top],
+    }
+
+
+def print_startup_profile(service: str, top: int = 15, budget: Optional[float] = None) -> bool:
+    """印出 import 耗時分析；有設定 budget 時回傳是否在預算內"""
+    summary = summarize(profile_imports(SERVICE_MODULES[service]), top=top)
+    print(f"⏱️  Startup profile: import {summary['module']}")
+    print(f"   imports {summary['import_seconds']:.3f}s, process wall {summary['wall_seconds']:.3f}s")
+    print("   By package (self time):")
+    for package, us in summary["packages"]:
+        print(f"     {us / 1e3:9.1f} ms  {package}")
+    print("   Slowest modules (cumulative):")
+    for r in summary["slowest"]:
+        print(f"     {r.cumulative_us / 1e3:9.1f} ms  {r.name}")
+    if budget is None:
+        return True
+    ok = summary["import_seconds"] <= budget
+    print(f"{'✅' if ok else '❌'} Import time {summary['import_seconds']:.3f}s (budget {budget:.3f}s)")
+    return ok
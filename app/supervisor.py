@@ -0,0 +1,191 @@
+"""
+以獨立子 process 執行 web 與 LINE 兩個服務
+
+父 process 先載入兩邊的 app 與共用模型後才 fork，子 process 以 copy-on-write 共用這些記憶體；
+各子 process 有自己的 worker pool 與 GIL，其中一個當掉或卡住不會影響另一個。
+子 process 異常結束時自動重啟（指數退避），輸出統一加上服務名稱前綴後印出。
+"""
+
+import multiprocessing
+import os
+import selectors
+import signal
+import sys
+import time
+from typing import Dict, List, Optional
+
+from .server import SERVICE_PORTS, load_service_app, warm_shared_models
+
+RESTART_BACKOFF = float(os.environ.get("APP_RESTART_BACKOFF", "1"))
+RESTART_BACKOFF_MAX = float(os.environ.get("APP_RESTART_BACKOFF_MAX", "30"))
+# 子 process 穩定執行超過這段時間後，退避時間歸零
+STABLE_AFTER = float(os.environ.get("APP_RESTART_STABLE_AFTER", "60"))
+STOP_TIMEOUT = float(os.environ.get("APP_STOP_TIMEOUT", "35"))
+
+_fork = multiprocessing.get_context("fork")
+
+
+def _serve(service: str, application, log_fd: int, prod: bool, asgi: bool,
+           workers: Optional[int], threads: Optional[int]) -> None:
+    """子 process 進入點"""
+    os.dup2(log_fd, 1)
+    os.dup2(log_fd, 2)
+    os.close(log_fd)
+    sys.stdout.reconfigure(line_buffering=True)
+    sys.stderr.reconfigure(line_buffering=True)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+    # 父 process 預熱時開過的連線不能在子 process 沿用
+    from .models import dispose_engines
+    dispose_engines()
+    if service == "web":
+        from .web_api import app, db
+        with app.app_context():
+            db.engine.dispose(close=False)
+
+    port = SERVICE_PORTS[service]
+    if prod:
+        from .server import DEFAULT_THREADS, DEFAULT_WORKERS, run_prefork
+        run_prefork(service, workers=workers or DEFAULT_WORKERS, threads=threads or DEFAULT_THREADS,
+                    asgi=asgi, application=application)
+    elif service == "web" and asgi:
+        import uvicorn
+        uvicorn.run(application, host="0.0.0.0", port=port, log_level="info")
+    else:
+        # 子 process 中不能使用 reloader（會重新執行整個指令）
+        application.run(host="0.0.0.0", port=port, threaded=True, use_reloader=False)
+
+
+class _Child:
+    def __init__(self, service: str):
+        self.service = service
+        self.process: Optional[multiprocessing.Process] = None
+        self.log_fd: Optional[int] = None
+        self.buffer = b""
+        self.started_at = 0.0
+        self.restart_at: Optional[float] = None
+        self.backoff = RESTART_BACKOFF
+        self.restarts = 0
+
+
+class ServiceSupervisor:
+    def __init__(self, services: List[str], prod: bool = False, asgi: bool = False,
+                 workers: Optional[int] = None, threads: Optional[int] = None):
+        self.services = services
+        self.prod = prod
+        self.asgi = asgi
+        self.workers = workers
+        self.threads = threads
+        self.apps: Dict[str, object] = {}
+        self.children = {s: _Child(s) for s in services}
+        self.selector = selectors.DefaultSelector()
+        self.stopping = False
+
+    def log(self, service: str, line: str) -> None:
+        sys.stdout.write(f"[{service:<4}] {line}\n")
+        sys.stdout.flush()
+
+    def preload(self) -> None:
+        for service in self.services:
+            self.apps[service] = load_service_app(service, asgi=self.asgi)
+        warm_shared_models("line" if "line" in self.services else "web")
+
+    def start(self, child: _Child) -> None:
+        read_fd, write_fd = os.pipe()
+        child.process = _fork.Process(
+            target=_serve, name=f"app-{child.service}",
+            args=(child.service, self.apps[child.service], write_fd, self.prod, self.asgi, self.workers, self.threads),
+        )
+        child.process.start()
+        os.close(write_fd)
+        child.log_fd = read_fd
+        child.buffer = b""
+        child.started_at = time.monotonic()
+        child.restart_at = None
+        self.selector.register(read_fd, selectors.EVENT_READ, child)
+        self.log("main", f"started {child.service} (pid {child.process.pid}) on port {SERVICE_PORTS[child.service]}")
+
+    def _read(self, child: _Child) -> None:
+        try:
+            data = os.read(child.log_fd, 65536)
+        except OSError:
+            data = b""
+        if not data:
+            self._close_log(child)
+            return
+        child.buffer += data
+        *lines, child.buffer = child.buffer.split(b"\n")
+        for line in lines:
+            self.log(child.service, line.decode("utf-8", "replace"))
+
+    def _close_log(self, child: _Child) -> None:
+        if child.log_fd is None:
+            return
+        if child.buffer:
+            self.log(child.service, child.buffer.decode("utf-8", "replace"))
+            child.buffer = b""
+        self.selector.unregister(child.log_fd)
+        os.close(child.log_fd)
+        child.log_fd = None
+
+    def _check(self, child: _Child) -> None:
+        now = time.monotonic()
+        if child.restart_at is not None:
+            if now >= child.restart_at and not self.stopping:
+                child.restarts += 1
+                self.start(child)
+            return
+        if child.process is None or child.process.is_alive():
+            return
+        self._close_log(child)
+        if self.stopping:
+            return
+        if now - child.started_at >= STABLE_AFTER:
+            child.backoff = RESTART_BACKOFF
+        self.log("main", f"{child.service} exited with code {child.process.exitcode}; restarting in {child.backoff:g}s")
+        child.restart_at = now + child.backoff
+        child.backoff = min(child.backoff * 2, RESTART_BACKOFF_MAX)
+
+    def _request_stop(self, signum, frame) -> None:
+        self.stopping = True
+
+    def stop(self) -> None:
+        """轉送 SIGTERM 讓子 process 優雅結束（gunicorn 會等進行中的請求），逾時才強制終止"""
+        self.stopping = True
+        alive = [c for c in self.children.values() if c.process is not None and c.process.is_alive()]
+        for child in alive:
+            child.process.terminate()
+        deadline = time.monotonic() + STOP_TIMEOUT
+        while any(c.process.is_alive() for c in alive) and time.monotonic() < deadline:
+            for key, _ in self.selector.select(timeout=0.2):
+                self._read(key.data)
+        for child in alive:
+            if child.process.is_alive():
+                self.log("main", f"{child.service} did not stop in time; killing")
+                child.process.kill()
+            child.process.join()
+        for child in self.children.values():
+            while child.log_fd is not None:
+                self._read(child)
+
+    def run(self) -> None:
+        self.preload()
+        signal.signal(signal.SIGTERM, self._request_stop)
+        for child in self.children.values():
+            self.start(child)
+        try:
+            while not self.stopping:
+                for key, _ in self.selector.select(timeout=0.5):
+                    self._read(key.data)
+                for child in self.children.values():
+                    self._check(child)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+            self.log("main", "all services stopped")
+
+
+def run_supervised(services: List[str], prod: bool = False, asgi: bool = False,
+                   workers: Optional[int] = None, threads: Optional[int] = None) -> None:
+    ServiceSupervisor(services, prod=prod, asgi=asgi, workers=workers, threads=threads).run()
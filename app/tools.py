@@ -6,27 +6,66 @@ from llama_index.core.tools import QueryEngineTool, ToolMetadata, FunctionTool
 from llama_index.core.indices.vector_store import VectorStoreIndex
 from llama_index.core import SimpleDirectoryReader, StorageContext, load_index_from_storage
 from llama_index.core.query_engine import NLSQLTableQueryEngine
+from llama_index.core.retrievers import SQLRetriever
 from llama_index.core.callbacks import CallbackManager, CBEventType, LlamaDebugHandler
 from llama_index.core.prompts import PromptTemplate, PromptType
 from typing import Any, Dict, List
 
-from .models import get_sql_database
+from .schema_context import get_pruned_sql_database
+from .sql_guard import SQLGuard, guard_sql_database
+from .search import search_products
+from .db_executor import run_blocking
+from .tracing import span
 from .models import Store, Coupon, User, RealName, Product, ProductItem, Order, OrderItem, Delivery, Payment, WalletRecord, Interrogation, ProductFullView
 from .models import PageType, AdminLevel, CouponType, DeliveryStatus, ProductStatus, OrderStatus, PaymentStatus, UserLevel, WalletType, DeliveryMethod
 
 DOCS_DIR = os.environ.get("APP_DOCS_DIR", os.path.join(os.getcwd(), "docs"))
 
+def format_search_results(results: List[Dict[str, Any]]) -> str:
+    """商品搜尋結果轉成給使用者的文字（直接路由時使用，不經過 LLM）"""
+    lines = []
+    for r in results:
+        line = f"• {r['full_name']}：NT${r['price']}，庫存 {r['stock']}"
+        if r.get("discount"):
+            line += f"（{r['discount']}）"
+        lines.append(line)
+    return "為您找到以下商品：\n" + "\n".join(lines)
+
 # Helper to place order imperatively
 @dataclass
 class OrderItemInput:
     name: str
     quantity: int
 
+class TracedQueryEngineTool(QueryEngineTool):
+    """每次呼叫一個 tool span，查詢引擎內的 LLM、檢索與 SQL span 掛在底下"""
+
+    def call(self, *args: Any, **kwargs: Any):
+        with span(f"tool.{self.metadata.name}", **{"tool.input": str(args or kwargs)[:200]}):
+            return super().call(*args, **kwargs)
+
+    async def acall(self, *args: Any, **kwargs: Any):
+        with span(f"tool.{self.metadata.name}", **{"tool.input": str(args or kwargs)[:200]}):
+            return await super().acall(*args, **kwargs)
+
+class OffloadedSQLRetriever(SQLRetriever):
+    """SQLRetriever 的非同步版本只是直接呼叫同步的 run_sql；改成只把 SQL 執行交給 DB thread pool，
+    NL→SQL 與結果彙整的 LLM 呼叫仍在 event loop 上，不會佔住 DB thread"""
+
+    async def aretrieve_with_metadata(self, str_or_query_bundle):
+        return await run_blocking(self.retrieve_with_metadata, str_or_query_bundle)
+
+def build_sql_query_engine(sql_database, **kwargs: Any) -> NLSQLTableQueryEngine:
+    qe = NLSQLTableQueryEngine(sql_database=sql_database, **kwargs)
+    inner = qe.sql_retriever._sql_retriever
+    qe.sql_retriever._sql_retriever = OffloadedSQLRetriever(sql_database, return_raw=inner._return_raw)
+    return qe
+
 class ToolsBuilder:
     def __init__(self, store_id: int, user_id: str):
         self.store_id = store_id
         self.user_id = user_id
-        self.sql_db = get_sql_database()
+        self.sql_guard = SQLGuard(store_id, user_id)
         self.text_to_sql_prompt = PromptTemplate("""
 You are an expert SQL assistant for an online store. 
 Given an input question, generate a syntactically correct {dialect} SQL query to answer it. 
@@ -81,6 +120,7 @@ SQLQuery:
 
     def build_tools(self) -> List[QueryEngineTool]:
         return [
+            self.build_product_search_tool(),
             self.build_product_sql_tool(),
             self.build_order_sql_tool(),
             self.build_docs_tool(),
@@ -88,9 +128,29 @@ SQLQuery:
             self.build_request_more_info_tool(),
         ]
 
+    def product_search(self, query: str, limit: int = 5) -> List[Dict[str, Any]]:
+        from .models import SessionLocal
+        with span("tool.product_search_tool", **{"tool.input": query}), SessionLocal() as session:
+            return search_products(session, query, self.store_id, min(int(limit), 10))
+
+    async def aproduct_search(self, query: str, limit: int = 5) -> List[Dict[str, Any]]:
+        return await run_blocking(self.product_search, query, limit)
+
+    def build_product_search_tool(self) -> FunctionTool:
+        return FunctionTool.from_defaults(
+            fn=self.product_search,
+            async_fn=self.aproduct_search,
+            name="product_search_tool",
+            description=(
+                "此工具用於以關鍵字搜尋本店上架中的產品，依相關度排序，回傳產品全名、分類、價格、庫存與折扣。"
+                "參數: query (str, 產品名稱或關鍵字), limit (int, 預設 5)。"
+                "找產品時優先使用此工具；需要彙總、比較或複雜條件時才使用 product_sql_tool。"
+            ),
+        )
+
     def build_product_sql_tool(self) -> QueryEngineTool:
-        qe = NLSQLTableQueryEngine(sql_database=self.sql_db, tables=[ProductFullView.__table__], callback_manager=self.callback_manager, text_to_sql_prompt=self.text_to_sql_prompt)
-        return QueryEngineTool(
+        qe = build_sql_query_engine(guard_sql_database(get_pruned_sql_database("product"), self.sql_guard), tables=[ProductFullView.__tablename__], callback_manager=self.callback_manager, text_to_sql_prompt=self.text_to_sql_prompt)
+        return TracedQueryEngineTool(
             query_engine=qe,
             metadata=ToolMetadata(
                 name="product_sql_tool",
@@ -103,8 +163,8 @@ SQLQuery:
         )
 
     def build_order_sql_tool(self) -> QueryEngineTool:
-        qe = NLSQLTableQueryEngine(sql_database=self.sql_db, tables=[Order.__table__, OrderItem.__table__, User.__table__, Product.__table__, ProductItem.__table__], callback_manager=self.callback_manager, text_to_sql_prompt=self.text_to_sql_prompt)
-        return QueryEngineTool(
+        qe = build_sql_query_engine(guard_sql_database(get_pruned_sql_database("order"), self.sql_guard), tables=[Order.__tablename__, OrderItem.__tablename__, User.__tablename__, Product.__tablename__, ProductItem.__tablename__], callback_manager=self.callback_manager, text_to_sql_prompt=self.text_to_sql_prompt)
+        return TracedQueryEngineTool(
             query_engine=qe,
             metadata=ToolMetadata(
                 name="order_sql_tool",
@@ -125,7 +185,7 @@ SQLQuery:
             storage_context = StorageContext.from_defaults(persist_dir=os.path.join(os.getcwd(), "storage"))
             index = load_index_from_storage(storage_context)
         qe = index.as_query_engine(similarity_top_k=3)
-        return QueryEngineTool(
+        return TracedQueryEngineTool(
             query_engine=qe,
             metadata=ToolMetadata(
                 name="policy_docs_tool",
@@ -195,12 +255,16 @@ SQLQuery:
 
     def place_order(self, items: List[Dict[str, Any]], destination: str) -> Dict[str, Any]:
         parsed_items = [OrderItemInput(name=i["name"], quantity=int(i["quantity"])) for i in items]
-        return self._place_order_in_db( items=parsed_items, destination=destination)
+        with span("tool.place_order", **{"tool.input": str(items)[:200]}):
+            return self._place_order_in_db( items=parsed_items, destination=destination)
 
+    async def aplace_order(self, items: List[Dict[str, Any]], destination: str) -> Dict[str, Any]:
+        return await run_blocking(self.place_order, items, destination)
 
     def build_place_order_tool(self) -> FunctionTool:
         return FunctionTool.from_defaults(
             fn=self.place_order,
+            async_fn=self.aplace_order,
             name="place_order",
             description=(
                 "此工具用於下訂單，當使用者想要購買產品時可以使用。"
@@ -0,0 +1,578 @@
+"""
+輕量的分散式追蹤：HTTP 請求 → agent 回合 → ReAct 迭代 → 工具 / LLM / SQL
+
+    APP_TRACE=jsonl   span 寫到 APP_TRACE_FILE（預設 storage/logs/traces.jsonl），一行一個 span
+    APP_TRACE=otlp    以 OTLP/HTTP JSON 送到 APP_TRACE_ENDPOINT（預設 http://127.0.0.1:4318/v1/traces）
+
+    python -m app.tracing collect --port 4318     本機的 OTLP collector 替身，收到的 span 寫成 JSONL
+    python -m app.tracing show --last 3           以樹狀列出最近幾個 trace 的各段耗時
+
+目前的 span 放在 ContextVar：asyncio task、run_blocking 的 DB thread、run_coroutine_threadsafe 送到 agent loop 的
+coroutine 都會帶著建立當下的 context；LINE 的背景 worker 不會，由 LineEventDispatcher 在排入時記下 span。
+ReAct 迭代在 agent 每次推理（take_step）時開始，到下一次推理或回合結束為止；期間的 LLM 與工具 span 掛在迭代下。
+沒有開啟時 span() 直接回傳共用的空 context manager，也不掛 SQLAlchemy / LlamaIndex 事件。
+"""
+
+import argparse
+import atexit
+import json
+import os
+import queue
+import random
+import threading
+import time
+import urllib.request
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional
+
+TRACE_MODE = os.environ.get("APP_TRACE", "").lower()
+TRACE_FILE = os.environ.get("APP_TRACE_FILE", os.path.join(os.getcwd(), "storage", "logs", "traces.jsonl"))
+TRACE_ENDPOINT = os.environ.get("APP_TRACE_ENDPOINT", "http://127.0.0.1:4318/v1/traces")
+TRACE_SAMPLE = float(os.environ.get("APP_TRACE_SAMPLE", "1.0"))
+TRACE_SERVICE = os.environ.get("APP_TRACE_SERVICE", "shop")
+EXPORT_INTERVAL = 1.0
+EXPORT_BATCH = 256
+STATEMENT_MAX_CHARS = 1000
+
+ENABLED = TRACE_MODE in ("jsonl", "otlp")
+
+
+# =========================
+# Span
+# =========================
+
+class Span:
+    __slots__ = ("name", "trace_id", "span_id", "parent_id", "start_ns", "end_ns", "attributes", "error",
+                 "active", "_parent")
+
+    def __init__(self, name: str, parent: Optional["Span"] = None, trace_id: Optional[str] = None,
+                 parent_id: Optional[str] = None, **attributes: Any):
+        self.name = name
+        self.trace_id = parent.trace_id if parent is not None else (trace_id or f"{random.getrandbits(128):032x}")
+        self.span_id = f"{random.getrandbits(64):016x}"
+        self.parent_id = parent.span_id if parent is not None else parent_id
+        self.start_ns = time.time_ns()
+        self.end_ns: Optional[int] = None
+        self.attributes: Dict[str, Any] = {k: v for k, v in attributes.items() if v is not None}
+        self.error: Optional[str] = None
+        # 不經由 ContextVar 開關的子 span（ReAct 迭代）；current_span() 會往下走到最內層
+        self.active: Optional[Span] = None
+        self._parent = parent
+
+    def set(self, **attributes: Any) -> None:
+        self.attributes.update({k: v for k, v in attributes.items() if v is not None})
+
+    def start_child(self, name: str, **attributes: Any) -> "Span":
+        """開始子 span 並設為 active，之後在這個 span 底下建立的 span 都掛到它"""
+        child = Span(name, parent=self, **attributes)
+        self.active = child
+        return child
+
+    def end(self, error: Optional[BaseException] = None) -> None:
+        if self.end_ns is not None:
+            return
+        if self.active is not None:
+            # 提前結束（request_more_info、斷線）時，進行中的迭代一起關閉
+            self.active.end()
+        self.end_ns = time.time_ns()
+        if error is not None:
+            self.error = f"{type(error).__name__}: {error}"
+        if self._parent is not None and self._parent.active is self:
+            self._parent.active = None
+        self._parent = None
+        _exporter().add(self)
+
+    @property
+    def traceparent(self) -> str:
+        return f"00-{self.trace_id}-{self.span_id}-01"
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "trace_id": self.trace_id, "span_id": self.span_id, "parent_id": self.parent_id, "name": self.name,
+            "service": TRACE_SERVICE, "start": self.start_ns / 1e9,
+            "duration_ms": round(((self.end_ns or self.start_ns) - self.start_ns) / 1e6, 3),
+            "attributes": self.attributes, "error": self.error,
+        }
+
+
+class _NotSampled:
+    """未取樣的請求：子 span 看到它就不建立，避免只記錄到半棵樹"""
+    active = None
+
+
+NOT_SAMPLED = _NotSampled()
+_NOOP = nullcontext()
+
+_current: ContextVar[Any] = ContextVar("trace_span", default=None)
+
+
+def _innermost(span: Span) -> Span:
+    while span.active is not None:
+        span = span.active
+    return span
+
+
+def current_span() -> Optional[Span]:
+    span = _current.get()
+    return _innermost(span) if isinstance(span, Span) else None
+
+
+def capture() -> Any:
+    """記下目前的 trace，交給不會複製 context 的 thread（LINE worker）當作 span(parent=...)"""
+    current = _current.get()
+    return _innermost(current) if isinstance(current, Span) else current
+
+
+def next_iteration(name: str = "react.iteration", **attributes: Any) -> Optional[Span]:
+    """結束目前 span 底下進行中的迭代並開始新的一個；之後建立的 span 都掛到新的迭代"""
+    if not ENABLED:
+        return None
+    owner = _current.get()
+    if not isinstance(owner, Span):
+        return None
+    if owner.active is not None:
+        owner.active.end()
+    return owner.start_child(name, **attributes)
+
+
+def start_span(name: str, parent: Optional[Span] = None, **attributes: Any) -> Optional[Span]:
+    """建立子 span 但不設為目前的 span（跨事件開關、不適合用 with 的地方）；沒有上層 span 時回傳 None"""
+    if not ENABLED:
+        return None
+    parent = parent or current_span()
+    return Span(name, parent=parent, **attributes) if parent is not None else None
+
+
+def span(name: str, root: bool = False, parent: Optional[Span] = None, traceparent: Optional[str] = None,
+         **attributes: Any):
+    """with span("tool.order_sql_tool") as s: ...
+
+    root=True 時沒有上層 span 也會開新的 trace（並依 APP_TRACE_SAMPLE 取樣）；其餘的只在 trace 之內建立。
+    parent 用於 context 沒有跟過來的地方（LINE worker），traceparent 為 W3C 格式的上游 trace。
+    """
+    if not ENABLED:
+        return _NOOP
+    if parent is None:
+        parent = capture()
+    if parent is NOT_SAMPLED or (parent is None and not root):
+        return _NOOP
+    return _span_scope(name, parent, traceparent, attributes)
+
+
+@contextmanager
+def _span_scope(name: str, parent: Optional[Span], traceparent: Optional[str], attributes: Dict[str, Any]):
+    if parent is None:
+        install()
+    upstream = _parse_traceparent(traceparent) if parent is None else None
+    if parent is None and upstream is None and random.random() >= TRACE_SAMPLE:
+        token = _current.set(NOT_SAMPLED)
+        try:
+            yield None
+        finally:
+            _reset(token)
+        return
+    s = Span(name, parent=parent, trace_id=upstream and upstream[0], parent_id=upstream and upstream[1], **attributes)
+    token = _current.set(s)
+    try:
+        yield s
+    except GeneratorExit:
+        raise
+    except BaseException as e:
+        s.end(error=e)
+        raise
+    finally:
+        _reset(token)
+        s.end()
+
+
+def _reset(token) -> None:
+    try:
+        _current.reset(token)
+    except ValueError:
+        # async generator 被提前關閉時可能在別的 context 執行
+        _current.set(None)
+
+
+def _parse_traceparent(value: Optional[str]) -> Optional[tuple]:
+    parts = (value or "").strip().split("-")
+    if len(parts) != 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None
+    return parts[1], parts[2]
+
+
+# =========================
+# 匯出
+# =========================
+
+def _attribute_value(value: Any) -> Dict[str, Any]:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def to_otlp(spans: List[Span]) -> Dict[str, Any]:
+    """OTLP/HTTP JSON 的 ExportTraceServiceRequest"""
+    return {"resourceSpans": [{
+        "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": TRACE_SERVICE}}]},
+        "scopeSpans": [{"scope": {"name": "app.tracing"}, "spans": [{
+            "traceId": s.trace_id, "spanId": s.span_id, "parentSpanId": s.parent_id or "", "name": s.name,
+            "kind": 1, "startTimeUnixNano": str(s.start_ns), "endTimeUnixNano": str(s.end_ns),
+            "attributes": [{"key": k, "value": _attribute_value(v)} for k, v in s.attributes.items()],
+            "status": {"code": 2, "message": s.error} if s.error else {"code": 1},
+        } for s in spans]}],
+    }]}
+
+
+def from_otlp(payload: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """to_otlp 的反向：轉成與 JSONL 匯出相同的扁平格式"""
+    records = []
+    for resource_spans in payload.get("resourceSpans") or []:
+        service = next((a["value"].get("stringValue") for a in (resource_spans.get("resource") or {}).get("attributes", [])
+                        if a.get("key") == "service.name"), None)
+        for scope_spans in resource_spans.get("scopeSpans") or []:
+            for s in scope_spans.get("spans") or []:
+                start, end = int(s["startTimeUnixNano"]), int(s["endTimeUnixNano"])
+                status = s.get("status") or {}
+                records.append({
+                    "trace_id": s["traceId"], "span_id": s["spanId"], "parent_id": s.get("parentSpanId") or None,
+                    "name": s["name"], "service": service, "start": start / 1e9, "duration_ms": round((end - start) / 1e6, 3),
+                    "attributes": {a["key"]: next(iter(a["value"].values()), None) for a in s.get("attributes") or []},
+                    "error": status.get("message") if status.get("code") == 2 else None,
+                })
+    return records
+
+
+def append_jsonl(path: str, records: List[Dict[str, Any]]) -> None:
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "a", encoding="utf-8") as f:
+        for record in records:
+            f.write(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+
+
+class BatchExporter:
+    """結束的 span 放進佇列，背景 thread 每秒或每 EXPORT_BATCH 個寫出一次，不在請求路徑上做 I/O"""
+
+    def __init__(self, mode: str = TRACE_MODE, path: str = TRACE_FILE, endpoint: str = TRACE_ENDPOINT):
+        self.mode = mode
+        self.path = path
+        self.endpoint = endpoint
+        self.dropped = 0
+        self._queue: "queue.Queue[Span]" = queue.Queue(maxsize=EXPORT_BATCH * 40)
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def add(self, s: Span) -> None:
+        if self._pid != os.getpid():
+            # 第一次使用，或 prefork 後在子 process 中：背景 thread 不會跟著 fork
+            self._start()
+        try:
+            self._queue.put_nowait(s)
+        except queue.Full:
+            self.dropped += 1
+
+    def _start(self) -> None:
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._queue = queue.Queue(maxsize=EXPORT_BATCH * 40)
+            threading.Thread(target=self._run, name="trace-exporter", daemon=True).start()
+
+    def _run(self) -> None:
+        while True:
+            time.sleep(EXPORT_INTERVAL)
+            self.flush()
+
+    def flush(self) -> None:
+        while True:
+            batch: List[Span] = []
+            while len(batch) < EXPORT_BATCH:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            if not batch:
+                return
+            try:
+                self.export(batch)
+            except Exception as e:
+                self.dropped += len(batch)
+                print(f"⚠️  Trace export failed ({len(batch)} spans dropped): {e}")
+
+    def export(self, batch: List[Span]) -> None:
+        if self.mode == "otlp":
+            request = urllib.request.Request(self.endpoint, data=json.dumps(to_otlp(batch)).encode("utf-8"),
+                                             headers={"Content-Type": "application/json"}, method="POST")
+            with urllib.request.urlopen(request, timeout=5) as response:
+                response.read()
+        else:
+            append_jsonl(self.path, [s.to_dict() for s in batch])
+
+
+@lru_cache(maxsize=1)
+def _exporter() -> BatchExporter:
+    exporter = BatchExporter()
+    atexit.register(exporter.flush)
+    return exporter
+
+
+def flush() -> None:
+    if ENABLED:
+        _exporter().flush()
+
+
+# =========================
+# 掛勾：Flask、SQLAlchemy、LlamaIndex
+# =========================
+
+def instrument_tracing(app, service: str) -> None:
+    """每個請求一個 root span；接受上游的 traceparent，回應帶 X-Trace-Id"""
+    if not ENABLED:
+        return
+    from flask import g, request
+
+    @app.before_request
+    def _trace_start():
+        # 每個請求都從新的 root 開始（上一個串流回應若沒送完，thread 的 context 可能還留著它的 span）
+        _current.set(None)
+        rule = request.url_rule.rule if request.url_rule is not None else "<unmatched>"
+        scope = span(f"{request.method} {rule}", root=True, traceparent=request.headers.get("traceparent"),
+                     **{"service": service, "http.method": request.method, "http.route": rule, "http.target": request.full_path.rstrip("?")})
+        g._trace_span = scope.__enter__()
+        g._trace_scope = scope
+
+    @app.after_request
+    def _trace_status(response):
+        s = g.get("_trace_span")
+        if s is not None:
+            s.set(**{"http.status_code": response.status_code})
+            response.headers["X-Trace-Id"] = s.trace_id
+        scope = g.pop("_trace_scope", None)
+        if scope is not None:
+            # 伺服器送完回應內容後才呼叫 close；stream_with_context 的 teardown 在串流開始前就會先跑一次
+            response.call_on_close(lambda: scope.__exit__(None, None, None))
+        return response
+
+    @app.teardown_request
+    def _trace_end(exc=None):
+        s = g.pop("_trace_span", None)
+        if s is not None and exc is not None:
+            s.error = f"{type(exc).__name__}: {exc}"
+        scope = g.pop("_trace_scope", None)
+        if scope is not None:
+            # after_request 沒有執行到
+            scope.__exit__(None, None, None)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    s = start_span("sql", **{"db.statement": statement[:STATEMENT_MAX_CHARS], "db.executemany": executemany or None})
+    conn.info.setdefault("trace_spans", []).append(s)
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    spans = conn.info.get("trace_spans")
+    s = spans.pop() if spans else None
+    if s is not None:
+        if cursor.rowcount is not None and cursor.rowcount >= 0:
+            s.set(**{"db.rowcount": cursor.rowcount})
+        s.end()
+
+
+def _handle_error(context):
+    conn = context.connection
+    spans = conn.info.get("trace_spans") if conn is not None else None
+    s = spans.pop() if spans else None
+    if s is not None:
+        s.end(error=context.original_exception)
+
+
+def _make_llm_handler():
+    from llama_index.core.instrumentation.event_handlers import BaseEventHandler
+    from llama_index.core.instrumentation.events.llm import (
+        LLMChatStartEvent, LLMChatEndEvent, LLMCompletionStartEvent, LLMCompletionEndEvent,
+    )
+    from llama_index.core.instrumentation.events.retrieval import RetrievalStartEvent, RetrievalEndEvent
+
+    open_spans: Dict[str, Span] = {}
+
+    class TraceSpanHandler(BaseEventHandler):
+        @classmethod
+        def class_name(cls) -> str:
+            return "TraceSpanHandler"
+
+        def handle(self, event, **kwargs: Any) -> None:
+            key = event.span_id or ""
+            if isinstance(event, LLMChatStartEvent):
+                s = start_span("llm.chat", **{"llm.messages": len(event.messages)})
+            elif isinstance(event, LLMCompletionStartEvent):
+                s = start_span("llm.completion")
+            elif isinstance(event, RetrievalStartEvent):
+                s = start_span("retrieval", query=str(event.str_or_query_bundle)[:200])
+            elif isinstance(event, (LLMChatEndEvent, LLMCompletionEndEvent, RetrievalEndEvent)):
+                s = open_spans.pop(key, None)
+                if s is not None:
+                    if isinstance(event, RetrievalEndEvent):
+                        s.set(nodes=len(event.nodes))
+                    else:
+                        raw = getattr(event.response, "raw", None) if event.response is not None else None
+                        usage = raw.get("usage") if isinstance(raw, dict) else getattr(raw, "usage", None)
+                        get = usage.get if isinstance(usage, dict) else lambda k: getattr(usage, k, None)
+                        if usage is not None:
+                            s.set(**{"llm.prompt_tokens": get("prompt_tokens"), "llm.completion_tokens": get("completion_tokens")})
+                    s.end()
+                return
+            else:
+                return
+            if s is not None:
+                open_spans[key] = s
+
+    return TraceSpanHandler()
+
+
+@lru_cache(maxsize=1)
+def install() -> bool:
+    """掛一次 SQLAlchemy Engine 事件與 LlamaIndex 事件處理器；未開啟時不做任何事"""
+    if not ENABLED:
+        return False
+    from sqlalchemy import event
+    from sqlalchemy.engine import Engine
+
+    event.listen(Engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(Engine, "after_cursor_execute", _after_cursor_execute)
+    event.listen(Engine, "handle_error", _handle_error)
+    try:
+        from llama_index.core.instrumentation import get_dispatcher
+    except ImportError:
+        return True
+    get_dispatcher().add_event_handler(_make_llm_handler())
+    return True
+
+
+# =========================
+# CLI：collector 替身與檢視
+# =========================
+
+class CollectorHandler(BaseHTTPRequestHandler):
+    server: "CollectorServer"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        if not self.path.rstrip("/").endswith("/v1/traces"):
+            self.send_error(404)
+            return
+        if "json" not in (self.headers.get("Content-Type") or ""):
+            # 只實作 OTLP/HTTP 的 JSON 編碼
+            self.send_error(415, "only application/json is supported")
+            return
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        try:
+            records = from_otlp(json.loads(body or b"{}"))
+        except (ValueError, KeyError, TypeError) as e:
+            self.send_error(400, str(e))
+            return
+        with self.server.lock:
+            append_jsonl(self.server.output, records)
+            self.server.received += len(records)
+        payload = b"{}"
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+class CollectorServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, output: str):
+        super().__init__(address, CollectorHandler)
+        self.output = output
+        self.received = 0
+        self.lock = threading.Lock()
+
+
+def load_traces(path: str) -> Dict[str, List[Dict[str, Any]]]:
+    traces: Dict[str, List[Dict[str, Any]]] = defaultdict(list)
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            traces[record["trace_id"]].append(record)
+    return traces
+
+
+def print_trace(spans: List[Dict[str, Any]]) -> None:
+    children: Dict[Optional[str], List[Dict[str, Any]]] = defaultdict(list)
+    ids = {s["span_id"] for s in spans}
+    for s in spans:
+        children[s["parent_id"] if s["parent_id"] in ids else None].append(s)
+    origin = min(s["start"] for s in spans)
+
+    def walk(parent: Optional[str], depth: int) -> None:
+        for s in sorted(children.get(parent, []), key=lambda s: s["start"]):
+            detail = s["attributes"].get("db.statement") or s["attributes"].get("tool.input") or ""
+            mark = " ❌ " + s["error"] if s.get("error") else ""
+            print(f"  {(s['start'] - origin) * 1000:8.1f} {s['duration_ms']:9.1f} ms  {'  ' * depth}{s['name']}"
+                  f"{'  ' + ' '.join(str(detail).split())[:70] if detail else ''}{mark}")
+            walk(s["span_id"], depth + 1)
+
+    print(f"trace {spans[0]['trace_id']}  ({len(spans)} spans)")
+    print(f"  {'start ms':>8} {'duration':>12}")
+    walk(None, 0)
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Trace collector stand-in and viewer")
+    commands = parser.add_subparsers(dest="command", required=True)
+    collect = commands.add_parser("collect", help="Accept OTLP/HTTP JSON spans and append them as JSONL")
+    collect.add_argument("--host", default="127.0.0.1")
+    collect.add_argument("--port", type=int, default=4318)
+    collect.add_argument("--output", default=TRACE_FILE)
+    show = commands.add_parser("show", help="Print traces as span trees")
+    show.add_argument("--file", default=TRACE_FILE)
+    show.add_argument("--trace", default=None, help="Trace id (prefix) to print")
+    show.add_argument("--last", type=int, default=1, help="Print the most recent N traces")
+    show.add_argument("--min-ms", type=float, default=0, help="Only traces whose root took at least this long")
+    args = parser.parse_args(argv)
+
+    if args.command == "collect":
+        server = CollectorServer((args.host, args.port), os.path.abspath(args.output))
+        print(f"📥 Collecting OTLP/HTTP JSON on http://{args.host}:{args.port}/v1/traces -> {server.output}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            print(f"Received {server.received} spans")
+        return
+
+    traces = load_traces(args.file)
+    if args.trace:
+        selected = [spans for trace_id, spans in traces.items() if trace_id.startswith(args.trace)]
+    else:
+        def root_ms(spans):
+            return max(s["duration_ms"] for s in spans)
+        ordered = sorted(traces.values(), key=lambda spans: min(s["start"] for s in spans))
+        selected = [spans for spans in ordered if root_ms(spans) >= args.min_ms][-args.last:]
+    if not selected:
+        print("No matching traces")
+        return
+    for spans in selected:
+        print_trace(spans)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,274 @@
+import json
+import logging
+import os
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import asdict, dataclass, field
+from functools import lru_cache
+from typing import Any, Dict, List, Optional
+
+from .logfiles import open_process_log, process_log_files, tail_lines
+from .metrics import observe_turn
+
+# 每一輪 agent 對話的 LLM 用量、延遲與成本統計
+
+# 每個 process 寫 agent_turns.<pid>.jsonl（見 logfiles）
+USAGE_LOG_PATH = os.environ.get("APP_USAGE_LOG", os.path.join(os.getcwd(), "storage", "logs", "agent_turns.jsonl"))
+USAGE_LOG_MAX_BYTES = 5 * 1024 * 1024
+USAGE_LOG_BACKUPS = 3
+# 管理後台最多讀取最近這麼多 bytes 的記錄
+USAGE_READ_MAX_BYTES = int(os.environ.get("APP_USAGE_READ_MAX_BYTES", str(8 * 1024 * 1024)))
+
+# 每 1M tokens 的價格（USD），依使用的模型設定
+PROMPT_COST_PER_M = float(os.environ.get("APP_LLM_PROMPT_COST", "0.30"))
+COMPLETION_COST_PER_M = float(os.environ.get("APP_LLM_COMPLETION_COST", "2.50"))
+
+
+@dataclass
+class TurnStats:
+    store_id: int
+    user_id: str
+    started_at: float = field(default_factory=time.time)
+    llm_calls: int = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    ttft_ms: Optional[float] = None
+    llm_ms: float = 0.0
+    iterations: int = 0
+    tool_ms: Dict[str, float] = field(default_factory=dict)
+    sql_queries: int = 0
+    sql_ms: float = 0.0
+    retrieval_ms: float = 0.0
+    memory_ms: float = 0.0
+    persist_ms: float = 0.0
+    total_ms: float = 0.0
+    routed: Optional[str] = None
+    cost_usd: float = 0.0
+    error: Optional[str] = None
+
+    def finish(self) -> None:
+        self.total_ms = round((time.time() - self.started_at) * 1000, 1)
+        self.cost_usd = round(
+            self.prompt_tokens * PROMPT_COST_PER_M / 1e6 + self.completion_tokens * COMPLETION_COST_PER_M / 1e6, 6
+        )
+
+
+_current_turn: ContextVar[Optional[TurnStats]] = ContextVar("agent_turn", default=None)
+
+
+def current_turn() -> Optional[TurnStats]:
+    return _current_turn.get()
+
+
+@lru_cache(maxsize=1)
+def _usage_logger(pid: int) -> logging.Logger:
+    # 以 pid 為快取鍵：fork 出的 worker 第一次寫入時換成自己的檔案
+    return open_process_log("app.usage", USAGE_LOG_PATH, USAGE_LOG_MAX_BYTES, USAGE_LOG_BACKUPS)
+
+
+@contextmanager
+def track_turn(store_id: int, user_id: str):
+    """包住一輪對話；結束時寫入 rolling log"""
+    install_llm_instrumentation()
+    stats = TurnStats(store_id=int(store_id), user_id=str(user_id))
+    token = _current_turn.set(stats)
+    try:
+        yield stats
+    except Exception as e:
+        stats.error = type(e).__name__
+        raise
+    finally:
+        try:
+            _current_turn.reset(token)
+        except ValueError:
+            # async generator 被提前關閉時可能在別的 context 執行
+            _current_turn.set(None)
+        stats.finish()
+        observe_turn(stats)
+        _usage_logger(os.getpid()).info(json.dumps(asdict(stats), ensure_ascii=False))
+
+
+def record_tool(tool_name: str, ms: float) -> None:
+    stats = current_turn()
+    if stats is not None:
+        stats.tool_ms[tool_name] = round(stats.tool_ms.get(tool_name, 0.0) + ms, 1)
+
+
+def record_sql(ms: float) -> None:
+    stats = current_turn()
+    if stats is not None:
+        stats.sql_queries += 1
+        stats.sql_ms = round(stats.sql_ms + ms, 1)
+
+
+def record_memory_load(ms: float) -> None:
+    stats = current_turn()
+    if stats is not None:
+        stats.memory_ms = round(stats.memory_ms + ms, 1)
+
+
+def record_persist(ms: float) -> None:
+    stats = current_turn()
+    if stats is not None:
+        stats.persist_ms = round(stats.persist_ms + ms, 1)
+
+
+def record_iteration() -> None:
+    stats = current_turn()
+    if stats is not None:
+        stats.iterations += 1
+
+
+# =========================
+# LLM 事件（LlamaIndex instrumentation）
+# =========================
+
+def _usage_from_raw(raw: Any) -> Optional[Dict[str, int]]:
+    usage = raw.get("usage") if isinstance(raw, dict) else getattr(raw, "usage", None)
+    if usage is None:
+        return None
+    get = usage.get if isinstance(usage, dict) else lambda k: getattr(usage, k, None)
+    if get("prompt_tokens") is None:
+        return None
+    return {"prompt": get("prompt_tokens") or 0, "completion": get("completion_tokens") or 0}
+
+
+def _count_tokens(text: str) -> int:
+    try:
+        from llama_index.core.utils import get_tokenizer
+        return len(get_tokenizer()(text))
+    except ImportError:
+        return len(text) // 3
+
+
+def _make_handler():
+    from llama_index.core.instrumentation.event_handlers import BaseEventHandler
+    from llama_index.core.instrumentation.events.llm import (
+        LLMChatStartEvent, LLMChatInProgressEvent, LLMChatEndEvent,
+        LLMCompletionStartEvent, LLMCompletionInProgressEvent, LLMCompletionEndEvent,
+    )
+    from llama_index.core.instrumentation.events.retrieval import RetrievalStartEvent, RetrievalEndEvent
+
+    starts: Dict[str, float] = {}
+    first_token_seen = set()
+
+    class LLMUsageHandler(BaseEventHandler):
+        @classmethod
+        def class_name(cls) -> str:
+            return "LLMUsageHandler"
+
+        def handle(self, event, **kwargs: Any) -> None:
+            stats = current_turn()
+            if stats is None:
+                return
+            span = event.span_id or ""
+            now = time.perf_counter()
+            if isinstance(event, (LLMChatStartEvent, LLMCompletionStartEvent, RetrievalStartEvent)):
+                starts[span] = now
+            elif isinstance(event, RetrievalEndEvent):
+                started = starts.pop(span, None)
+                if started is not None:
+                    stats.retrieval_ms = round(stats.retrieval_ms + (now - started) * 1000, 1)
+            elif isinstance(event, (LLMChatInProgressEvent, LLMCompletionInProgressEvent)):
+                if span in starts and span not in first_token_seen:
+                    first_token_seen.add(span)
+                    if stats.ttft_ms is None:
+                        stats.ttft_ms = round((now - starts[span]) * 1000, 1)
+            elif isinstance(event, (LLMChatEndEvent, LLMCompletionEndEvent)):
+                started = starts.pop(span, None)
+                first_token_seen.discard(span)
+                stats.llm_calls += 1
+                if started is not None:
+                    stats.llm_ms = round(stats.llm_ms + (now - started) * 1000, 1)
+                    if stats.ttft_ms is None:
+                        stats.ttft_ms = round((now - started) * 1000, 1)
+                response = event.response
+                usage = _usage_from_raw(getattr(response, "raw", None)) if response is not None else None
+                if usage is None:
+                    prompt = event.prompt if isinstance(event, LLMCompletionEndEvent) else " ".join(str(m.content) for m in event.messages)
+                    usage = {"prompt": _count_tokens(prompt), "completion": _count_tokens(str(response or ""))}
+                stats.prompt_tokens += usage["prompt"]
+                stats.completion_tokens += usage["completion"]
+
+    return LLMUsageHandler()
+
+
+@lru_cache(maxsize=1)
+def install_llm_instrumentation() -> bool:
+    """在 root dispatcher 上掛一次 LLM 事件處理器"""
+    try:
+        from llama_index.core.instrumentation import get_dispatcher
+    except ImportError:
+        return False
+    get_dispatcher().add_event_handler(_make_handler())
+    return True
+
+
+# =========================
+# 查詢與彙總（給管理後台）
+# =========================
+
+def load_turns(path: str = USAGE_LOG_PATH, store_id: Optional[int] = None, user_id: Optional[str] = None,
+               since: Optional[float] = None, max_bytes: int = USAGE_READ_MAX_BYTES) -> List[Dict[str, Any]]:
+    """合併所有 process 的記錄，依開始時間排序；只讀最近 max_bytes，更早的記錄不計入"""
+    records = []
+    for line in tail_lines(process_log_files(path, modified_since=since), max_bytes):
+        try:
+            rec = json.loads(line)
+        except ValueError:
+            continue
+        if store_id is not None and rec.get("store_id") != store_id:
+            continue
+        if user_id is not None and rec.get("user_id") != str(user_id):
+            continue
+        if since is not None and rec.get("started_at", 0) < since:
+            continue
+        records.append(rec)
+    records.sort(key=lambda rec: rec.get("started_at", 0))
+    return records
+
+
+def _percentile(values: List[float], pct: float) -> Optional[float]:
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))]
+
+
+def aggregate_turns(records: List[Dict[str, Any]], group_by: str = "store_id") -> Dict[str, Dict[str, Any]]:
+    groups: Dict[str, List[Dict[str, Any]]] = defaultdict(list)
+    for rec in records:
+        groups[str(rec.get(group_by))].append(rec)
+
+    result = {}
+    for key, recs in groups.items():
+        tool_ms: Dict[str, float] = defaultdict(float)
+        for rec in recs:
+            for name, ms in (rec.get("tool_ms") or {}).items():
+                tool_ms[name] += ms
+        totals = [r["total_ms"] for r in recs]
+        ttfts = [r["ttft_ms"] for r in recs if r.get("ttft_ms") is not None]
+        result[key] = {
+            "turns": len(recs),
+            "llm_calls": sum(r["llm_calls"] for r in recs),
+            "llm_calls_per_turn": round(sum(r["llm_calls"] for r in recs) / len(recs), 2),
+            "prompt_tokens": sum(r["prompt_tokens"] for r in recs),
+            "completion_tokens": sum(r["completion_tokens"] for r in recs),
+            "cost_usd": round(sum(r.get("cost_usd", 0) for r in recs), 6),
+            "iterations": sum(r["iterations"] for r in recs),
+            "sql_queries": sum(r["sql_queries"] for r in recs),
+            "sql_ms": round(sum(r["sql_ms"] for r in recs), 1),
+            "retrieval_ms": round(sum(r.get("retrieval_ms", 0) for r in recs), 1),
+            "memory_ms": round(sum(r.get("memory_ms", 0) for r in recs), 1),
+            "persist_ms": round(sum(r.get("persist_ms", 0) for r in recs), 1),
+            "tool_ms": {k: round(v, 1) for k, v in tool_ms.items()},
+            "routed_turns": sum(1 for r in recs if r.get("routed")),
+            "errors": sum(1 for r in recs if r.get("error")),
+            "total_ms_p50": _percentile(totals, 50),
+            "total_ms_p95": _percentile(totals, 95),
+            "ttft_ms_p50": _percentile(ttfts, 50),
+            "ttft_ms_p95": _percentile(ttfts, 95),
+        }
+    return result
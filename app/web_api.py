@@ -1,17 +1,20 @@
-from flask import Flask, render_template, request, jsonify, redirect, url_for, flash, session
+from flask import Flask, Response, render_template, request, jsonify, redirect, url_for, flash, session, stream_with_context, send_from_directory
 from flask_cors import CORS
 from flask_sqlalchemy import SQLAlchemy
 from werkzeug.security import generate_password_hash, check_password_hash
 from datetime import datetime, date
 import json
 import os
+import threading
+from collections import defaultdict
 from typing import List, Dict, Any
 from functools import wraps
-from sqlalchemy import func
+from sqlalchemy import func, select
+from sqlalchemy.orm import joinedload, selectinload
 
 # Import models
 from .models import (
-    Base, get_engine, SessionLocal, SQLDatabase,
+    Base, get_engine, SessionLocal, Session as ModelSession,
     Store, RawPage, Product, ProductItem, Order, OrderItem, Delivery, Payment, Coupon, Admin, RealName, WalletRecord, Interrogation,
     PageType, AdminLevel, CouponType, DeliveryStatus, ProductStatus, 
     OrderStatus, PaymentStatus, UserLevel, WalletType, OrderLog, RawPage,
@@ -19,6 +22,13 @@ from .models import (
     ChatSession, ChatMessage,
     User,
 )
+from .search import search_products
+from . import catalog_cache  # noqa: F401  商品異動提交後讓 LINE 輪播快取失效
+from .usage import load_turns, aggregate_turns
+from .metrics import instrument_flask, metrics_response, watch_cache, watch_engines
+from .query_stats import instrument_queries, query_budget
+from .profiler import PROFILE_DIR, instrument_profiler, list_profiles
+from .tracing import instrument_tracing
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'your-secret-key-here')
@@ -28,6 +38,17 @@ app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
 db = SQLAlchemy(app)
 CORS(app)
+instrument_flask(app, "web")
+instrument_tracing(app, "web")
+instrument_queries(app)
+# 管理員以 X-Profile header 或 ?_profile=1 對單一請求做 profiling；權限與 /admin/profiles 相同（MANAGER 以上）
+instrument_profiler(app, lambda: session.get('user_type') == 'admin'
+                    and session.get('admin_level', 0) >= AdminLevel.MANAGER)
+
+@app.teardown_appcontext
+def remove_model_session(exc=None):
+    # Model.query 走 models.Session（thread-local scoped session），請求結束時歸還連線，否則 threaded server 會耗盡連線池
+    ModelSession.remove()
 
 # Provide an init function for run.py
 
@@ -123,21 +144,29 @@ def healthz():
 
 @app.route('/metrics')
 def metrics():
-    return jsonify({
-        'users': User.query.count(),
-        'products': Product.query.count(),
-        'orders': Order.query.count(),
-        'payments_paid': Payment.query.filter_by(status=PaymentStatus.PAID).count(),
-    })
+    """Prometheus 文字格式；業務數字來自快取，不會在每次抓取時掃描整張表"""
+    return metrics_response()
+
+@app.route('/admin/profiles')
+@admin_required(AdminLevel.MANAGER)
+def admin_profiles():
+    """已儲存的請求 profile（依路由分組，新的在前）"""
+    return jsonify(list_profiles())
+
+@app.route('/admin/profiles/<path:name>')
+@admin_required(AdminLevel.MANAGER)
+def admin_profile_download(name):
+    return send_from_directory(PROFILE_DIR, name, as_attachment=True)
 
 # -----------------
 # Frontend Routes
 # -----------------
 
 @app.route('/')
+@query_budget(10)
 def index():
     """Frontend homepage - separate from admin backend"""
-    products = Product.query.filter_by(status=ProductStatus.NORMAL).limit(8).all()
+    products = Product.query.options(selectinload(Product.product_items)).filter_by(status=ProductStatus.NORMAL).limit(8).all()
     # Load basic pages for footer linking
     store_id = session.get('store_id', 1)
     about = RawPage.query.filter_by(store_id=store_id, type=PageType.ABOUT_US).first()
@@ -232,6 +261,104 @@ def api_chat():
         db.session.rollback()
         return jsonify({'error': str(e)}), 500
 
+# 每位使用者一個 AgentBuilder，記憶與 ReAct Context 跨請求保留（有上限的 LRU/TTL 快取）
+_web_agents = None
+_web_agents_lock = threading.Lock()
+
+def get_web_agent(store_id: int, user_id: int):
+    global _web_agents
+    from .agent import AgentBuilder, shared_agent_objects
+    from .agent_cache import AgentCache
+
+    with _web_agents_lock:
+        if _web_agents is None:
+            _web_agents = AgentCache(lambda key: AgentBuilder(key[0], str(key[1])),
+                                     on_evict=lambda agent: agent.close(), shared=shared_agent_objects)
+    return _web_agents.get((store_id, user_id))
+
+watch_cache("agent_web", lambda: _web_agents.counters() if _web_agents is not None else None)
+
+def _flask_engines():
+    with app.app_context():
+        return [db.engine]
+
+watch_engines(_flask_engines)
+
+def persist_user_message(store_id: int, user_id: int, session_id, message: str) -> int:
+    """寫入使用者訊息（必要時建立新的 ChatSession），回傳 session id"""
+    try:
+        chat_session = db.session.get(ChatSession, int(session_id)) if session_id else None
+        if not chat_session or chat_session.user_id != user_id:
+            chat_session = ChatSession(store_id=store_id, user_id=user_id, status='ai')
+            db.session.add(chat_session)
+            db.session.flush()
+        db.session.add(ChatMessage(session_id=chat_session.id, sender='user', content=message))
+        db.session.commit()
+        return chat_session.id
+    except Exception:
+        db.session.rollback()
+        raise
+
+def persist_ai_message(session_id: int, content: str) -> None:
+    try:
+        db.session.add(ChatMessage(session_id=session_id, sender='ai', content=content))
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+def sse_event(event: str, data: Dict[str, Any]) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+@app.route('/api/chat/stream', methods=['POST'])
+@login_required
+def api_chat_stream():
+    """AI Chat 串流端點（Server-Sent Events）：回答片段與工具結果即時送出，結束後寫入 ChatMessage"""
+    if session.get('user_type') != 'user':
+        return jsonify({'error': '權限不足'}), 403
+
+    try:
+        data = request.get_json() or {}
+        message = data.get('message', '').strip()
+        session_id = data.get('session_id')
+
+        if not message:
+            return jsonify({'error': '訊息不能為空'}), 400
+
+        store_id = session.get('store_id', 1)
+        user_id = session.get('user_id')
+        chat_session_id = persist_user_message(store_id, user_id, session_id, message)
+        agent = get_web_agent(store_id, user_id)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+    from .agent import iter_chat_events
+
+    def generate():
+        yield sse_event('session', {'session_id': chat_session_id})
+        final = None
+        for event in iter_chat_events(agent, message):
+            if event['type'] == 'delta':
+                yield sse_event('delta', {'delta': event['delta']})
+            elif event['type'] == 'tool':
+                yield sse_event('tool', {'tool_name': event['tool_name'], 'output': event['output']})
+            elif event['type'] == 'done':
+                final = event['response']
+            elif event['type'] == 'error':
+                yield sse_event('error', {'error': event['error']})
+
+        if final is None:
+            return
+        try:
+            persist_ai_message(chat_session_id, final)
+        except Exception as e:
+            yield sse_event('error', {'error': f'訊息保存失敗：{str(e)}'})
+            return
+        yield sse_event('done', {'response': final, 'session_id': chat_session_id, 'timestamp': datetime.now().isoformat()})
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
 def generate_ai_response(message):
     """Generate AI response based on user message"""
     message_lower = message.lower()
@@ -286,10 +413,14 @@ def admin_dashboard():
 # -----------------
 
 @app.route('/admin/orders')
+@query_budget(10)
 @admin_required(AdminLevel.STAFF)
 def admin_orders():
     store_id = session.get('store_id', 1)
-    orders = Order.query.filter_by(store_id=store_id).order_by(Order.created_at.desc()).all()
+    # 列表會用到使用者、配送與商品名稱，一次載入避免每筆訂單各查一次
+    orders = (Order.query.options(joinedload(Order.user), joinedload(Order.delivery),
+                                  selectinload(Order.order_items).joinedload(OrderItem.product_item).joinedload(ProductItem.product))
+              .filter_by(store_id=store_id).order_by(Order.created_at.desc()).all())
     return render_template('admin/orders.html', orders=orders)
 
 @app.route('/admin/orders/<int:order_id>')
@@ -561,7 +692,7 @@ def admin_product_items(pid):
 @admin_required(AdminLevel.MANAGER)
 def admin_product_item_edit(item_id):
     try:
-        item = db.session.get(ProductItem, item_id)
+        item = db.session.get(ProductItem, item_id, options=[joinedload(ProductItem.product)])
         if not item:
             return jsonify({'error': '商品細項不存在'}), 404
         
@@ -585,7 +716,7 @@ def admin_product_item_edit(item_id):
 @admin_required(AdminLevel.MANAGER)
 def admin_product_item_delete(item_id):
     try:
-        item = db.session.get(ProductItem, item_id)
+        item = db.session.get(ProductItem, item_id, options=[joinedload(ProductItem.product)])
         if not item:
             return jsonify({'error': '商品細項不存在'}), 404
         
@@ -693,11 +824,35 @@ def admin_raw_page_edit(rid):
     
     return render_template('admin/raw_page_form.html', page=rp, page_types=list(PageType))
 
+# -----------------
+# Admin: Agent usage
+# -----------------
+
+@app.route('/admin/api/agent-usage')
+@admin_required(AdminLevel.MANAGER)
+def admin_agent_usage():
+    """AI 客服每輪的 LLM 用量、延遲與成本，依使用者彙總"""
+    try:
+        store_id = session.get('store_id', 1)
+        user_id = request.args.get('user_id')
+        hours = request.args.get('hours', type=float)
+        since = datetime.now().timestamp() - hours * 3600 if hours else None
+        records = load_turns(store_id=store_id, user_id=user_id, since=since)
+        return jsonify({
+            'store_id': store_id,
+            'store': aggregate_turns(records, group_by='store_id').get(str(store_id), {'turns': 0}),
+            'users': aggregate_turns(records, group_by='user_id'),
+            'recent': records[-20:],
+        })
+    except Exception as e:
+        return jsonify({'error': f'讀取用量失敗：{str(e)}'}), 500
+
 # -----------------
 # Admin: Customer Service
 # -----------------
 
 @app.route('/admin/customer-service')
+@query_budget(10)
 @admin_required(AdminLevel.STAFF)
 def admin_customer_service():
     store_id = session.get('store_id', 1)
@@ -709,15 +864,18 @@ def admin_customer_service():
             query = query.filter_by(status='resolved')
         elif status_filter == 'unresolved':
             query = query.filter(ChatSession.status != 'resolved')
-    sessions = query.order_by(ChatSession.created_at.desc()).all()
-    
+    sessions = query.options(joinedload(ChatSession.user)).order_by(ChatSession.created_at.desc()).all()
+
+    # 每個對話的最後一則訊息一次查出，不要逐一查詢
+    last_ids = (select(func.max(ChatMessage.id))
+                .where(ChatMessage.session_id.in_([cs.id for cs in sessions]))
+                .group_by(ChatMessage.session_id))
+    last_messages = {m.session_id: m for m in ChatMessage.query.filter(ChatMessage.id.in_(last_ids))}
+
     chats = []
     for cs in sessions:
-        last_msg = ChatMessage.query.filter_by(session_id=cs.id).order_by(ChatMessage.created_at.desc()).first()
-        user_name = None
-        if cs.user_id:
-            u = db.session.get(User, cs.user_id)
-            user_name = u.name if u else None
+        last_msg = last_messages.get(cs.id)
+        user_name = cs.user.name if cs.user else None
         chats.append({
             'id': cs.id,
             'user_id': cs.user_id,
@@ -873,10 +1031,10 @@ def api_create_order():
             total += item_total
             
             # Create order item
+            # OrderItem 沒有單價欄位，價格以 product_item 為準
             order_item = OrderItem(
                 product_item_id=product_item.id,
-                quantity=item_data['quantity'],
-                price=price
+                quantity=item_data['quantity']
             )
             order_items.append(order_item)
             
@@ -1036,12 +1194,10 @@ def api_products():
         if status:
             query = query.filter_by(status=ProductStatus(int(status)))
         
-        products = query.all()
+        products = query.options(selectinload(Product.product_items)).all()
         
         result = []
         for p in products:
-            # Get product items
-            items = ProductItem.query.filter_by(product_id=p.id).all()
             product_data = {
                 'id': p.id,
                 'name': p.name,
@@ -1049,17 +1205,18 @@ def api_products():
                 'descriptions': p.descriptions,
                 'detail': p.detail,
                 'picture': p.picture,
+                'carousel': p.carousel,
                 'status': p.status.value,
                 'items': []
             }
             
-            for item in items:
+            for item in p.product_items:
                 item_data = {
                     'id': item.id,
+                    'name': item.name,
                     'price': item.price,
                     'stock': item.stock,
                     'discount': item.discount,
-                    'carousel': item.carousel,
                     'status': item.status.value
                 }
                 product_data['items'].append(item_data)
@@ -1070,6 +1227,19 @@ def api_products():
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/search')
+def api_search():
+    """Full-text product search (FTS5 + bm25)"""
+    try:
+        q = request.args.get('q', '').strip()
+        if not q:
+            return jsonify({'error': '請輸入搜尋關鍵字'}), 400
+        store_id = request.args.get('store_id', 1, type=int)
+        limit = max(1, min(request.args.get('limit', 10, type=int), 50))
+        return jsonify(search_products(db.session, q, store_id, limit))
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/api/products/<int:product_id>')
 def api_product_detail(product_id: int):
     try:
@@ -1104,7 +1274,8 @@ def api_product_detail(product_id: int):
 def api_order_detail(order_id):
     """Get order details"""
     try:
-        order = db.session.get(Order, order_id)
+        order = db.session.get(Order, order_id, options=[
+            selectinload(Order.order_items).joinedload(OrderItem.product_item).joinedload(ProductItem.product)])
         if not order:
             return jsonify({'error': '訂單不存在'}), 404
         
@@ -1121,10 +1292,11 @@ def api_order_detail(order_id):
         }
         
         for item in order.order_items:
+            product_item = item.product_item
             item_data = {
-                'product_name': item.product.name if item.product else '未知商品',
+                'product_name': product_item.product.name if product_item and product_item.product else '未知商品',
                 'quantity': item.quantity,
-                'price': item.price
+                'price': product_item.price if product_item else None
             }
             order_data['items'].append(item_data)
         
@@ -1160,8 +1332,13 @@ def api_user_detail(user_id):
         return jsonify({'error': str(e)}), 500
 
 @app.route('/api/orders', methods=['GET'])
+@query_budget(10)
 def api_get_orders():
-    orders = Order.query.order_by(Order.created_at.desc()).all()
+    orders = Order.query.options(joinedload(Order.user)).order_by(Order.created_at.desc()).all()
+    # 明細一次查完再依訂單分組；selectinload 每 500 筆訂單就多一個 IN 批次，查詢數會隨訂單數成長
+    items_by_order = defaultdict(list)
+    for item in OrderItem.query.options(joinedload(OrderItem.product_item)).order_by(OrderItem.id):
+        items_by_order[item.order_id].append(item)
     result = []
     for order in orders:
         order_data = {
@@ -1172,7 +1349,7 @@ def api_get_orders():
             'created_at': order.created_at.isoformat() if hasattr(order, 'created_at') and order.created_at else None,
             'order_items': []
         }
-        for item in order.order_items:
+        for item in items_by_order[order.id]:
             order_data['order_items'].append({
                 'product_name': item.product_item.name if item.product_item else None,
                 'count': item.quantity,
@@ -1228,6 +1405,10 @@ def api_stats():
         category_counts = db.session.query(Product.catalog, func.count(Product.id)).filter_by(store_id=store_id).group_by(Product.catalog).all()
         category_stats = [{ 'category': c, 'count': int(n) } for c, n in category_counts]
 
+        # 各狀態的訂單數（儀表板的訂單狀態摘要）
+        status_counts = db.session.query(Order.status, func.count(Order.id)).filter_by(store_id=store_id).group_by(Order.status).all()
+        order_status_counts = {int(status): int(n) for status, n in status_counts}
+
         stats = {
             'total_products': total_products,
             'total_orders': total_orders,
@@ -1235,6 +1416,7 @@ def api_stats():
             'monthly_orders': monthly_orders,
             'monthly_revenue': int(monthly_revenue),
             'category_stats': category_stats,
+            'order_status_counts': order_status_counts,
             'store_id': store_id
         }
         return jsonify(stats)
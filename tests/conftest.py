@@ -0,0 +1,5 @@
+import os
+import sys
+
+# 讓 tests/ 底下可以直接 import app
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
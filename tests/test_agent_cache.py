@@ -0,0 +1,18 @@
+from app import agent_cache
+from app.agent_cache import AgentCache
+from app.metrics import REGISTRY, watch_cache
+
+
+def test_metrics_scrape_does_not_estimate_sizes(monkeypatch):
+    estimates = []
+    monkeypatch.setattr(agent_cache, "estimate_bytes", lambda value, shared: estimates.append(value) or 100)
+    cache = AgentCache(lambda key: [key])
+    cache.get("u1")
+    cache.get("u1")
+    watch_cache("agent_test", cache.counters)
+    assert 'cache="agent_test"' in REGISTRY.render()
+    assert estimates == []
+
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["estimated_bytes"]) == (1, 1, 100)
+    assert estimates == [["u1"]]
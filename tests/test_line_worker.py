@@ -0,0 +1,195 @@
+import asyncio
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+
+import pytest
+from linebot import LineBotApi
+from linebot.exceptions import LineBotApiError
+from linebot.models import TextSendMessage
+from sqlalchemy import create_engine
+
+from app import line_bot
+from app.line_worker import EventDeduplicator, LineEventDispatcher
+
+
+# =========================
+# 假的 LINE Messaging API
+# =========================
+
+class StubLineHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)) or b"{}")
+        kind = self.path.rsplit("/", 1)[-1]
+        self.server.calls.append((kind, body))
+        status = self.server.status.get(kind, 200)
+        payload = json.dumps({} if status == 200 else {"message": "Invalid reply token"}).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+@pytest.fixture
+def line_api(monkeypatch):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubLineHandler)
+    server.calls, server.status = [], {}
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    api = LineBotApi("test-token", endpoint=f"http://127.0.0.1:{server.server_address[1]}")
+    monkeypatch.setattr(line_bot, "get_line_bot_api", lambda: api)
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def line_event(age: float = 0.0, user_id: str = "U1"):
+    return SimpleNamespace(reply_token="reply-token", timestamp=(time.time() - age) * 1000,
+                           source=SimpleNamespace(user_id=user_id))
+
+
+def test_fresh_event_uses_reply_token(line_api):
+    line_bot.send_reply(line_event(), TextSendMessage(text="hi"))
+    assert [kind for kind, _ in line_api.calls] == ["reply"]
+    assert line_api.calls[0][1]["replyToken"] == "reply-token"
+
+
+def test_rejected_reply_token_falls_back_to_push(line_api):
+    line_api.status["reply"] = 400
+    line_bot.send_reply(line_event(), TextSendMessage(text="hi"))
+    assert [kind for kind, _ in line_api.calls] == ["reply", "push"]
+    assert line_api.calls[1][1]["to"] == "U1"
+
+
+def test_expired_reply_token_pushes_directly(line_api):
+    line_bot.send_reply(line_event(age=line_bot.REPLY_TOKEN_TTL + 5), TextSendMessage(text="hi"))
+    assert [kind for kind, _ in line_api.calls] == ["push"]
+
+
+def test_server_errors_are_not_pushed(line_api):
+    line_api.status["reply"] = 500
+    with pytest.raises(LineBotApiError):
+        line_bot.send_reply(line_event(), TextSendMessage(text="hi"))
+    assert [kind for kind, _ in line_api.calls] == ["reply"]
+
+
+# =========================
+# 背景 worker
+# =========================
+
+def webhook_event(user_id: str, seq: int, event_id: str = None):
+    return SimpleNamespace(type="message", source=SimpleNamespace(user_id=user_id), seq=seq,
+                           webhook_event_id=event_id or f"{user_id}-{seq}")
+
+
+def wait_for(predicate, timeout: float = 5.0) -> None:
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def test_events_of_one_user_run_in_order_and_users_in_parallel():
+    handled, running, peak = [], [0], [0]
+    lock = threading.Lock()
+
+    def handle(event):
+        with lock:
+            running[0] += 1
+            peak[0] = max(peak[0], running[0])
+        time.sleep(random.uniform(0.001, 0.02))
+        with lock:
+            running[0] -= 1
+            handled.append((event.source.user_id, event.seq))
+
+    dispatcher = LineEventDispatcher(handle, workers=4)
+    users = ["U1", "U2", "U3"]
+    for seq in range(10):
+        for user in users:
+            dispatcher.submit(webhook_event(user, seq))
+    wait_for(lambda: len(handled) == 30)
+    dispatcher.shutdown()
+
+    for user in users:
+        assert [seq for u, seq in handled if u == user] == list(range(10))
+    assert peak[0] > 1
+
+
+def test_redelivered_events_are_handled_once(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'dedup.db'}")
+    handled = []
+    dispatcher = LineEventDispatcher(lambda e: handled.append(e.seq), workers=2, dedup=EventDeduplicator(engine=engine))
+    assert dispatcher.submit(webhook_event("U1", 1, "evt-1"))
+    assert not dispatcher.submit(webhook_event("U1", 1, "evt-1"))
+    # 另一個 process（新的記憶體 LRU）收到重送，仍由資料庫判定為重複
+    other = EventDeduplicator(engine=engine)
+    assert other.seen("evt-1")
+    assert not other.seen("evt-2")
+    wait_for(lambda: dispatcher.pending() == 0 and handled)
+    dispatcher.shutdown()
+    assert handled == [1]
+    assert dispatcher.dedup.duplicates == 1
+
+
+# =========================
+# agent 逾時
+# =========================
+
+def test_timed_out_agent_turn_is_cancelled(monkeypatch):
+    cancelled = threading.Event()
+
+    class SlowAgent:
+        async def chat(self, text):
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+
+    monkeypatch.setattr(line_bot, "AGENT_TURN_TIMEOUT", 0.1)
+    monkeypatch.setattr(line_bot.line_service, "get_user_agent", lambda user_id: SlowAgent())
+    event = SimpleNamespace(source=SimpleNamespace(user_id="U1"), message=SimpleNamespace(text="還在嗎"))
+    reply = line_bot.line_service.handle_text_message(event)
+    assert "太久" in reply.text
+    assert cancelled.wait(2)
+
+
+# =========================
+# 分類 postback
+# =========================
+
+@pytest.fixture
+def carousels(monkeypatch):
+    requested, sent = [], []
+    monkeypatch.setattr(line_bot.line_service, "product_carousel_message",
+                        lambda category=None: requested.append(category) or f"carousel:{category}")
+    monkeypatch.setattr(line_bot, "send_reply", lambda event, message: sent.append(message))
+    return requested, sent
+
+
+def postback(data):
+    return SimpleNamespace(postback=SimpleNamespace(data=data))
+
+
+@pytest.mark.parametrize("data, category", [
+    ("category=electronics", "電子產品"),
+    ("category=all", None),
+])
+def test_category_postback_sends_carousel(carousels, data, category):
+    requested, sent = carousels
+    line_bot.handle_postback(postback(data))
+    assert requested == [category]
+    assert sent == [f"carousel:{category}"]
+
+
+def test_unknown_category_gets_text_fallback(carousels):
+    requested, sent = carousels
+    line_bot.handle_postback(postback("category=clothing"))
+    assert requested == []
+    assert isinstance(sent[0], TextSendMessage)
@@ -0,0 +1,278 @@
+import asyncio
+import logging
+import threading
+import time
+
+import pytest
+from llama_index.core.llms import ChatMessage, ChatResponse
+
+from app import llm_client
+from app.llm_client import LLMGate, PooledOpenAILike, TokenBucket, get_llm_metrics
+from app.mock_llm import MockLLMHandler, MockLLMServer
+
+
+class FlakyHandler(MockLLMHandler):
+    """依 server.script 依序回應：數字是錯誤狀態碼，"slow" 是延遲超過 client timeout，用完後照常回覆"""
+
+    def do_POST(self):
+        with self.server._lock:
+            self.server.hits += 1
+            action = self.server.script.pop(0) if self.server.script else None
+        if action == "slow":
+            time.sleep(1.0)
+        elif action is not None:
+            self.rfile.read(int(self.headers.get("Content-Length") or 0))
+            self._send_json(action, {"error": {"message": f"stub {action}", "type": "stub"}})
+            return
+        super().do_POST()
+
+
+class StubServer(MockLLMServer):
+    handler_class = FlakyHandler
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), ttft_ms=0, tokens_per_sec=0)
+        self.script = []
+        self.hits = 0
+
+
+@pytest.fixture
+def server():
+    server = StubServer()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture(autouse=True)
+def fast_backoff(monkeypatch):
+    monkeypatch.setattr(llm_client, "LLM_RETRY_BASE", 0.01)
+
+
+class FallbackLLM:
+    """只實作 chat / achat 的備援後端"""
+
+    def __init__(self):
+        self.calls = 0
+
+    def chat(self, messages, **kwargs):
+        self.calls += 1
+        return ChatResponse(message=ChatMessage(role="assistant", content="fallback"))
+
+    async def achat(self, messages, **kwargs):
+        return self.chat(messages, **kwargs)
+
+
+def make_llm(server, retries=2, timeout=5.0, **kwargs):
+    return PooledOpenAILike(model="mock-react", api_base=server.url, api_key="test", is_chat_model=True,
+                            gate=LLMGate(max_concurrency=4, rate=0, burst=1), retries=retries, timeout=timeout, **kwargs)
+
+
+def metric_delta(before, name):
+    return get_llm_metrics().get(name, 0) - before.get(name, 0)
+
+
+MESSAGES = [ChatMessage(role="user", content="hello")]
+
+
+@pytest.mark.parametrize("status", [429, 500, 503])
+def test_retries_retryable_status(server, status):
+    server.script = [status, status]
+    response = make_llm(server).chat(MESSAGES)
+    assert response.message.content
+    assert server.hits == 3
+
+
+def test_gives_up_after_max_retries(server):
+    server.script = [503, 503, 503]
+    with pytest.raises(Exception) as exc:
+        make_llm(server, retries=2).chat(MESSAGES)
+    assert getattr(exc.value, "status_code", None) == 503
+    assert server.hits == 3
+
+
+def test_client_errors_are_not_retried(server):
+    server.script = [400]
+    with pytest.raises(Exception):
+        make_llm(server).chat(MESSAGES)
+    assert server.hits == 1
+
+
+def test_timeout_is_retried(server):
+    server.script = ["slow"]
+    started = time.monotonic()
+    response = make_llm(server, timeout=0.3).chat(MESSAGES)
+    assert response.message.content
+    assert server.hits == 2
+    assert time.monotonic() - started < 1.0
+
+
+def test_stream_retries_before_first_chunk(server):
+    server.script = [429]
+    chunks = list(make_llm(server).stream_chat(MESSAGES))
+    assert chunks and chunks[-1].message.content == "好的，請問還有什麼需要協助的嗎？"
+    assert server.hits == 2
+
+
+def test_async_chat_retries(server):
+    server.script = [502]
+    response = asyncio.run(make_llm(server).achat(MESSAGES))
+    assert response.message.content
+    assert server.hits == 2
+
+
+def test_async_stream_retries(server):
+    server.script = [500]
+
+    async def collect():
+        return [chunk async for chunk in await make_llm(server).astream_chat(MESSAGES)]
+
+    chunks = asyncio.run(collect())
+    assert chunks[-1].message.content == "好的，請問還有什麼需要協助的嗎？"
+    assert server.hits == 2
+
+
+def test_gate_caps_concurrency_and_serves_waiters_in_order():
+    gate = LLMGate(max_concurrency=2, rate=0, burst=1)
+    active, peak, order = 0, 0, []
+
+    async def worker(i):
+        nonlocal active, peak
+        async with gate.aslot():
+            order.append(i)
+            active += 1
+            peak = max(peak, active)
+            await asyncio.sleep(0.01)
+            active -= 1
+
+    async def main():
+        tasks = []
+        for i in range(8):
+            tasks.append(asyncio.create_task(worker(i)))
+            await asyncio.sleep(0)  # 依序排入等待佇列
+        await asyncio.gather(*tasks)
+
+    asyncio.run(main())
+    assert peak == 2
+    assert order == list(range(8))
+
+
+def test_gate_is_shared_across_threads_and_loops():
+    gate = LLMGate(max_concurrency=1, rate=0, burst=1)
+    lock = threading.Lock()
+    active, peak = 0, 0
+
+    def hold():
+        nonlocal active, peak
+        with lock:
+            active += 1
+            peak = max(peak, active)
+        time.sleep(0.005)
+        with lock:
+            active -= 1
+
+    async def async_user():
+        for _ in range(5):
+            async with gate.aslot():
+                hold()
+
+    def sync_user():
+        for _ in range(5):
+            with gate.slot():
+                hold()
+
+    threads = [threading.Thread(target=asyncio.run, args=(async_user(),)) for _ in range(2)]
+    threads += [threading.Thread(target=sync_user) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=10)
+    assert not any(thread.is_alive() for thread in threads)
+    assert peak == 1
+
+
+def test_cancelled_waiter_does_not_leak_slot():
+    gate = LLMGate(max_concurrency=1, rate=0, burst=1)
+
+    async def main():
+        release = asyncio.Event()
+
+        async def holder():
+            async with gate.aslot():
+                await release.wait()
+
+        async def waiter():
+            async with gate.aslot():
+                pass
+
+        first = asyncio.create_task(holder())
+        await asyncio.sleep(0)
+        cancelled = asyncio.create_task(waiter())
+        await asyncio.sleep(0)
+        cancelled.cancel()
+        release.set()
+        await first
+        await asyncio.wait_for(waiter(), timeout=1)
+
+    asyncio.run(main())
+
+
+def test_token_bucket_reserves_future_tokens():
+    bucket = TokenBucket(rate=10, capacity=2)
+    waits = [bucket.reserve() for _ in range(4)]
+    assert waits[:2] == [0.0, 0.0]
+    assert waits[2] == pytest.approx(0.1, abs=0.02)
+    assert waits[3] == pytest.approx(0.2, abs=0.02)
+    assert TokenBucket(rate=0, capacity=1).reserve() == 0.0
+
+
+def test_gate_applies_rate_limit():
+    gate = LLMGate(max_concurrency=4, rate=20, burst=1)
+
+    async def main():
+        for _ in range(4):
+            async with gate.aslot():
+                pass
+
+    started = time.monotonic()
+    asyncio.run(main())
+    assert time.monotonic() - started >= 0.13
+
+
+def test_falls_back_when_primary_fails(server, caplog):
+    server.script = [400]
+    fallback = FallbackLLM()
+    before = get_llm_metrics()
+    with caplog.at_level(logging.WARNING, logger="app.llm_client"):
+        response = make_llm(server, fallback=fallback).chat(MESSAGES)
+    assert response.message.content == "fallback"
+    assert fallback.calls == 1
+    assert metric_delta(before, "fallback_calls") == 1
+    assert "using fallback" in caplog.text
+
+
+def test_async_falls_back_when_primary_fails(server):
+    server.script = [400]
+    fallback = FallbackLLM()
+    response = asyncio.run(make_llm(server, fallback=fallback).achat(MESSAGES))
+    assert response.message.content == "fallback"
+    assert server.hits == 1
+
+
+def test_hedge_returns_fallback_when_primary_is_slow(server):
+    server.script = ["slow"]
+    before = get_llm_metrics()
+    started = time.monotonic()
+    response = asyncio.run(make_llm(server, fallback=FallbackLLM(), hedge_delay=0.05).achat(MESSAGES))
+    assert response.message.content == "fallback"
+    assert time.monotonic() - started < 0.9
+    assert metric_delta(before, "hedged_calls") == 1
+    assert metric_delta(before, "fallback_wins") == 1
+
+
+def test_hedge_keeps_primary_when_it_answers_first(server):
+    before = get_llm_metrics()
+    response = asyncio.run(make_llm(server, fallback=FallbackLLM(), hedge_delay=0.5).achat(MESSAGES))
+    assert response.message.content != "fallback"
+    assert metric_delta(before, "hedged_calls") == 0
@@ -0,0 +1,55 @@
+import asyncio
+import logging
+
+import pytest
+from llama_index.core.llms import ChatMessage, MessageRole
+from sqlalchemy import create_engine
+
+from app.chat_store import SQLiteChatStore
+from app.memory import RollingSummaryMemory
+
+
+class FakeLLM:
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.prompts = []
+
+    async def acomplete(self, prompt):
+        self.prompts.append(prompt)
+        if self.fail:
+            raise RuntimeError("llm down")
+        return "摘要：使用者查詢過訂單"
+
+
+@pytest.fixture
+def store(tmp_path):
+    return SQLiteChatStore(engine=create_engine(f"sqlite:///{tmp_path / 'chat.db'}"))
+
+
+def _memory(store, llm):
+    return RollingSummaryMemory.from_defaults(llm=llm, chat_store=store, chat_store_key="u1", recent_turns=1, fold_batch=1)
+
+
+async def _talk(memory, turns):
+    for i in range(turns):
+        await memory.aput(ChatMessage(role=MessageRole.USER, content=f"問題 {i}"))
+        await memory.aput(ChatMessage(role=MessageRole.ASSISTANT, content=f"回答 {i}"))
+    if memory._summary_task is not None:
+        await asyncio.wait([memory._summary_task])
+
+
+def test_summary_is_not_a_chat_key(store):
+    memory = _memory(store, FakeLLM())
+    asyncio.run(_talk(memory, 3))
+    assert memory.get_summary() == "摘要：使用者查詢過訂單"
+    assert store.get_keys() == ["u1"]
+    assert memory.get()[0].role == MessageRole.SYSTEM
+
+
+def test_failed_fold_is_logged(store, caplog):
+    memory = _memory(store, FakeLLM(fail=True))
+    with caplog.at_level(logging.ERROR, logger="app.memory"):
+        asyncio.run(_talk(memory, 3))
+    assert "summary fold failed for u1" in caplog.text
+    assert memory.get_summary() is None
+    assert len(memory.get_all()) == 6
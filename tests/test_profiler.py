@@ -0,0 +1,50 @@
+import os
+
+import pytest
+from flask import Flask, Response
+
+from app import profiler
+from app.profiler import instrument_profiler
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    monkeypatch.setattr(profiler, "PROFILE_DIR", str(tmp_path))
+    allowed = {"value": True}
+    app = Flask(__name__)
+    instrument_profiler(app, lambda: allowed["value"], enabled=True)
+
+    @app.route("/plain")
+    def plain():
+        return "ok"
+
+    @app.route("/stream")
+    def stream():
+        return Response((chunk for chunk in ["data: a\n\n", "data: b\n\n"]), mimetype="text/event-stream")
+
+    client = app.test_client()
+    client.allowed = allowed
+    return client
+
+
+def test_profiles_regular_response(client, tmp_path):
+    response = client.get("/plain", headers={"X-Profile": "cprofile"})
+    path = response.headers["X-Profile-Path"]
+    assert os.path.exists(tmp_path / path)
+
+
+def test_streaming_response_is_not_profiled(client, tmp_path):
+    response = client.get("/stream", headers={"X-Profile": "1"})
+    assert response.get_data(as_text=True) == "data: a\n\ndata: b\n\n"
+    assert response.headers["X-Profile"] == "unsupported"
+    assert "X-Profile-Path" not in response.headers
+    assert os.listdir(tmp_path) == []
+    # 名額已釋放，下一個請求仍可 profile
+    assert "X-Profile-Path" in client.get("/plain", headers={"X-Profile": "1"}).headers
+
+
+def test_requires_permission(client, tmp_path):
+    client.allowed["value"] = False
+    response = client.get("/plain", headers={"X-Profile": "1"})
+    assert "X-Profile-Path" not in response.headers
+    assert os.listdir(tmp_path) == []
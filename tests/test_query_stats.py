@@ -0,0 +1,24 @@
+from app.query_stats import RequestQueries, statement_shape
+
+
+def test_shape_ignores_literals_and_in_list_length():
+    assert statement_shape("SELECT * FROM orders WHERE id = 3 AND name = 'a'") == \
+        statement_shape("SELECT * FROM orders WHERE id = 42 AND name = 'bb'")
+    assert statement_shape("SELECT * FROM t WHERE id IN (?, ?)") == statement_shape("SELECT * FROM t WHERE id IN (?)")
+
+
+def test_lazy_loads_are_reported_as_nplus1():
+    stats = RequestQueries()
+    for _ in range(6):
+        stats.record("SELECT * FROM order_items WHERE ? = order_items.order_id", 0.1)
+    assert [o["count"] for o in stats.repeated(threshold=5)] == [6]
+
+
+def test_selectin_batches_are_not_nplus1():
+    stats = RequestQueries()
+    batch = "SELECT * FROM order_items WHERE order_items.order_id IN (" + ", ".join("?" * 500) + ")"
+    for _ in range(12):
+        stats.record(batch, 0.1)
+    stats.record("SELECT * FROM order_items WHERE order_items.order_id IN (?)", 0.1)
+    assert stats.count == 13
+    assert stats.repeated(threshold=5) == []
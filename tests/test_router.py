@@ -0,0 +1,67 @@
+import asyncio
+
+from app.router import IntentRouter
+
+
+class FakeClassifier:
+    """固定回傳某個意圖，並記錄是在哪個 thread 執行"""
+
+    def __init__(self, intent, score=0.9, margin=0.5):
+        self.result = (intent, score, margin)
+        self.threads = []
+
+    def classify(self, text):
+        import threading
+        self.threads.append(threading.current_thread().name)
+        return self.result
+
+
+def test_longest_keyword_wins():
+    router = IntentRouter(classifier=FakeClassifier("product_lookup"))
+    route = router.route("購買流程是什麼")
+    assert route is not None and route.intent == "policy_question" and route.source == "keyword"
+
+
+def test_agent_only_keyword_goes_to_agent():
+    router = IntentRouter(classifier=FakeClassifier("product_lookup"))
+    assert router.route("我想購買耳機") is None
+
+
+def test_aroute_runs_classifier_off_the_loop():
+    classifier = FakeClassifier("policy_question")
+    router = IntentRouter(classifier=classifier)
+    route = asyncio.run(router.aroute("退貨和價格怎麼算"))
+    assert route is not None and route.intent == "policy_question" and route.source == "embedding"
+    assert classifier.threads and classifier.threads[0] != "MainThread"
+
+
+def test_aroute_keyword_skips_classifier():
+    classifier = FakeClassifier("product_lookup")
+    router = IntentRouter(classifier=classifier)
+    route = asyncio.run(router.aroute("查詢訂單狀態"))
+    assert route.intent == "order_status" and classifier.threads == []
+
+
+def test_logged_examples_come_from_recorded_tool_choices(tmp_path, monkeypatch):
+    from sqlalchemy import create_engine
+
+    from app import chat_store
+    from app.router import load_logged_examples
+
+    store = chat_store.SQLiteChatStore(engine=create_engine(f"sqlite:///{tmp_path / 'chat.db'}"))
+    store.add_tool_choice("u1", "我的包裹到哪了", "order_sql_tool")
+    store.add_tool_choice("u1", "我要下單", "place_order")
+    monkeypatch.setattr(chat_store, "get_chat_store", lambda: store)
+    examples = load_logged_examples()
+    assert examples["order_status"] == ["我的包裹到哪了"]
+    assert sum(len(texts) for texts in examples.values()) == 1
+
+
+def test_product_lookup_routes_to_keyword_search():
+    from app.router import search_terms
+
+    route = IntentRouter(classifier=None).route("藍牙耳機的價格是多少？")
+    assert route.tool_name == "product_search_tool"
+    assert search_terms("藍牙耳機的價格是多少？") == "藍牙耳機"
+    assert search_terms("查詢 SKU-1002 的價格與庫存") == "1002"
+    assert search_terms("有什麼商品") == ""
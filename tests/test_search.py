@@ -0,0 +1,38 @@
+import pytest
+from sqlalchemy import create_engine, text
+
+from app.models import Base, Product, ProductItem, Store
+from app.search import build_match_query, ensure_product_search_index, search_products
+
+
+@pytest.fixture
+def connection(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'search.db'}")
+    Base.metadata.create_all(engine, tables=[Store.__table__, Product.__table__, ProductItem.__table__])
+    ensure_product_search_index(engine)
+    with engine.begin() as conn:
+        conn.execute(text("INSERT INTO products (id, store_id, catalog, name, status) VALUES "
+                          "(1, 1, '美食', '茶葉禮盒', 'NORMAL'), (2, 1, '居家', '咖啡杯', 'NORMAL')"))
+        conn.execute(text("INSERT INTO product_items (id, product_id, name, price, stock, status) VALUES "
+                          "(1, 1, '烏龍', 500, 10, 'NORMAL'), (2, 1, '紅玉', 600, 10, 'NORMAL'), "
+                          "(3, 2, '白色', 300, 10, 'NORMAL')"))
+    with engine.connect() as conn:
+        yield conn
+
+
+def item_ids(connection, query):
+    return sorted(r["product_item_id"] for r in search_products(connection, query, store_id=1))
+
+
+def test_single_cjk_character_uses_prefix_query(connection):
+    assert build_match_query("茶") == '"茶"*'
+    assert item_ids(connection, "茶") == [1, 2]
+
+
+def test_bigram_query_matches(connection):
+    assert item_ids(connection, "咖啡") == [3]
+
+
+def test_soft_deleted_items_are_hidden(connection):
+    connection.execute(text("UPDATE product_items SET deleted_at = CURRENT_TIMESTAMP WHERE id = 2"))
+    assert item_ids(connection, "茶葉") == [1]
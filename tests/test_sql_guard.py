@@ -0,0 +1,154 @@
+import sqlite3
+
+import pytest
+from llama_index.core import SQLDatabase
+from sqlalchemy import create_engine
+
+from app.models import Order, OrderItem, Product, ProductItem
+from app.sql_guard import SQLGuard, SQLGuardError
+
+SCHEMA = """
+CREATE TABLE stores (id INTEGER PRIMARY KEY, store_name TEXT);
+CREATE TABLE users (id INTEGER PRIMARY KEY, name TEXT, email TEXT);
+CREATE TABLE orders (id INTEGER PRIMARY KEY, user_id INTEGER, store_id INTEGER, coupon TEXT, total INTEGER);
+CREATE TABLE order_items (id INTEGER PRIMARY KEY, order_id INTEGER, product_item_id INTEGER, quantity INTEGER);
+CREATE TABLE products (id INTEGER PRIMARY KEY, store_id INTEGER, name TEXT);
+CREATE TABLE product_items (id INTEGER PRIMARY KEY, product_id INTEGER, name TEXT, price INTEGER);
+CREATE VIEW product_full_view AS
+    SELECT pi.id AS id, p.store_id AS store_id, p.name || ' ' || pi.name AS full_name, pi.price AS price
+    FROM product_items pi JOIN products p ON p.id = pi.product_id;
+CREATE INDEX ix_orders_user_id ON orders (user_id);
+CREATE INDEX ix_order_items_order_id ON order_items (order_id);
+CREATE INDEX ix_products_store_id ON products (store_id);
+CREATE INDEX ix_product_items_product_id ON product_items (product_id);
+INSERT INTO stores VALUES (1, 'A'), (2, 'B');
+INSERT INTO users VALUES (1, 'alice', 'alice@example.com'), (2, 'bob', 'bob@example.com');
+INSERT INTO orders VALUES (10, 1, 1, 'update', 100), (11, 1, 1, NULL, 200), (20, 2, 1, NULL, 300);
+INSERT INTO order_items VALUES (1, 10, 1, 1), (2, 20, 2, 5);
+INSERT INTO products VALUES (1, 1, 'tea'), (2, 2, 'coffee');
+INSERT INTO product_items VALUES (1, 1, 'green', 50), (2, 2, 'black', 80);
+"""
+
+
+def make_database(path, extra=""):
+    engine = create_engine(f"sqlite:///{path}")
+    raw = engine.raw_connection()
+    try:
+        raw.driver_connection.executescript(SCHEMA + extra)
+    finally:
+        raw.close()
+    return SQLDatabase(engine)
+
+
+@pytest.fixture
+def database(tmp_path):
+    return make_database(tmp_path / "guard.db")
+
+
+@pytest.fixture
+def guard():
+    return SQLGuard(store_id=1, user_id="1")
+
+
+def rows(guard, database, sql):
+    return guard.run(database, sql)[1]["result"]
+
+
+def test_or_after_scope_predicate_stays_in_scope(guard, database):
+    assert rows(guard, database, "SELECT id FROM orders o WHERE o.user_id = 1 OR 1=1 ORDER BY id") == [(10,), (11,)]
+
+
+def test_union_with_other_user_stays_in_scope(guard, database):
+    sql = "SELECT id FROM orders WHERE user_id = 1 UNION SELECT id FROM orders WHERE user_id = 2"
+    assert sorted(rows(guard, database, sql)) == [(10,), (11,)]
+
+
+def test_subquery_and_join_stay_in_scope(guard, database):
+    sql = ("SELECT oi.quantity FROM order_items oi JOIN orders o ON o.id = oi.order_id "
+           "WHERE oi.order_id IN (SELECT id FROM orders WHERE user_id = 2 OR user_id = 1)")
+    assert rows(guard, database, sql) == [(1,)]
+
+
+def test_users_only_returns_current_user(guard, database):
+    assert rows(guard, database, "SELECT email FROM users") == [("alice@example.com",)]
+
+
+def test_products_scoped_by_store(guard, database):
+    assert rows(guard, database, "SELECT name FROM products WHERE store_id = 1 OR store_id = 2") == [("tea",)]
+    assert rows(guard, database, "SELECT full_name FROM product_full_view") == [("tea green",)]
+    assert rows(guard, database, "SELECT name FROM product_items") == [("green",)]
+
+
+def test_existing_with_clause_is_merged(guard, database):
+    sql = "WITH big AS (SELECT id, total FROM orders WHERE total > 50) SELECT id FROM big ORDER BY id"
+    assert rows(guard, database, sql) == [(10,), (11,)]
+
+
+def test_recursive_cte_is_allowed(guard, database):
+    sql = ("WITH RECURSIVE c(n) AS (SELECT 10 UNION ALL SELECT n + 1 FROM c WHERE n < 20) "
+           "SELECT o.id FROM c JOIN orders o ON o.id = c.n ORDER BY o.id")
+    assert rows(guard, database, sql) == [(10,), (11,)]
+
+
+def test_authorizer_allows_reads_of_local_ctes_only():
+    authorize = SQLGuard.authorizer([], {"c"})
+    assert authorize(sqlite3.SQLITE_READ, "c", "n", None, None) == sqlite3.SQLITE_OK
+    assert authorize(sqlite3.SQLITE_READ, "stores", "id", "main", "c") == sqlite3.SQLITE_DENY
+
+
+def test_scope_predicates_are_indexed():
+    for column in (Order.user_id, OrderItem.order_id, Product.store_id, ProductItem.product_id):
+        assert column.index
+
+
+def test_scoped_queries_do_not_count_as_unbounded_scans(database):
+    guard = SQLGuard(store_id=1, user_id="1", large_table_rows=1)
+    assert rows(guard, database, "SELECT total FROM orders ORDER BY id DESC LIMIT 5") == [(200,), (100,)]
+    assert rows(guard, database, "SELECT name FROM product_items") == [("green",)]
+
+
+def test_table_sizes_are_cached_per_database(tmp_path):
+    small = make_database(tmp_path / "small.db")
+    large = make_database(tmp_path / "large.db", "INSERT INTO stores VALUES (1000, 'Z');")
+    guard = SQLGuard(store_id=1, user_id="1")
+    sizes = []
+    for database in (large, small):
+        raw = database.engine.raw_connection()
+        try:
+            sizes.append(guard.table_size(raw.driver_connection, str(database.engine.url), "stores"))
+        finally:
+            raw.close()
+    assert sizes == [1000, 2]
+
+
+@pytest.mark.parametrize("sql", [
+    "SELECT id FROM main.orders",
+    "WITH stores AS (SELECT * FROM main.stores) SELECT store_name FROM stores",
+    "SELECT id FROM orders UNION SELECT id FROM main.orders",
+    "SELECT full_name FROM main.product_full_view",
+    "WITH o AS (SELECT * FROM main.orders) SELECT id FROM o",
+    "SELECT store_name FROM stores",
+    "SELECT name FROM sqlite_master",
+    "SELECT name FROM pragma_table_info('users')",
+])
+def test_reads_outside_scope_are_rejected(guard, database, sql):
+    with pytest.raises(SQLGuardError) as exc:
+        guard.run(database, sql)
+    assert exc.value.reason == "out_of_scope"
+
+
+def test_keywords_inside_string_literals_are_allowed(guard, database):
+    assert rows(guard, database, "SELECT id FROM orders WHERE coupon = 'update'") == [(10,)]
+    assert rows(guard, database, "SELECT id FROM orders WHERE coupon = 'a;b' -- drop table orders") == []
+
+
+@pytest.mark.parametrize("sql, reason", [
+    ("UPDATE orders SET total = 0", "not_select"),
+    ("SELECT id FROM orders WHERE id IN (SELECT 1); DELETE FROM orders", "multi_statement"),
+    ("WITH x AS (SELECT 1) DELETE FROM orders", "not_select"),
+    ("PRAGMA table_info(users)", "not_select"),
+])
+def test_non_select_is_rejected(guard, database, sql, reason):
+    with pytest.raises(SQLGuardError) as exc:
+        guard.run(database, sql)
+    assert exc.value.reason == reason
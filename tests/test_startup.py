@@ -0,0 +1,36 @@
+import json
+import subprocess
+import sys
+
+import pytest
+
+from app.startup_profile import PROJECT_ROOT
+
+# 冷啟動預算（秒）；這裡約 0.6s，留足 CI 機器的餘裕
+IMPORT_BUDGET_SECONDS = 5.0
+
+PROBE = """
+import json, sys, time
+started = time.perf_counter()
+import {module}
+print(json.dumps({{"seconds": time.perf_counter() - started, "modules": sorted(sys.modules)}}))
+"""
+
+
+def cold_import(module):
+    """在乾淨的子 process 中 import，回傳耗時與載入的模組"""
+    proc = subprocess.run([sys.executable, "-c", PROBE.format(module=module)],
+                          cwd=PROJECT_ROOT, capture_output=True, text=True, timeout=120)
+    assert proc.returncode == 0, proc.stderr
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+
+@pytest.mark.parametrize("module, forbidden", [
+    ("app.web_api", ("llama_index", "torch", "linebot")),
+    ("app.line_bot", ("llama_index", "torch")),
+])
+def test_cold_import_stays_light(module, forbidden):
+    result = cold_import(module)
+    loaded = {name.split(".")[0] for name in result["modules"]}
+    assert not loaded & set(forbidden)
+    assert result["seconds"] < IMPORT_BUDGET_SECONDS
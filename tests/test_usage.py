@@ -0,0 +1,62 @@
+import json
+import os
+
+from app import logfiles, usage
+from app.usage import load_turns
+
+
+def write_turns(path, records):
+    with open(path, "a", encoding="utf-8") as f:
+        for rec in records:
+            f.write(json.dumps(rec) + "\n")
+
+
+def turn(started_at, store_id=1, user_id="u1"):
+    return {"store_id": store_id, "user_id": user_id, "started_at": started_at}
+
+
+def test_each_process_writes_its_own_file(tmp_path, monkeypatch):
+    path = str(tmp_path / "logs" / "agent_turns.jsonl")
+    monkeypatch.setattr(usage, "USAGE_LOG_PATH", path)
+    pid = os.getpid()
+    usage._usage_logger.cache_clear()
+    try:
+        logger = usage._usage_logger(pid)
+        logger.info("first")
+        # 換成另一個 pid（模擬 fork 出的 worker）時會換掉 handler，不會兩邊都寫
+        monkeypatch.setattr(logfiles.os, "getpid", lambda: 424242)
+        logger = usage._usage_logger(424242)
+        logger.info("second")
+        assert len(logger.handlers) == 1
+    finally:
+        for handler in list(logger.handlers):
+            logger.removeHandler(handler)
+            handler.close()
+        usage._usage_logger.cache_clear()
+    written = {name: open(tmp_path / "logs" / name).read() for name in os.listdir(tmp_path / "logs")}
+    assert written == {f"agent_turns.{pid}.jsonl": "first\n", "agent_turns.424242.jsonl": "second\n"}
+
+
+def test_load_turns_merges_process_files_and_backups(tmp_path):
+    path = str(tmp_path / "agent_turns.jsonl")
+    write_turns(tmp_path / "agent_turns.101.jsonl.1", [turn(1), turn(3)])
+    write_turns(tmp_path / "agent_turns.101.jsonl", [turn(5)])
+    write_turns(tmp_path / "agent_turns.202.jsonl", [turn(2), turn(4, store_id=2)])
+    write_turns(tmp_path / "other.101.jsonl", [turn(6)])
+    assert [rec["started_at"] for rec in load_turns(path)] == [1, 2, 3, 4, 5]
+    assert [rec["started_at"] for rec in load_turns(path, store_id=1, since=2)] == [2, 3, 5]
+
+
+def test_load_turns_reads_only_the_tail(tmp_path):
+    path = str(tmp_path / "agent_turns.jsonl")
+    write_turns(tmp_path / "agent_turns.101.jsonl", [turn(i) for i in range(100)])
+    line_bytes = len(json.dumps(turn(99)) + "\n")
+    records = load_turns(path, max_bytes=line_bytes * 3 + 5)
+    assert [rec["started_at"] for rec in records] == [97, 98, 99]
+
+
+def test_tail_keeps_line_starting_exactly_at_the_cut(tmp_path):
+    target = tmp_path / "a.1.jsonl"
+    target.write_bytes(b"aa\nbb\ncc\n")
+    assert list(logfiles.tail_lines([str(target)], 6)) == ["bb", "cc"]
+    assert list(logfiles.tail_lines([str(target)], 5)) == ["cc"]